@@ -0,0 +1,85 @@
+import os
+import sys
+
+# The modules of unisonctrl import each other by name, like the script does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "unisonctrl"))
+
+import logging
+
+import pytest
+
+
+class MemoryStorage():
+    """Instance data and controller state kept in memory, like DataStorage
+    keeps them on disk."""
+
+    def __init__(self):
+        self.running_data = {}
+        self.state_data = {}
+
+    def get_data(self, key):
+        return self.running_data.get(key)
+
+    def set_data(self, key, data):
+        self.running_data[key] = data
+
+    def remove_data(self, key):
+        self.running_data.pop(key, None)
+
+    def get_state(self, key, default=None):
+        return self.state_data.get(key, default)
+
+    def set_state(self, key, data):
+        self.state_data[key] = data
+
+    def remove_state(self, key):
+        self.state_data.pop(key, None)
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+@pytest.fixture
+def make_handler(storage):
+    """Return a factory of sync root handlers, without reading config.py or
+    touching the system. Only the parts the tested methods use are set up."""
+    from unisonhandler import UnisonHandler
+    from restartpolicy import RestartPolicy
+    from scheduler import SyncScheduler
+    from bandwidth import BandwidthBudget
+
+    def make(rules, **config):
+        handler = UnisonHandler.__new__(UnisonHandler)
+        handler.config = dict({
+            'sync_hierarchy_rules': rules,
+            'unison_local_root': "/local",
+            'unison_remotes': [{'name': "remote", 'ssh_conn': "host", 'root': "/remote", 'ssh_keyfile': ""}],
+            'global_unison_config_options': ["-repeat=5"],
+            'latency_probe_interval': 0,
+            'bandwidth_limit': 0,
+            'scheduled_workers': 2,
+            'max_instance_starts_per_run': 0,
+            'restart_debounce': 0,
+            'restart_debounce_max': 900,
+            'restart_max_defer': 3600,
+            'instance_restart_min_interval': 0,
+            'global_restart_limit': 100,
+            'global_restart_window': 300,
+            'urgent_restart_components': ["remote"],
+            'crash_fast_failure_time': 300,
+            'crash_backoff_base': 60,
+            'crash_backoff_max': 3600,
+            'crash_backoff_jitter': 0,
+            'crash_quarantine_after': 5,
+            'crash_quarantine_time': 86400,
+        }, **config)
+        handler.logger = logging.getLogger("test")
+        handler.data_storage = storage
+        handler.restart_policy = RestartPolicy(handler.config, storage, handler.logger)
+        handler.scheduler = SyncScheduler(handler.config, storage, handler.logger)
+        handler.bandwidth = BandwidthBudget(handler.config, handler.logger)
+        return handler
+
+    return make
@@ -0,0 +1,65 @@
+import logging
+
+from admission import AdmissionControl
+
+REMOTE = {'name': "remote", 'max_instances': 0}
+
+
+def make_admission(storage, **config):
+    config = dict({
+        'max_instances': 0,
+        'max_instance_starts_per_run': 0,
+        'max_memory_percent': 0,
+        'max_load_per_cpu': 0,
+    }, **config)
+    return AdmissionControl(config, storage, logging.getLogger("test"))
+
+
+def test_queue_orders_by_priority_then_rule_order(storage):
+    admission = make_admission(storage)
+    admission.enqueue("low", 2, 0, REMOTE)
+    admission.enqueue("high-later", 0, 5, REMOTE)
+    admission.enqueue("high-first", 0, 1, REMOTE)
+    admission.enqueue("normal", 1, 2, REMOTE)
+
+    assert admission.admit([]) == ["high-first", "high-later", "normal", "low"]
+    assert storage.get_state(AdmissionControl.STATE_KEY) is None
+
+
+def test_starts_per_run_are_capped(storage):
+    admission = make_admission(storage, max_instance_starts_per_run=2)
+
+    for order, name in enumerate(["a", "b", "c"]):
+        admission.enqueue(name, 1, order, REMOTE)
+
+    assert admission.admit([]) == ["a", "b"]
+    assert storage.get_state(AdmissionControl.STATE_KEY) == ["c"]
+
+
+def test_starts_of_other_roots_count_towards_the_cap(storage):
+    admission = make_admission(storage, max_instance_starts_per_run=3)
+
+    for order, name in enumerate(["a", "b", "c"]):
+        admission.enqueue(name, 1, order, REMOTE)
+
+    assert admission.admit([], 2) == ["a"]
+
+
+def test_running_instances_count_towards_max_instances(storage):
+    admission = make_admission(storage, max_instances=3)
+
+    for order, name in enumerate(["a", "b", "c"]):
+        admission.enqueue(name, 1, order, REMOTE)
+
+    assert admission.admit([{'remote': "remote"}, {'remote': "other"}]) == ["a"]
+
+
+def test_full_remote_does_not_hold_up_other_remotes(storage):
+    admission = make_admission(storage)
+    small = {'name': "small", 'max_instances': 1}
+    admission.enqueue("small-1", 0, 0, small)
+    admission.enqueue("small-2", 0, 1, small)
+    admission.enqueue("other", 1, 2, REMOTE)
+
+    assert admission.admit([]) == ["small-1", "other"]
+    assert storage.get_state(AdmissionControl.STATE_KEY) == ["small-2"]
@@ -0,0 +1,74 @@
+import logging
+import subprocess
+
+import pytest
+
+import archives
+from archives import ArchiveManager
+
+REMOTES = [
+    {'name': "a", 'ssh_conn': "host-a", 'root': "/remote", 'ssh_keyfile': "/keys/a"},
+    {'name': "b", 'ssh_conn': "host-b", 'root': "/remote", 'ssh_keyfile': ""},
+]
+
+
+@pytest.fixture
+def ssh_calls(monkeypatch):
+    """Record the ssh commands instead of running them."""
+    calls = []
+
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, b"", b"")
+
+    monkeypatch.setattr(archives.subprocess, "run", run)
+    return calls
+
+
+def make_manager(remotes):
+    config = {
+        'isolate_unison_archives': True,
+        'unison_remote_archive_dir': ".unison-instances",
+        'unison_remotes': remotes,
+    }
+    return ArchiveManager(config, logging.getLogger("test"))
+
+
+def test_archives_are_removed_on_their_own_remote(ssh_calls):
+    manager = make_manager(REMOTES)
+
+    assert manager.remove_remote_archives(["docs@a", "media@a"]) is True
+
+    assert ssh_calls == [[
+        "ssh", "-o", "BatchMode=yes", "-i", "/keys/a", "host-a",
+        "rm -rf -- .unison-instances/docs@a .unison-instances/media@a"
+    ]]
+
+
+def test_each_remote_gets_its_instances(ssh_calls):
+    manager = make_manager(REMOTES)
+
+    manager.remove_remote_archives(["docs@a", "docs@b"])
+
+    assert [x[-2:] for x in ssh_calls] == [
+        ["host-a", "rm -rf -- .unison-instances/docs@a"],
+        ["host-b", "rm -rf -- .unison-instances/docs@b"],
+    ]
+
+
+def test_unnamed_remote_keeps_plain_names(ssh_calls):
+    manager = make_manager([dict(REMOTES[0], name="")])
+
+    manager.remove_remote_archives(["docs"])
+
+    assert ssh_calls[0][-1] == "rm -rf -- .unison-instances/docs"
+
+
+def test_failed_removal_is_reported(monkeypatch):
+    manager = make_manager(REMOTES)
+    monkeypatch.setattr(
+        archives.subprocess, "run",
+        lambda cmd, **kwargs: subprocess.CompletedProcess(cmd, 255, b"", b"Permission denied")
+    )
+
+    assert manager.remove_remote_archives(["docs@b"]) is False
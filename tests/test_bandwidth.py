@@ -0,0 +1,111 @@
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from bandwidth import BandwidthBudget
+
+THROTTLEPIPE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "unisonctrl", "throttlepipe.py"
+)
+LIMIT = 1000000
+
+
+def make_budget(tmp_path):
+    config = {
+        'bandwidth_limit': LIMIT,
+        'bandwidth_idle_reserve': 0.1,
+        'bandwidth_rate_dir': str(tmp_path),
+    }
+    return BandwidthBudget(config, logging.getLogger("test"))
+
+
+def make_instance(tmp_path, name, weight):
+    return {'syncname': name, 'rate_file': str(tmp_path / name), 'bandwidth_weight': weight}
+
+
+def read_rate(instance_info):
+    with open(instance_info['rate_file']) as f:
+        return int(f.read())
+
+
+def run_pipe(tmp_path, rate, data, command="cat", args=()):
+    rate_file = tmp_path / "rate"
+    rate_file.write_text(str(rate))
+    env = dict(os.environ, UNISONCTRL_RATE_FILE=str(rate_file), UNISONCTRL_SSH_COMMAND=command)
+
+    start = time.monotonic()
+    proc = subprocess.run(
+        [sys.executable, THROTTLEPIPE] + list(args), input=data, stdout=subprocess.PIPE, env=env, timeout=60
+    )
+    return proc, time.monotonic() - start
+
+
+def test_idle_link_goes_to_the_only_busy_instance(tmp_path):
+    budget = make_budget(tmp_path)
+    main = make_instance(tmp_path, "main", 1)
+    catchall = make_instance(tmp_path, "catchall", 0.25)
+
+    budget.update([(main, False), (catchall, True)])
+
+    assert read_rate(catchall) > 0.9 * LIMIT
+    assert read_rate(main) == int(LIMIT * 0.1 / 1.25)
+
+
+def test_shares_follow_weights_when_nothing_transfers(tmp_path):
+    budget = make_budget(tmp_path)
+    main = make_instance(tmp_path, "main", 1)
+    catchall = make_instance(tmp_path, "catchall", 0.25)
+
+    budget.update([(main, False), (catchall, False)])
+
+    assert read_rate(main) == int(LIMIT * 0.8)
+    assert read_rate(catchall) == int(LIMIT * 0.2)
+
+
+def test_busy_instances_split_the_spare_bandwidth_by_weight(tmp_path):
+    budget = make_budget(tmp_path)
+    a = make_instance(tmp_path, "a", 3)
+    b = make_instance(tmp_path, "b", 1)
+    idle = make_instance(tmp_path, "idle", 1)
+
+    budget.update([(a, True), (b, True), (idle, False)])
+
+    assert abs(read_rate(a) - 3 * read_rate(b)) <= 3
+    assert read_rate(a) + read_rate(b) + read_rate(idle) <= LIMIT
+
+
+def test_unchanged_shares_are_not_rewritten(tmp_path):
+    budget = make_budget(tmp_path)
+    instances = [(make_instance(tmp_path, "a", 1), True), (make_instance(tmp_path, "b", 1), False)]
+
+    assert budget.update(instances) == 2
+    assert budget.update(instances) == 0
+
+
+def test_loopback_transport_is_relayed_unchanged(tmp_path):
+    data = os.urandom(256 * 1024)
+
+    proc, elapsed = run_pipe(tmp_path, 0, data)
+
+    assert proc.returncode == 0
+    assert proc.stdout == data
+
+
+def test_loopback_transport_is_throttled(tmp_path):
+    # Both directions share the rate, so the echo moves twice the data
+    rate = 200000
+    data = os.urandom(200 * 1024)
+
+    proc, elapsed = run_pipe(tmp_path, rate, data)
+
+    assert proc.stdout == data
+    assert elapsed >= 2 * len(data) / rate - 0.5 - 0.2
+
+
+def test_transport_arguments_and_exit_code_are_passed_on(tmp_path):
+    proc, elapsed = run_pipe(tmp_path, 0, b"hello", command="sh", args=["-c", "cat; exit 3"])
+
+    assert proc.stdout == b"hello"
+    assert proc.returncode == 3
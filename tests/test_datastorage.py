@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import datastorage
+from datastorage import DataStorage
+
+
+def make_storage(tmp_path):
+    config = {
+        'running_data_dir': str(tmp_path / "running"),
+        'state_data_dir': str(tmp_path / "state"),
+    }
+    os.makedirs(config['running_data_dir'], exist_ok=True)
+    os.makedirs(config['state_data_dir'], exist_ok=True)
+
+    # Read-only storage registers no exit handler, but still writes state
+    return DataStorage(False, config, read_only=True)
+
+
+def test_state_is_read_back(tmp_path):
+    make_storage(tmp_path).set_state("restart-policy", {'pending': {"a": 1}})
+
+    assert make_storage(tmp_path).get_state("restart-policy") == {'pending': {"a": 1}}
+
+
+def test_interrupted_write_keeps_the_previous_state(tmp_path, monkeypatch):
+    storage = make_storage(tmp_path)
+    storage.set_state("restart-policy", {'history': [1, 2]})
+
+    def crash(source, destination):
+        raise OSError("interrupted")
+
+    monkeypatch.setattr(datastorage.os, "replace", crash)
+
+    with pytest.raises(OSError):
+        storage.set_state("restart-policy", {'history': [1, 2, 3]})
+
+    monkeypatch.undo()
+    assert make_storage(tmp_path).get_state("restart-policy") == {'history': [1, 2]}
@@ -0,0 +1,117 @@
+import logging
+import os
+import shutil
+
+import pytest
+
+import latencyprobe
+from latencyprobe import LatencyProbe
+
+# Stand-in for ssh: each remote is a local directory named by its ssh_conn,
+# and the relative remote root is resolved inside it
+HOST_COMMAND = "sh -c 'cd -- \"$UNISONCTRL_REMOTE_SSH_CONN\" && exec sh -s'"
+
+
+class Clock():
+    """Clock of the probe, advanced by the tests."""
+
+    def __init__(self):
+        self.now = 100000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(latencyprobe.time, "time", clock)
+    return clock
+
+
+def make_probe(tmp_path, storage):
+    local_root = tmp_path / "local"
+    config = {
+        'unison_local_root': str(local_root),
+        'latency_probe_interval': 60,
+        'latency_probe_command': HOST_COMMAND,
+        'latency_probe_timeout': 30,
+        'latency_probe_max_wait': 3600,
+    }
+    return LatencyProbe(config, storage, logging.getLogger("test"))
+
+
+def make_instances(tmp_path, hosts):
+    running_data = {}
+    remotes = {}
+
+    for pid, host in enumerate(hosts, 100):
+        instance_name = "rule@" + host
+        os.makedirs(tmp_path / "local" / LatencyProbe.CANARY_DIR / instance_name)
+        os.makedirs(tmp_path / host / "share" / LatencyProbe.CANARY_DIR / instance_name)
+        running_data[instance_name] = {'syncname': instance_name, 'pid': pid, 'rule': "rule", 'remote': host}
+        remotes[host] = {'name': host, 'ssh_conn': str(tmp_path / host), 'ssh_keyfile': "", 'root': "share"}
+
+    return running_data, remotes
+
+
+def sync_canary(tmp_path, storage, instance_name, host):
+    """Copy a canary to a remote, like unison would."""
+    path = storage.get_state(LatencyProbe.STATE_KEY)['pending'][instance_name]['path']
+    shutil.copy(tmp_path / "local" / path, tmp_path / host / "share" / path)
+
+
+def test_each_remote_is_checked_on_its_own_host(tmp_path, storage, clock):
+    probe = make_probe(tmp_path, storage)
+    running_data, remotes = make_instances(tmp_path, ["host-a", "host-b"])
+
+    assert probe.start(running_data) == 2
+
+    # Only host-a received its canary
+    sync_canary(tmp_path, storage, "rule@host-a", "host-a")
+    clock.now += 5
+    probe.check(running_data, remotes)
+
+    state = storage.get_state(LatencyProbe.STATE_KEY)
+    assert list(state['pending']) == ["rule@host-b"]
+    assert len(state['results']["rule"]['samples']) == 1
+
+
+def test_command_is_told_the_remote(tmp_path, storage, clock):
+    probe = make_probe(tmp_path, storage)
+    log = tmp_path / "env.log"
+    probe.config['latency_probe_command'] = (
+        "sh -c 'echo \"$UNISONCTRL_REMOTE_NAME $UNISONCTRL_REMOTE_ROOT\" >> " + str(log) +
+        " && cd -- \"$UNISONCTRL_REMOTE_SSH_CONN\" && exec sh -s'"
+    )
+    running_data, remotes = make_instances(tmp_path, ["host-a", "host-b"])
+
+    probe.start(running_data)
+    probe.check(running_data, remotes)
+
+    assert sorted(log.read_text().splitlines()) == ["host-a share", "host-b share"]
+
+
+def test_canary_which_never_arrives_is_a_timeout(tmp_path, storage, clock):
+    probe = make_probe(tmp_path, storage)
+    running_data, remotes = make_instances(tmp_path, ["host-a"])
+
+    probe.start(running_data)
+    clock.now += 3600
+    probe.check(running_data, remotes)
+
+    state = storage.get_state(LatencyProbe.STATE_KEY)
+    assert state['pending'] == {}
+    assert state['results']["rule"]['timeouts'] == 1
+
+
+def test_unreachable_remote_keeps_the_probe_pending(tmp_path, storage, clock):
+    probe = make_probe(tmp_path, storage)
+    running_data, remotes = make_instances(tmp_path, ["host-a"])
+    remotes["host-a"]['ssh_conn'] = str(tmp_path / "unreachable")
+
+    probe.start(running_data)
+    clock.now += 3600
+    probe.check(running_data, remotes)
+
+    assert list(storage.get_state(LatencyProbe.STATE_KEY)['pending']) == ["rule@host-a"]
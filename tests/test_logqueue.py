@@ -0,0 +1,58 @@
+import io
+import json
+import logging
+import logging.handlers
+import queue
+
+import pytest
+
+from logformatter import JsonLinesFormatter
+from logqueue import LogQueueHandler
+
+
+@pytest.fixture
+def log_through_listener():
+    """Log like setup_logging, through the queue and its listener thread."""
+    output = io.StringIO()
+    handler = logging.StreamHandler(output)
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("test-logqueue")
+    logger.propagate = False
+    logger.addHandler(LogQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    def log(formatter, *args, **kwargs):
+        handler.setFormatter(formatter)
+        listener.start()
+        try:
+            logger.exception(*args, **kwargs)
+        finally:
+            listener.stop()
+        return output.getvalue()
+
+    yield log
+
+    logger.handlers.clear()
+
+
+def raise_and_log(log, formatter):
+    try:
+        raise ValueError("broken archive")
+    except ValueError:
+        return log(formatter, "Instance '%s' Failed.", "rule@remote", extra={'phase': "start"})
+
+
+def test_exception_is_a_json_field(log_through_listener):
+    entry = json.loads(raise_and_log(log_through_listener, JsonLinesFormatter()))
+
+    assert entry['message'] == "Instance 'rule@remote' Failed."
+    assert entry['phase'] == "start"
+    assert entry['exception'].startswith("Traceback")
+    assert "ValueError: broken archive" in entry['exception']
+
+
+def test_text_log_keeps_the_traceback(log_through_listener):
+    lines = raise_and_log(log_through_listener, logging.Formatter("%(message)s")).splitlines()
+
+    assert lines[0] == "Instance 'rule@remote' Failed."
+    assert lines[-1] == "ValueError: broken archive"
@@ -0,0 +1,50 @@
+import logging
+import os
+
+from logrotation import InstanceLogRotator
+
+
+def make_rotator(tmp_path, storage):
+    config = {
+        'unison_log_dir': str(tmp_path),
+        'instance_log_max_bytes': 1,
+        'instance_log_max_age': 0,
+        'instance_log_compress': False,
+        'instance_log_backups': 10,
+        'instance_log_retention': 0,
+    }
+    return InstanceLogRotator(config, storage, logging.getLogger("test"))
+
+
+def write_log(rotator, text):
+    with open(rotator.get_logfile("rule@remote"), "w") as f:
+        f.write(text)
+
+
+def test_rotations_in_the_same_second_keep_every_segment(tmp_path, storage, monkeypatch):
+    rotator = make_rotator(tmp_path, storage)
+    monkeypatch.setattr("logrotation.time.strftime", lambda _: "20260101-120000")
+
+    for text in ["first", "second", "third"]:
+        write_log(rotator, text)
+        assert rotator.rotate_if_needed("rule@remote") is True
+
+    segments = sorted(os.listdir(tmp_path))
+    assert segments == [
+        "rule@remote.log.20260101-120000",
+        "rule@remote.log.20260101-120000-1",
+        "rule@remote.log.20260101-120000-2",
+    ]
+    assert open(tmp_path / segments[0]).read() == "first"
+    assert open(tmp_path / segments[2]).read() == "third"
+
+
+def test_compressed_segment_is_not_reused(tmp_path, storage, monkeypatch):
+    rotator = make_rotator(tmp_path, storage)
+    monkeypatch.setattr("logrotation.time.strftime", lambda _: "20260101-120000")
+    (tmp_path / "rule@remote.log.20260101-120000.gz").write_text("")
+
+    write_log(rotator, "log")
+    rotator.rotate_if_needed("rule@remote")
+
+    assert (tmp_path / "rule@remote.log.20260101-120000-1").read_text() == "log"
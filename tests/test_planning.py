@@ -0,0 +1,80 @@
+from reconcileplan import ReconcilePlan
+
+DIRS = {'sync': ["/local/a"], 'ignore': [], 'syncname': "rule", 'remote': "remote"}
+CONTINUOUS = {'syncname': "rule", 'dir_selector': "*"}
+SCHEDULED = {'syncname': "rule", 'dir_selector': "*", 'mode': "scheduled", 'interval': 3600}
+
+
+def store_instance(handler, rule, pid=100):
+    """Store an instance as create_sync_instance does for the rule."""
+    handler.config['sync_hierarchy_rules'] = [rule]
+    components = handler.get_config_components("rule@remote", DIRS)
+    handler.data_storage.set_data("rule@remote", {
+        'syncname': "rule@remote",
+        'pid': pid,
+        'mode': rule.get('mode', "continuous"),
+        'config_hash': handler.get_config_hash(components),
+        'config_components': {k: handler.get_config_hash([(k, v)]) for k, v in components},
+    })
+
+
+def plan_instance(handler):
+    plan = ReconcilePlan()
+    plan.instances["rule@remote"] = DIRS
+    handler.plan_instance(plan, "rule@remote", DIRS)
+    return plan
+
+
+def test_unchanged_continuous_instance_is_kept(make_handler):
+    handler = make_handler([CONTINUOUS])
+    store_instance(handler, CONTINUOUS)
+
+    plan = plan_instance(handler)
+
+    assert plan.keep == ["rule@remote"]
+
+
+def test_switch_to_scheduled_stops_the_continuous_instance(make_handler):
+    handler = make_handler([CONTINUOUS])
+    store_instance(handler, CONTINUOUS)
+    handler.config['sync_hierarchy_rules'] = [SCHEDULED]
+
+    plan = plan_instance(handler)
+
+    assert plan.kill == ["rule@remote"]
+    assert plan.running_scheduled == []
+    assert handler.scheduler.get_due_instances(plan.scheduled, plan.running_scheduled) == ["rule@remote"]
+
+
+def test_running_one_shot_sync_is_left_alone(make_handler):
+    handler = make_handler([SCHEDULED])
+    store_instance(handler, SCHEDULED)
+
+    plan = plan_instance(handler)
+
+    assert plan.kill == []
+    assert plan.running_scheduled == ["rule@remote"]
+    assert handler.scheduler.get_due_instances(plan.scheduled, plan.running_scheduled) == []
+
+
+def test_switch_to_continuous_restarts_the_one_shot_sync(make_handler):
+    handler = make_handler([SCHEDULED])
+    store_instance(handler, SCHEDULED)
+    handler.config['sync_hierarchy_rules'] = [CONTINUOUS]
+
+    plan = plan_instance(handler)
+
+    assert plan.restart == {"rule@remote": ["mode"]}
+
+
+def test_interval_is_part_of_the_config(make_handler):
+    handler = make_handler([SCHEDULED])
+    store_instance(handler, SCHEDULED)
+    handler.config['sync_hierarchy_rules'] = [dict(SCHEDULED, interval=600)]
+
+    changed = handler.get_changed_config_components(
+        handler.data_storage.get_data("rule@remote"),
+        handler.get_config_components("rule@remote", DIRS)
+    )
+
+    assert changed == ["mode"]
@@ -0,0 +1,38 @@
+import os
+import subprocess
+
+import pytest
+
+IDLE = {'class': "idle", 'nice': 19, 'ionice_class': "idle", 'ionice_level': 4, 'cpu_affinity': None}
+
+
+def test_wrapper_sets_the_class_of_the_process_and_its_children(make_handler):
+    handler = make_handler([])
+    cmd = handler.get_priority_command("rule", IDLE)
+
+    # The child stands in for the ssh transport unison spawns
+    output = subprocess.run(
+        cmd + ["sh", "-c", "sh -c 'ps -o ni= -p $$'"], stdout=subprocess.PIPE, check=True
+    ).stdout
+
+    assert int(output) == 19
+
+
+def test_unavailable_cpus_are_left_out(make_handler, caplog):
+    handler = make_handler([])
+    cmd = handler.get_priority_command("rule", dict(IDLE, cpu_affinity=[max(os.sched_getaffinity(0)) + 1]))
+
+    assert "taskset" not in cmd
+    assert "cpu_affinity" in caplog.text
+
+
+def test_available_cpus_are_applied(make_handler):
+    handler = make_handler([])
+    cpu = min(os.sched_getaffinity(0))
+    cmd = handler.get_priority_command("rule", dict(IDLE, cpu_affinity=[cpu]))
+
+    if "taskset" not in cmd:
+        pytest.skip("taskset is not installed")
+
+    assert cmd[-3:] == ["taskset", "-c", str(cpu)]
+    subprocess.run(cmd + ["true"], check=True)
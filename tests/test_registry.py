@@ -0,0 +1,116 @@
+import subprocess
+import sys
+import time
+
+import psutil
+import pytest
+
+from registry import InstanceRecord, InstanceRegistry
+
+
+@pytest.fixture
+def process():
+    """Process carrying the label of instance 'docs', like unison does."""
+    proc = subprocess.Popen(
+        [sys.executable, "-c", "import time; time.sleep(60)", "-label=unisonctrl-docs"]
+    )
+    yield proc
+    proc.kill()
+    proc.wait()
+
+
+def wait_for_exec(proc):
+    """Wait until the process runs with its final command line."""
+    for _ in range(100):
+        if "-label=unisonctrl-docs" in psutil.Process(proc.pid).cmdline():
+            return psutil.Process(proc.pid).create_time()
+        time.sleep(0.01)
+
+    raise AssertionError("process did not start")
+
+
+def test_process_with_matching_identity_is_running(process):
+    create_time = wait_for_exec(process)
+
+    record = InstanceRecord("docs", {'pid': process.pid, 'create_time': create_time})
+
+    assert record.get_process().pid == process.pid
+
+
+def test_reused_pid_of_another_instance_is_not_running(process):
+    create_time = wait_for_exec(process)
+
+    record = InstanceRecord("media", {'pid': process.pid, 'create_time': create_time})
+
+    assert not record.is_running()
+
+
+def test_reused_pid_after_reboot_is_not_running(process):
+    create_time = wait_for_exec(process)
+
+    record = InstanceRecord("docs", {'pid': process.pid, 'create_time': create_time - 3600})
+
+    assert not record.is_running()
+
+
+def test_start_time_may_drift_slightly(process):
+    create_time = wait_for_exec(process)
+
+    record = InstanceRecord("docs", {'pid': process.pid, 'create_time': create_time + 0.5})
+
+    assert record.is_running()
+
+
+def test_record_without_start_time_is_identified_by_label(process):
+    wait_for_exec(process)
+
+    assert InstanceRecord("docs", {'pid': process.pid}).is_running()
+    assert not InstanceRecord("media", {'pid': process.pid}).is_running()
+
+
+def test_recorded_label_is_used(process):
+    wait_for_exec(process)
+
+    record = InstanceRecord("docs@remote", {'pid': process.pid, 'label': "unisonctrl-docs"})
+
+    assert record.is_running()
+
+
+def test_exited_process_is_not_running(process):
+    create_time = wait_for_exec(process)
+    record = InstanceRecord("docs", {'pid': process.pid, 'create_time': create_time})
+
+    # Killed, but not reaped yet
+    process.kill()
+    for _ in range(100):
+        if psutil.Process(process.pid).status() == psutil.STATUS_ZOMBIE:
+            break
+        time.sleep(0.01)
+
+    assert not record.is_running()
+
+
+def test_registry_indexes_by_name_and_pid():
+    registry = InstanceRegistry({"docs": {'pid': 100}, "media": {'pid': 101}})
+
+    assert registry.get("docs").pid == 100
+    assert registry.get_by_pid("101").name == "media"
+
+    # A restarted instance is found by its new PID only
+    registry.add("docs", {'pid': 102})
+    assert registry.get_by_pid(100) is None
+    assert registry.get_by_pid(102).name == "docs"
+
+    registry.remove("media")
+    assert registry.get("media") is None
+    assert registry.get_by_pid(101) is None
+    assert [x.name for x in registry.get_records()] == ["docs"]
+
+
+def test_removing_an_instance_keeps_the_record_reusing_its_pid():
+    registry = InstanceRegistry({"docs": {'pid': 100}})
+    registry.add("media", {'pid': 100})
+
+    registry.remove("docs")
+
+    assert registry.get_by_pid(100).name == "media"
@@ -0,0 +1,104 @@
+import logging
+
+from remotelisting import RemoteListing
+
+# Stand-in for ssh: each remote is a local directory named by its ssh_conn,
+# and the relative remote root is resolved inside it
+HOST_COMMAND = "sh -c 'cd -- \"$UNISONCTRL_REMOTE_SSH_CONN\" && exec sh -s'"
+
+
+class MemoryStorage():
+    """Controller state kept in memory, like DataStorage keeps it on disk."""
+
+    def __init__(self):
+        self.state = {}
+
+    def get_state(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set_state(self, key, data):
+        self.state[key] = data
+
+
+def make_remote(tmp_path, name, dirs):
+    host = tmp_path / name
+    for x in dirs:
+        (host / "share" / "Art Department" / x).mkdir(parents=True)
+    return {'name': name, 'ssh_conn': str(host), 'ssh_keyfile': "", 'root': "share"}
+
+
+def make_listing(tmp_path, remotes, command=HOST_COMMAND, storage=None):
+    config = {
+        'unison_local_root': "/local",
+        'unison_remotes': remotes,
+        'remote_listing_command': command,
+        'remote_listing_timeout': 30,
+    }
+    return RemoteListing(config, storage or MemoryStorage(), logging.getLogger("test"))
+
+
+def test_each_remote_is_listed_by_its_own_host(tmp_path):
+    remotes = [
+        make_remote(tmp_path, "host-a", ["110", "111"]),
+        make_remote(tmp_path, "host-b", ["112", "M01"]),
+    ]
+    listing = make_listing(tmp_path, remotes)
+
+    listing.refresh(["Art Department/11*", "Art Department/M0*"])
+
+    assert listing.get_dirs("Art Department/11*") == [
+        "/local/Art Department/110", "/local/Art Department/111", "/local/Art Department/112",
+    ]
+    assert listing.get_dirs("Art Department/M0*") == ["/local/Art Department/M01"]
+
+
+def test_command_is_told_the_remote(tmp_path):
+    remotes = [make_remote(tmp_path, "host-a", ["110"])]
+    log = tmp_path / "env.log"
+    command = (
+        "sh -c 'echo \"$UNISONCTRL_REMOTE_NAME $UNISONCTRL_REMOTE_ROOT\" > " + str(log) +
+        " && cd -- \"$UNISONCTRL_REMOTE_SSH_CONN\" && exec sh -s'"
+    )
+    listing = make_listing(tmp_path, remotes, command)
+
+    listing.refresh(["Art Department/11*"])
+
+    assert log.read_text() == "host-a share\n"
+
+
+def test_new_remote_directory_is_seen_on_the_next_refresh(tmp_path):
+    remotes = [make_remote(tmp_path, "host-a", ["110"])]
+    storage = MemoryStorage()
+    make_listing(tmp_path, remotes, storage=storage).refresh(["Art Department/11*"])
+
+    (tmp_path / "host-a" / "share" / "Art Department" / "111").mkdir()
+    listing = make_listing(tmp_path, remotes, storage=storage)
+    listing.refresh(["Art Department/11*"])
+
+    assert listing.get_dirs("Art Department/11*") == [
+        "/local/Art Department/110", "/local/Art Department/111",
+    ]
+
+
+def test_unreachable_remote_keeps_its_cached_listing(tmp_path):
+    remotes = [make_remote(tmp_path, "host-a", ["110"])]
+    storage = MemoryStorage()
+    make_listing(tmp_path, remotes, storage=storage).refresh(["Art Department/11*"])
+
+    remotes[0]['ssh_conn'] = str(tmp_path / "unreachable")
+    listing = make_listing(tmp_path, remotes, storage=storage)
+    listing.refresh(["Art Department/11*"])
+
+    assert listing.get_dirs("Art Department/11*") == ["/local/Art Department/110"]
+
+
+def test_removed_remote_is_forgotten(tmp_path):
+    remotes = [make_remote(tmp_path, "host-a", ["110"]), make_remote(tmp_path, "host-b", ["111"])]
+    storage = MemoryStorage()
+    make_listing(tmp_path, remotes, storage=storage).refresh(["Art Department/11*"])
+
+    listing = make_listing(tmp_path, remotes[:1], storage=storage)
+    listing.refresh(["Art Department/11*"])
+
+    assert listing.get_dirs("Art Department/11*") == ["/local/Art Department/110"]
+    assert set(storage.get_state(RemoteListing.STATE_KEY)) == {"host-a"}
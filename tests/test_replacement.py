@@ -0,0 +1,108 @@
+import logging
+import time
+
+import pytest
+
+from reconcileplan import ReconcilePlan
+from transfers import TransferMonitor
+
+
+@pytest.fixture
+def handler(make_handler, tmp_path):
+    """Handler whose kills are recorded instead of sent."""
+    handler = make_handler([], unison_log_dir=str(tmp_path), transfer_active_bytes_per_second=1000)
+    handler.transfers = TransferMonitor(handler.config, handler.data_storage, logging.getLogger("test"))
+    handler.killed = []
+    handler.kill_sync_instance_by_pid = handler.killed.append
+    return handler
+
+
+def run_instance(handler, name, dirs, pid, start_time=0):
+    handler.data_storage.set_data(name, {
+        'syncname': name, 'pid': pid, 'start_time': start_time, 'dirs_to_sync': dirs,
+    })
+
+
+def make_plan(handler, instances):
+    plan = ReconcilePlan()
+    plan.instances = {
+        name: {'sync': ["/local/" + x for x in dirs], 'ignore': []} for name, dirs in instances.items()
+    }
+    plan.start = [x for x in plan.instances if x not in handler.data_storage.running_data]
+    plan.kill = [x for x in handler.data_storage.running_data if x not in plan.instances]
+    return plan
+
+
+def test_merged_rules_are_one_group(handler):
+    run_instance(handler, "docs", ["docs"], 100)
+    run_instance(handler, "media", ["media"], 101)
+    run_instance(handler, "old", ["old"], 102)
+
+    plan = make_plan(handler, {"shared": ["docs", "media"]})
+
+    assert handler.get_replacement_groups(plan) == [
+        ({"shared"}, {"docs", "media"}),
+        (set(), {"old"}),
+    ]
+
+
+def test_split_rule_is_one_group(handler):
+    run_instance(handler, "shared", ["docs", "media"], 100)
+
+    plan = make_plan(handler, {"docs": ["docs"], "media": ["media"]})
+
+    assert handler.get_replacement_groups(plan) == [({"docs", "media"}, {"shared"})]
+
+
+def test_replacement_waits_for_the_restart_policy(handler):
+    handler.config['restart_debounce'] = 120
+    run_instance(handler, "docs", ["docs"], 100)
+    run_instance(handler, "media", ["media"], 101)
+
+    plan = make_plan(handler, {"shared": ["docs", "media"]})
+    deferred_dirs, replacing = handler.kill_unneeded_instances(plan)
+
+    assert deferred_dirs == {"/local/docs", "/local/media"}
+    assert replacing == set()
+    assert handler.killed == []
+
+
+def test_group_is_replaced_together_or_not_at_all(handler):
+    handler.config['instance_restart_min_interval'] = 600
+    run_instance(handler, "docs", ["docs"], 100)
+    run_instance(handler, "media", ["media"], 101, start_time=time.time())
+
+    # media started too recently, so docs keeps running as well
+    plan = make_plan(handler, {"shared": ["docs", "media"]})
+    deferred_dirs, replacing = handler.kill_unneeded_instances(plan)
+
+    assert deferred_dirs == {"/local/docs", "/local/media"}
+    assert handler.killed == []
+
+
+def test_allowed_replacement_stops_the_whole_group(handler):
+    run_instance(handler, "docs", ["docs"], 100)
+    run_instance(handler, "media", ["media"], 101)
+    run_instance(handler, "old", ["old"], 102)
+
+    plan = make_plan(handler, {"shared": ["docs", "media"]})
+    deferred_dirs, replacing = handler.kill_unneeded_instances(plan)
+
+    assert deferred_dirs == set()
+    assert replacing == {"shared"}
+    assert sorted(handler.killed) == [100, 101, 102]
+    assert handler.data_storage.running_data == {}
+
+
+def test_replacements_respect_the_start_cap(handler):
+    handler.config['max_instance_starts_per_run'] = 1
+    run_instance(handler, "docs-old", ["docs"], 100)
+    run_instance(handler, "media-old", ["media"], 101)
+
+    plan = make_plan(handler, {"docs": ["docs"], "media": ["media"]})
+    deferred_dirs, replacing = handler.kill_unneeded_instances(plan)
+
+    # The first replacement of a run is always allowed
+    assert replacing == {"docs"}
+    assert deferred_dirs == {"/local/media"}
+    assert handler.killed == [100]
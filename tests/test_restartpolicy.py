@@ -0,0 +1,207 @@
+import logging
+
+import pytest
+
+import restartpolicy
+from restartpolicy import RestartPolicy
+
+INSTANCE = {'pid': 100, 'start_time': 0}
+
+
+class Clock():
+    """Clock of the restart policy, advanced by the tests."""
+
+    def __init__(self):
+        self.now = 100000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(restartpolicy.time, "time", clock)
+    return clock
+
+
+def make_policy(storage, **config):
+    config = dict({
+        'restart_debounce': 120,
+        'restart_debounce_max': 900,
+        'restart_max_defer': 3600,
+        'instance_restart_min_interval': 0,
+        'global_restart_limit': 2,
+        'global_restart_window': 300,
+        'urgent_restart_components': ["remote"],
+        'crash_fast_failure_time': 300,
+        'crash_backoff_base': 60,
+        'crash_backoff_max': 600,
+        'crash_backoff_jitter': 0,
+        'crash_quarantine_after': 5,
+        'crash_quarantine_time': 86400,
+    }, **config)
+    return RestartPolicy(config, storage, logging.getLogger("test"))
+
+
+def test_change_waits_for_the_debounce(storage, clock):
+    policy = make_policy(storage)
+
+    assert not policy.check_restart("a", "hash-1", INSTANCE, None)
+
+    clock.now += 119
+    assert not policy.check_restart("a", "hash-1", INSTANCE, None)
+
+    clock.now += 1
+    assert policy.check_restart("a", "hash-1", INSTANCE, None)
+
+
+def test_further_changes_restart_the_debounce(storage, clock):
+    policy = make_policy(storage)
+    policy.check_restart("a", "hash-1", INSTANCE, None)
+
+    clock.now += 100
+    assert not policy.check_restart("a", "hash-2", INSTANCE, None)
+
+    clock.now += 100
+    assert not policy.check_restart("a", "hash-2", INSTANCE, None)
+
+    clock.now += 20
+    assert policy.check_restart("a", "hash-2", INSTANCE, None)
+
+
+def test_debounce_max_ends_a_burst_of_changes(storage, clock):
+    policy = make_policy(storage)
+
+    for i in range(9):
+        assert not policy.check_restart("a", "hash-" + str(i), INSTANCE, None)
+        clock.now += 100
+
+    assert policy.check_restart("a", "hash-9", INSTANCE, None)
+
+
+def test_rule_overrides_the_debounce(storage, clock):
+    policy = make_policy(storage)
+
+    assert policy.check_restart("a", "hash-1", INSTANCE, {'restart_debounce': 0})
+
+
+def test_global_budget_limits_restarts(storage, clock):
+    policy = make_policy(storage, restart_debounce=0)
+
+    for name in ["a", "b"]:
+        assert policy.check_restart(name, "hash-1", INSTANCE, None)
+        policy.record_restart(name, "changed: dirs")
+
+    assert not policy.check_restart("c", "hash-1", INSTANCE, None)
+
+    # The budget frees up once the restarts leave the window
+    clock.now += 301
+    assert policy.check_restart("c", "hash-1", INSTANCE, None)
+
+
+def test_recently_started_instance_is_not_restarted(storage, clock):
+    policy = make_policy(storage, restart_debounce=0, instance_restart_min_interval=600)
+
+    assert not policy.check_restart("a", "hash-1", {'pid': 100, 'start_time': clock.now - 60}, None)
+    assert policy.check_restart("a", "hash-1", {'pid': 100, 'start_time': clock.now - 600}, None)
+
+
+def test_cleared_change_does_not_look_overdue_later(storage, clock):
+    policy = make_policy(storage)
+    policy.check_restart("a", "hash-1", INSTANCE, None)
+
+    # The instance dies, and a new change arrives long after
+    policy.clear_pending("a")
+    clock.now += 1000
+
+    assert not policy.check_restart("a", "hash-2", INSTANCE, None)
+
+
+def test_pending_changes_of_removed_instances_are_pruned(storage, clock):
+    policy = make_policy(storage)
+    policy.check_restart("a", "hash-1", INSTANCE, None)
+    policy.check_restart("b", "hash-1", INSTANCE, None)
+
+    policy.prune_failures({"a"})
+
+    assert set(policy.get_policy_state()['pending']) == {"a"}
+
+
+def crash(policy, clock, uptime=10):
+    """Start the instance now, and record its exit after the uptime."""
+    instance_info = {'syncname': "a", 'pid': 100, 'start_time': clock.now}
+    clock.now += uptime
+    policy.record_exit(instance_info)
+
+
+def test_fast_failures_back_off_exponentially(storage, clock):
+    policy = make_policy(storage)
+
+    for backoff in [60, 120, 240]:
+        crash(policy, clock)
+
+        clock.now += backoff - 1
+        assert not policy.check_start("a")
+
+        clock.now += 1
+        assert policy.check_start("a")
+
+
+def test_backoff_is_capped(storage, clock):
+    policy = make_policy(storage, crash_quarantine_after=10)
+
+    for _ in range(6):
+        crash(policy, clock)
+
+    assert policy.get_policy_state()['failures']["a"]['next_attempt'] == clock.now + 600
+
+
+def test_jitter_only_lengthens_the_backoff(storage, clock):
+    policy = make_policy(storage, crash_backoff_jitter=0.5)
+    crash(policy, clock)
+
+    backoff = policy.get_policy_state()['failures']["a"]['next_attempt'] - clock.now
+    assert 60 <= backoff <= 90
+
+
+def test_repeated_failures_are_quarantined(storage, clock):
+    policy = make_policy(storage)
+
+    for _ in range(5):
+        clock.now += 600
+        crash(policy, clock)
+
+    failure = policy.get_policy_state()['failures']["a"]
+    assert failure['quarantined'] is True
+
+    clock.now += 86399
+    assert not policy.check_start("a")
+
+    clock.now += 1
+    assert policy.check_start("a")
+
+
+def test_slow_exit_resets_the_failures(storage, clock):
+    policy = make_policy(storage)
+    crash(policy, clock)
+    clock.now += 60
+
+    crash(policy, clock, uptime=300)
+
+    assert "a" not in policy.get_policy_state()['failures']
+    assert policy.check_start("a")
+
+
+def test_healthy_instance_resets_the_failures(storage, clock):
+    policy = make_policy(storage)
+    crash(policy, clock)
+    clock.now += 60
+
+    instance_info = {'syncname': "a", 'pid': 101, 'start_time': clock.now}
+    policy.record_healthy("a", instance_info)
+    assert "a" in policy.get_policy_state()['failures']
+
+    clock.now += 300
+    policy.record_healthy("a", instance_info)
+    assert "a" not in policy.get_policy_state()['failures']
@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+
+import pytest
+
+from unisonhandler import UnisonHandler
+
+DIRS = {
+    'running_data_dir': "/var/lib/unisonctrl/running",
+    'state_data_dir': "/var/lib/unisonctrl/state",
+    'unison_log_dir': "/var/log/unison",
+    'unison_archive_dir': "/var/lib/unison-instances",
+    'unison_remote_archive_dir': "",
+    'shard_state_dir': "",
+    'bandwidth_rate_dir': "/run/unisonctrl/rates",
+}
+
+
+def make_top(root_handlers, max_parallel_roots=0):
+    handler = UnisonHandler.__new__(UnisonHandler)
+    handler.config = {'max_parallel_roots': max_parallel_roots, 'bandwidth_limit': 0}
+    handler.root_handlers = root_handlers
+    return handler
+
+
+def get_root_config(config, root):
+    handler = UnisonHandler.__new__(UnisonHandler)
+    handler.validate_sync_config = lambda: True
+    return handler.get_root_config(config, root)
+
+
+class FakeRoot():
+    """Sync root handler which records how its reconcile ran."""
+
+    def __init__(self, started=None, fail=False):
+        self.logger = logging.getLogger("test")
+        self.started = started
+        self.fail = fail
+        self.thread = None
+
+    def create_all_sync_instances(self):
+        self.thread = threading.current_thread()
+
+        # Waits for the other roots, so this only returns if they run together
+        if self.started is not None:
+            self.started.wait(timeout=5)
+
+        if self.fail:
+            raise RuntimeError("scan failed")
+
+
+def test_root_settings_override_the_top_level():
+    config = dict(DIRS, unison_local_root="/srv/share/", sync_hierarchy_rules=[])
+    rules = [{'syncname': "docs", 'dir_selector': "*"}]
+
+    root_config = get_root_config(config, {'name': "media", 'unison_local_root': "/srv/media/", 'sync_hierarchy_rules': rules})
+
+    assert root_config['unison_local_root'] == "/srv/media"
+    assert root_config['sync_hierarchy_rules'] == rules
+    assert config['unison_local_root'] == "/srv/share/"
+
+
+def test_root_directories_are_namespaced():
+    config = dict(DIRS, unison_local_root="/srv/share", sync_hierarchy_rules=[])
+
+    media = get_root_config(config, {'name': "media"})
+    docs = get_root_config(config, {'name': "docs"})
+
+    for key, value in DIRS.items():
+        if value == "":
+            assert media[key] == ""
+        else:
+            assert media[key] == value + os.sep + "media"
+            assert docs[key] == value + os.sep + "docs"
+
+
+def test_unknown_root_setting_is_rejected():
+    config = dict(DIRS, unison_local_root="/srv/share", sync_hierarchy_rules=[])
+
+    with pytest.raises(LookupError):
+        get_root_config(config, {'name': "media", 'max_parallel_roots': 2})
+
+
+def test_roots_are_reconciled_in_parallel():
+    started = threading.Barrier(3)
+    roots = [FakeRoot(started) for _ in range(3)]
+
+    make_top(roots).run()
+
+    assert not started.broken
+    assert len({x.thread for x in roots}) == 3
+
+
+def test_max_parallel_roots_limits_the_workers():
+    roots = [FakeRoot() for _ in range(3)]
+
+    make_top(roots, max_parallel_roots=1).run()
+
+    assert len({x.thread for x in roots}) == 1
+
+
+def test_failing_root_does_not_stop_the_others():
+    roots = [FakeRoot(fail=True), FakeRoot()]
+
+    make_top(roots).run()
+
+    assert roots[1].thread is not None
@@ -0,0 +1,227 @@
+import logging
+import os
+
+import pytest
+
+import sharding
+from reconcileplan import ReconcilePlan
+from sharding import ShardCoordinator
+
+RULES = ["rule-a", "rule-b", "rule-c", "rule-d"]
+TTL = 60
+
+
+class Clock():
+    """Shared clock of all hosts, advanced by the tests."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sharding.time, "time", clock)
+    return clock
+
+
+def make_host(shared_dir, name):
+    config = {
+        'shard_node_name': name,
+        'shard_state_dir': str(shared_dir),
+        'shard_lease_ttl': TTL,
+        'shard_rebalance_slack': 0.25,
+    }
+    return ShardCoordinator(config, logging.getLogger("test"))
+
+
+def test_single_host_claims_every_rule(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+
+    assert host_a.get_owned_rules(RULES, {}) == set(RULES)
+    assert host_a.get_held_rules(RULES) == set(RULES)
+
+
+def test_unexpired_lease_is_not_taken(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+    host_b = make_host(tmp_path, "b")
+
+    host_a.get_owned_rules(RULES, {})
+
+    # b is assigned half of the rules, but a still holds their leases
+    clock.now += 10
+    assert host_b.get_owned_rules(RULES, {}) == set()
+
+
+def test_expired_lease_is_taken_over(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+    host_b = make_host(tmp_path, "b")
+
+    host_a.get_owned_rules(RULES, {})
+
+    # a stops renewing, so its heartbeat and leases expire
+    clock.now += TTL + 1
+    assert host_b.get_owned_rules(RULES, {}) == set(RULES)
+    assert host_a.get_held_rules(RULES) == set()
+
+
+def test_rules_rebalance_when_a_host_joins(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+    host_b = make_host(tmp_path, "b")
+
+    host_a.get_owned_rules(RULES, {})
+
+    # b joins, then a releases the rules assigned to b, which b claims
+    clock.now += 10
+    host_b.get_owned_rules(RULES, {})
+    clock.now += 10
+    owned_a = host_a.get_owned_rules(RULES, {})
+    for syncname in list(host_a.releasing):
+        host_a.release(syncname)
+    clock.now += 10
+    owned_b = host_b.get_owned_rules(RULES, {})
+
+    assert len(owned_a) == 2
+    assert len(owned_b) == 2
+    assert owned_a.isdisjoint(owned_b)
+    assert owned_a | owned_b == set(RULES)
+
+
+def test_rules_move_when_a_host_leaves(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+    host_b = make_host(tmp_path, "b")
+
+    host_a.get_owned_rules(RULES, {})
+    clock.now += 10
+    host_b.get_owned_rules(RULES, {})
+    clock.now += 10
+    host_a.get_owned_rules(RULES, {})
+    for syncname in list(host_a.releasing):
+        host_a.release(syncname)
+    clock.now += 10
+    assert len(host_b.get_owned_rules(RULES, {})) == 2
+
+    # b goes down. Its leases are taken over once they expire.
+    clock.now += 10
+    assert len(host_a.get_owned_rules(RULES, {})) == 2
+
+    clock.now += TTL
+    assert host_a.get_owned_rules(RULES, {}) == set(RULES)
+
+
+def test_assignment_balances_measured_cost(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+    leases = {
+        "rule-a": {'node': "a", 'expires': 2000, 'cost': 3.0},
+        "rule-b": {'node': "a", 'expires': 2000, 'cost': 1.0},
+        "rule-c": {'node': "a", 'expires': 2000, 'cost': 1.0},
+        "rule-d": {'node': "a", 'expires': 2000, 'cost': 1.0},
+    }
+
+    assignment = host_a.get_assignment(RULES, leases, ["a", "b"])
+
+    # The expensive rule alone weighs as much as the three others
+    assert [x for x in RULES if assignment[x] == assignment["rule-a"]] == ["rule-a"]
+
+
+def test_locked_lease_is_not_claimed(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+
+    # Another host is claiming the rule right now
+    lock_file = host_a.get_lease_file("rule-a") + ".lock"
+    os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+
+    assert host_a.claim("rule-a", None, None) is False
+    assert os.path.exists(lock_file)
+
+
+def test_stale_lock_is_broken(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+
+    # A host crashed while claiming the rule
+    lock_file = host_a.get_lease_file("rule-a") + ".lock"
+    os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    os.utime(lock_file, (clock.now - TTL - 1, clock.now - TTL - 1))
+
+    assert host_a.claim("rule-a", None, None) is True
+    assert not os.path.exists(lock_file)
+    assert os.listdir(os.path.dirname(lock_file)) == ["rule-a.json"]
+
+
+def test_fresh_lock_replacing_a_stale_one_is_kept(tmp_path, clock, monkeypatch):
+    host_a = make_host(tmp_path, "a")
+    lock_file = host_a.get_lease_file("rule-a") + ".lock"
+    os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    os.utime(lock_file, (clock.now - TTL - 1, clock.now - TTL - 1))
+
+    # Another host breaks the stale lock and takes a fresh one, right after
+    # this host found the lock stale
+    stat = os.stat
+
+    def stat_then_replace(path):
+        result = stat(path)
+        if path == lock_file:
+            monkeypatch.setattr(sharding.os, "stat", stat)
+            os.remove(lock_file)
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return result
+
+    monkeypatch.setattr(sharding.os, "stat", stat_then_replace)
+
+    assert host_a.claim("rule-a", None, None) is False
+    assert os.path.exists(lock_file)
+    assert os.listdir(os.path.dirname(lock_file)) == ["rule-a.json.lock"]
+
+
+def test_moved_rule_is_released_with_its_cost(tmp_path, clock):
+    host_a = make_host(tmp_path, "a")
+    host_b = make_host(tmp_path, "b")
+    costs = {x: 2.0 for x in RULES}
+
+    host_a.get_owned_rules(RULES, costs)
+    clock.now += 10
+    host_b.get_owned_rules(RULES, {})
+    clock.now += 10
+
+    # a keeps the leases of the rules assigned to b, until it stopped them
+    owned_a = host_a.get_owned_rules(RULES, costs)
+    moved = set(host_a.releasing)
+    assert len(moved) == 2
+    assert moved.isdisjoint(owned_a)
+
+    clock.now += 10
+    assert host_b.get_owned_rules(RULES, {}) == set()
+    assert host_a.get_held_rules(RULES) == set(RULES)
+
+    for syncname in moved:
+        assert host_a.release(syncname) is True
+
+    for syncname in moved:
+        lease = host_a.read_json(host_a.get_lease_file(syncname))
+        assert lease['node'] is None
+        assert lease['cost'] == 2.0
+
+    clock.now += 10
+    assert host_b.get_owned_rules(RULES, {}) == moved
+
+
+def test_lease_is_released_after_the_instance_stopped(tmp_path, clock, make_handler):
+    handler = make_handler([{'syncname': "rule-a", 'dir_selector': "*"}])
+    handler.shards = make_host(tmp_path, "a")
+    handler.shards.get_owned_rules(["rule-a"], {})
+    handler.shards.releasing = {"rule-a"}
+    handler.data_storage.set_data("rule-a@remote", {'syncname': "rule-a@remote", 'dirs_to_sync': ["a"]})
+
+    plan = ReconcilePlan()
+    plan.released = {"rule-a": ["/local/a"]}
+
+    # The instance is still stopping, so the lease is kept
+    handler.release_moved_rules(plan)
+    assert handler.shards.get_held_rules(["rule-a"]) == {"rule-a"}
+
+    handler.data_storage.remove_data("rule-a@remote")
+    handler.release_moved_rules(plan)
+    assert handler.shards.get_held_rules(["rule-a"]) == set()
@@ -0,0 +1,96 @@
+import pytest
+
+
+@pytest.fixture
+def handler(make_handler, tmp_path):
+    """Handler with a local root of orders O01 to O09, and a shared dir."""
+    for name in ["O0" + str(x) for x in range(1, 10)] + ["shared"]:
+        (tmp_path / name).mkdir()
+
+    return make_handler([], unison_local_root=str(tmp_path))
+
+
+def get_dirs(handler, tmp_path, rules):
+    dirs_to_sync = handler.get_dirs_to_sync(handler.expand_rule_templates(rules))
+
+    return {
+        syncname: [x[len(str(tmp_path)) + 1:] for x in dirs['sync']]
+        for syncname, dirs in dirs_to_sync.items()
+    }
+
+
+def test_tiers_expand_into_batch_rules(handler):
+    rules = handler.expand_rule_templates([
+        {'syncname': "first", 'dir_selector': "shared"},
+        {'syncname': "orders", 'dir_selector': "O*", 'sort_method': "name_lowfirst", 'tiers': [
+            {'sort_count': 2, 'priority': "high"},
+            3,
+        ]},
+    ])
+
+    assert [x['syncname'] for x in rules] == ["first", "orders-batch-1", "orders-batch-2"]
+    assert rules[1] == {
+        'syncname': "orders-batch-1", 'dir_selector': "O*", 'sort_method': "name_lowfirst",
+        'sort_count': 2, 'priority': "high", 'tier_of': "orders",
+    }
+    assert rules[2]['sort_count'] == 3
+    assert 'priority' not in rules[2]
+
+
+@pytest.mark.parametrize("rule", [
+    {'syncname': "orders", 'dir_selector': "O*", 'tiers': []},
+    {'syncname': "orders", 'dir_selector': "O*", 'tiers': [2], 'sort_count': 2},
+    {'syncname': "orders", 'dir_selector': "O*", 'tiers': [2], 'overlap': True},
+    {'syncname': "orders", 'dir_selector': "O*", 'tiers': [0]},
+    {'syncname': "orders", 'dir_selector': "O*", 'tiers': [True]},
+    {'syncname': "orders", 'dir_selector': "O*", 'tiers': [{'sort_count': 2, 'dir_selector': "X*"}]},
+])
+def test_invalid_templates_are_rejected(handler, rule):
+    with pytest.raises(LookupError):
+        handler.expand_rule_templates([rule])
+
+
+def test_tiers_take_consecutive_slices(handler, tmp_path):
+    dirs = get_dirs(handler, tmp_path, [
+        {'syncname': "orders", 'dir_selector': "O*", 'tiers': [2, 3]},
+        {'syncname': "rest", 'dir_selector': "O*"},
+    ])
+
+    assert dirs == {
+        "orders-batch-1": ["O09", "O08"],
+        "orders-batch-2": ["O07", "O06", "O05"],
+        "rest": ["O04", "O03", "O02", "O01"],
+    }
+
+
+def test_chain_skips_directories_of_earlier_rules(handler, tmp_path):
+    dirs = get_dirs(handler, tmp_path, [
+        {'syncname': "hot", 'dir_selector': "O0[89]"},
+        {'syncname': "orders", 'dir_selector': "O*", 'sort_method': "name_lowfirst", 'tiers': [4, 4]},
+    ])
+
+    assert dirs == {
+        "hot": ["O09", "O08"],
+        "orders-batch-1": ["O01", "O02", "O03", "O04"],
+        "orders-batch-2": ["O05", "O06", "O07"],
+    }
+
+
+def test_empty_tiers_get_no_instance(handler, tmp_path):
+    dirs = get_dirs(handler, tmp_path, [
+        {'syncname': "orders", 'dir_selector': "O*", 'tiers': [5, 5, 5]},
+    ])
+
+    assert list(dirs) == ["orders-batch-1", "orders-batch-2"]
+    assert len(dirs["orders-batch-2"]) == 4
+
+
+def test_overlapping_rule_sees_every_directory(handler, tmp_path):
+    dirs = get_dirs(handler, tmp_path, [
+        {'syncname': "orders", 'dir_selector': "O*", 'tiers': [9]},
+        {'syncname': "backup", 'dir_selector': "O0[12]", 'overlap': True},
+        {'syncname': "rest", 'dir_selector': "*"},
+    ])
+
+    assert dirs["backup"] == ["O02", "O01"]
+    assert dirs["rest"] == ["shared"]
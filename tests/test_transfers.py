@@ -0,0 +1,102 @@
+import logging
+
+import pytest
+
+import restartpolicy
+import transfers
+from restartpolicy import RestartPolicy
+from transfers import TransferMonitor
+
+INSTANCE = {'syncname': "rule@remote", 'pid': 100, 'start_time': 0}
+
+
+class Clock():
+    """Clock of the transfer monitor and restart policy, advanced by the tests."""
+
+    def __init__(self):
+        self.now = 100000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(transfers.time, "time", clock)
+    monkeypatch.setattr(restartpolicy.time, "time", clock)
+    return clock
+
+
+def make_monitor(tmp_path, storage):
+    config = {'unison_log_dir': str(tmp_path), 'transfer_active_bytes_per_second': 1000}
+    return TransferMonitor(config, storage, logging.getLogger("test"))
+
+
+def make_policy(storage):
+    config = {
+        'restart_debounce': 0,
+        'restart_debounce_max': 900,
+        'restart_max_defer': 3600,
+        'instance_restart_min_interval': 0,
+        'global_restart_limit': 10,
+        'global_restart_window': 300,
+        'urgent_restart_components': ["remote"],
+    }
+    return RestartPolicy(config, storage, logging.getLogger("test"))
+
+
+@pytest.mark.parametrize("log, transferring", [
+    ("[BGN] Copying docs/big.iso from local to remote\n", True),
+    ("[BGN] Copying docs/big.iso from local to remote\n[END] Copying docs/big.iso\n", False),
+    ("Synchronization complete\n", False),
+])
+def test_log_tail_shows_unfinished_copies(tmp_path, storage, log, transferring):
+    monitor = make_monitor(tmp_path, storage)
+    (tmp_path / "rule@remote.log").write_text(log)
+
+    assert monitor.is_transferring("rule@remote", INSTANCE) is transferring
+
+
+def test_io_rate_is_sampled_between_runs(tmp_path, storage, clock, monkeypatch):
+    monitor = make_monitor(tmp_path, storage)
+    io_bytes = {100: 0}
+    monkeypatch.setattr(monitor, "get_io_bytes", lambda pid: io_bytes[pid])
+
+    monitor.sample({"rule@remote": INSTANCE})
+    assert not monitor.is_transferring("rule@remote", INSTANCE)
+
+    clock.now += 60
+    io_bytes[100] = 60 * 5000
+    monitor.sample({"rule@remote": INSTANCE})
+    assert monitor.is_transferring("rule@remote", INSTANCE)
+
+    # The sample of an earlier process does not apply to a restarted one
+    assert not monitor.is_transferring("rule@remote", dict(INSTANCE, pid=200))
+
+
+def test_restart_waits_for_the_transfer(storage, clock):
+    policy = make_policy(storage)
+
+    assert not policy.check_restart("a", "hash-1", INSTANCE, None, ["dirs"], transferring=True)
+
+    clock.now += 600
+    assert policy.check_restart("a", "hash-1", INSTANCE, None, ["dirs"], transferring=False)
+
+
+def test_restart_is_deferred_at_most_restart_max_defer(storage, clock):
+    policy = make_policy(storage)
+
+    assert not policy.check_restart("a", "hash-1", INSTANCE, None, ["dirs"], transferring=True)
+
+    clock.now += 3599
+    assert not policy.check_restart("a", "hash-1", INSTANCE, None, ["dirs"], transferring=True)
+
+    clock.now += 1
+    assert policy.check_restart("a", "hash-1", INSTANCE, None, ["dirs"], transferring=True)
+
+
+def test_urgent_change_interrupts_the_transfer(storage, clock):
+    policy = make_policy(storage)
+
+    assert policy.check_restart("a", "hash-1", INSTANCE, None, ["remote"], transferring=True)
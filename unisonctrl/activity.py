@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# This script tracks how recently the directories in the local root changed,
+# so rules can sync the most active directories in their own instances
+
+import os
+import random
+import time
+
+
+class ActivityIndex():
+    """ActivityIndex - rank directories by their recent modification activity.
+
+    Each directory has a score, which grows whenever a newer modification
+    time is found inside it, and halves every 'activity_half_life' seconds.
+    Directories are sampled with a shallow scandir of at most
+    'activity_sample_entries' entries per level, down to
+    'activity_sample_depth' levels, at most once per
+    'activity_sample_interval'. Scores are kept in the controller state, so
+    they build up across runs.
+    """
+
+    # Key used to persist the scores in the data storage backend
+    STATE_KEY = "activity"
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger, read_only=False):
+        """Load the activity index.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist the scores
+        3) logging.Logger
+            logger to report sampling to
+        4) bool
+            if True, samples are not saved
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+        self.read_only = read_only
+        self.index = dict(data_storage.get_state(self.STATE_KEY, {}))
+        self.seen = set()
+        self.samples_left = config['activity_max_samples_per_run']
+
+    def get_decay(self, age):
+        """Return the factor a score decays by over some time.
+
+        Parameters
+        ----------
+        float
+            seconds passed
+
+        Returns
+        -------
+        float
+            factor between 0 and 1
+
+        Throws
+        -------
+        none
+
+        """
+        return 0.5 ** (max(age, 0) / self.config['activity_half_life'])
+
+    def get_newest_mtime(self, path, depth):
+        """Return the newest modification time found in a sample of a directory.
+
+        Parameters
+        ----------
+        1) str
+            path of the directory
+        2) int
+            levels of subdirectories to descend into
+
+        Returns
+        -------
+        float
+            newest modification time, or 0 if the directory is gone
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            newest = os.stat(path).st_mtime
+            entries = list(os.scandir(path))
+        except OSError:
+            return 0
+
+        # Large directories are sampled, since listing is cheap but a stat
+        # per entry is not
+        if len(entries) > self.config['activity_sample_entries']:
+            entries = random.sample(entries, self.config['activity_sample_entries'])
+
+        for entry in entries:
+            try:
+                newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+
+                if depth > 1 and entry.is_dir(follow_symlinks=False):
+                    newest = max(newest, self.get_newest_mtime(entry.path, depth - 1))
+
+            except OSError:
+                continue
+
+        return newest
+
+    def sample(self, path, now):
+        """Sample a directory, and update its score.
+
+        Parameters
+        ----------
+        1) str
+            path of the directory
+        2) float
+            current time
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        newest = self.get_newest_mtime(path, self.config['activity_sample_depth'])
+        entry = self.index.get(path)
+
+        if entry is None:
+            # A new directory starts with the score of its latest change
+            score = self.get_decay(now - newest)
+
+        else:
+            score = entry['score'] * self.get_decay(now - entry['time'])
+
+            if newest > entry['mtime']:
+                score += self.get_decay(now - newest)
+
+            newest = max(newest, entry['mtime'])
+
+        self.index[path] = {'score': round(score, 6), 'time': now, 'mtime': newest}
+
+    def get_score(self, path, now):
+        """Return the current score of a directory.
+
+        Parameters
+        ----------
+        1) str
+            path of the directory
+        2) float
+            current time
+
+        Returns
+        -------
+        float
+            decayed score, 0 for directories not sampled yet
+
+        Throws
+        -------
+        none
+
+        """
+        entry = self.index.get(path)
+
+        if entry is None:
+            return 0
+
+        return entry['score'] * self.get_decay(now - entry['time'])
+
+    def sort_by_activity(self, dirs):
+        """Sort directories by activity, most active first.
+
+        Directories not sampled for 'activity_sample_interval' seconds are
+        sampled first, stalest first, up to 'activity_max_samples_per_run'.
+
+        Parameters
+        ----------
+        list[str]
+            paths of the directories
+
+        Returns
+        -------
+        list[str]
+            the directories, most active first, ties by name, highest first
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        self.seen.update(dirs)
+
+        stale = [
+            x for x in dirs
+            if now - self.index.get(x, {}).get('time', 0) >= self.config['activity_sample_interval']
+        ]
+        stale.sort(key=lambda x: self.index.get(x, {}).get('time', 0))
+
+        sampled = stale[:max(self.samples_left, 0)]
+
+        for path in sampled:
+            self.sample(path, now)
+
+        self.samples_left -= len(sampled)
+
+        if len(stale) > 0:
+            self.logger.debug(
+                "Sampled activity of %s of %s stale directories.", len(sampled), len(stale)
+            )
+
+        return sorted(dirs, key=lambda x: (self.get_score(x, now), x), reverse=True)
+
+    def save(self):
+        """Store the scores of the directories seen in this run.
+
+        Directories which were not seen, because they were removed or taken
+        by another rule, are forgotten.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        if self.read_only:
+            return
+
+        index = {k: v for k, v in self.index.items() if k in self.seen}
+
+        if index != self.data_storage.get_state(self.STATE_KEY, {}):
+            self.data_storage.set_state(self.STATE_KEY, index)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# This script decides if the host has capacity for another unison instance,
+# and keeps waiting instances in priority order until it does
+
+import heapq
+import os
+import psutil
+
+
+class AdmissionControl():
+    """AdmissionControl - limit how many unison instances run at once."""
+
+    # Key used to persist the waiting queue in the data storage backend
+    STATE_KEY = "admission-queue"
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger):
+        """Prepare admission control for one run.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to publish the waiting queue
+        3) logging.Logger
+            logger to report waiting instances to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+
+        # Heap of (priority rank, rule order, instance name, remote)
+        self.queue = []
+
+        # Instances started during this run by all sync roots, since load and
+        # memory usage lag behind new processes
+        self.started_this_run = 0
+
+    def enqueue(self, instance_name, rank, order, remote):
+        """Add an instance which is waiting to be started.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) int
+            rank of the priority class, lower starts first
+        3) int
+            position of the rule in the config, used to break ties
+        4) dict
+            remote the instance syncs to, with its own 'max_instances'
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        heapq.heappush(self.queue, (rank, order, instance_name, remote))
+
+    def has_capacity(self, running_count):
+        """Check if another instance may be started right now.
+
+        Parameters
+        ----------
+        int
+            number of unison instances currently running
+
+        Returns
+        -------
+        str
+            reason why no instance may be started, or None if there is capacity
+
+        Throws
+        -------
+        none
+
+        """
+        if (
+            self.config['max_instances'] > 0 and
+            running_count >= self.config['max_instances']
+        ):
+            return "max_instances of " + str(self.config['max_instances']) + " reached"
+
+        if (
+            self.config['max_instance_starts_per_run'] > 0 and
+            self.started_this_run >= self.config['max_instance_starts_per_run']
+        ):
+            return "max_instance_starts_per_run of " + str(self.config['max_instance_starts_per_run']) + " reached"
+
+        if self.config['max_memory_percent'] > 0:
+            memory_percent = psutil.virtual_memory().percent
+
+            if memory_percent >= self.config['max_memory_percent']:
+                return "memory usage at " + str(memory_percent) + "%"
+
+        if self.config['max_load_per_cpu'] > 0:
+            load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+
+            if load_per_cpu >= self.config['max_load_per_cpu']:
+                return "load average at " + str(round(load_per_cpu, 2)) + " per CPU"
+
+        return None
+
+    def remote_has_capacity(self, remote, running_instances, admitted_remotes):
+        """Check if another instance may be started for a remote.
+
+        Parameters
+        ----------
+        1) dict
+            remote the instance syncs to
+        2) list[dict]
+            stored data of all running instances
+        3) list[str]
+            remote names of the instances admitted so far in this run
+
+        Returns
+        -------
+        bool
+            True if the remote is below its 'max_instances'
+
+        Throws
+        -------
+        none
+
+        """
+        if remote['max_instances'] <= 0:
+            return True
+
+        running_count = len([
+            x for x in running_instances if x.get('remote', "") == remote['name']
+        ]) + admitted_remotes.count(remote['name'])
+
+        return running_count < remote['max_instances']
+
+    def admit(self, running_instances, started_before=0):
+        """Pop the waiting instances which may be started now.
+
+        Instances are admitted in priority order until the host runs out of
+        capacity. Instances whose remote is at its own limit are skipped, so
+        they do not hold up instances of other remotes. Anything left waits
+        for a later run, and is published to the data storage so it can be
+        reported.
+
+        Parameters
+        ----------
+        1) list[dict]
+            stored data of all running instances
+        2) int
+            instances other sync roots started during this run, which count
+            towards 'max_instance_starts_per_run'
+
+        Returns
+        -------
+        list[str]
+            names of the instances to start, in order
+
+        Throws
+        -------
+        none
+
+        """
+        admitted = []
+        admitted_remotes = []
+        remote_limited = []
+        self.started_this_run = started_before
+
+        while len(self.queue) > 0:
+            reason = self.has_capacity(len(running_instances) + len(admitted))
+
+            if reason is not None:
+                self.logger.info(
+                    str(len(self.queue) + len(remote_limited)) +
+                    " instances waiting to start: " + reason + "."
+                )
+                break
+
+            entry = heapq.heappop(self.queue)
+            remote = entry[3]
+
+            if not self.remote_has_capacity(remote, running_instances, admitted_remotes):
+                remote_limited.append(entry)
+                continue
+
+            admitted.append(entry[2])
+            admitted_remotes.append(remote['name'])
+            self.started_this_run += 1
+
+        if len(remote_limited) > 0:
+            self.logger.info(
+                str(len(remote_limited)) + " instances waiting to start: " +
+                "their remote reached its max_instances."
+            )
+
+        waiting = [entry[2] for entry in sorted(self.queue + remote_limited, key=lambda x: x[:3])]
+
+        if len(waiting) > 0:
+            self.data_storage.set_state(self.STATE_KEY, waiting)
+        else:
+            self.data_storage.remove_state(self.STATE_KEY)
+
+        return admitted
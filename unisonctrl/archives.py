@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# This script manages the unison archive directories, giving each sync
+# instance its own archive instead of sharing ~/.unison between all of them
+
+import os
+import shlex
+import shutil
+import subprocess
+
+from remoteshell import RemoteShell
+
+
+class ArchiveManager():
+    """ArchiveManager - create and garbage-collect per-instance unison archives.
+
+    The local archive directory is passed to unison with the 'UNISON'
+    environment variable. The unison server on the remote gets its own
+    directory below 'unison_remote_archive_dir' through the 'servercmd'
+    preference, unless that setting is empty, in which case the remote side
+    keeps sharing ~/.unison of the remote user.
+    """
+
+    # Seconds to wait for the removal of remote archive directories
+    REMOTE_TIMEOUT = 60
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, logger):
+        """Prepare the archive manager.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) logging.Logger
+            logger to report archive changes to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.logger = logger
+        self.remote_shell = RemoteShell(config)
+
+    def get_archive_dir(self, instance_name):
+        """Return the unison directory of an instance, creating it if needed.
+
+        The directory is passed to unison with the 'UNISON' environment
+        variable. It is named after the instance, so a restarted instance
+        finds its archive again and does not need to rescan from scratch.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        str
+            path to the unison directory of the instance
+
+        Throws
+        -------
+        none
+
+        """
+        archive_dir = self.config['unison_archive_dir'] + os.sep + instance_name
+
+        if not os.path.isdir(archive_dir):
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                "Creating unison archive directory '" + archive_dir + "'."
+            )
+            os.makedirs(archive_dir)
+
+        return archive_dir
+
+    def get_remote_profile_lines(self, instance_name, unison_options):
+        """Return the profile lines giving the unison server its own archive.
+
+        The 'servercmd' preference is passed by ssh to the shell of the
+        remote user, which creates the remote archive directory, and runs
+        unison with 'UNISON' pointing to it. A '-servercmd' option sets the
+        unison executable on the remote, and is taken out of the options.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) list[str]
+            unison options of the instance
+
+        Returns
+        -------
+        tuple
+            (preference lines, remaining unison options). The lines are empty,
+            and the options unchanged, if the remote archives are not
+            isolated.
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> AM = ArchiveManager({'isolate_unison_archives': True, 'unison_remote_archive_dir': ".unison-instances"}, None)
+
+        >>> AM.get_remote_profile_lines("catch-all", ["-batch", "-servercmd=/usr/bin/unison"])
+        (['servercmd = mkdir -p .unison-instances/catch-all && UNISON=.unison-instances/catch-all exec /usr/bin/unison'], ['-batch'])
+
+        """
+        if not self.config['isolate_unison_archives'] or self.config['unison_remote_archive_dir'] == "":
+            return ([], unison_options)
+
+        server_path = "unison"
+        remaining_options = []
+
+        for option in unison_options:
+            if option.startswith("-servercmd="):
+                server_path = option[len("-servercmd="):]
+            else:
+                remaining_options.append(option)
+
+        archive_dir = shlex.quote(self.config['unison_remote_archive_dir'] + "/" + instance_name)
+
+        return ([
+            "servercmd = mkdir -p " + archive_dir + " && UNISON=" + archive_dir + " exec " + server_path
+        ], remaining_options)
+
+    def get_remote_instances(self, instance_names, remote):
+        """Return the instances which ran against a remote.
+
+        Instances are named "<syncname>@<remote name>", except on the
+        unnamed remote of a single-remote config, which keeps the syncname.
+
+        Parameters
+        ----------
+        1) list[str]
+            names of sync instances
+        2) dict
+            remote, from 'unison_remotes'
+
+        Returns
+        -------
+        list[str]
+            names of the instances of the remote
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> AM = ArchiveManager({'unison_remotes': [{'name': "a"}, {'name': "b"}]}, None)
+
+        >>> AM.get_remote_instances(["docs@a", "docs@b", "media@b"], {'name': "b"})
+        ['docs@b', 'media@b']
+
+        >>> AM = ArchiveManager({'unison_remotes': [{'name': ""}]}, None)
+
+        >>> AM.get_remote_instances(["docs", "media"], {'name': ""})
+        ['docs', 'media']
+
+        """
+        if remote['name'] != "":
+            return [x for x in instance_names if x.endswith("@" + remote['name'])]
+
+        named_suffixes = tuple("@" + x['name'] for x in self.config['unison_remotes'] if x['name'] != "")
+
+        return [x for x in instance_names if not x.endswith(named_suffixes)]
+
+    def remove_remote_archives(self, instance_names):
+        """Remove the remote archive directories of instances.
+
+        Each directory is only removed on the remote its instance ran
+        against, over ssh with the keyfile of that remote.
+
+        Parameters
+        ----------
+        list[str]
+            names of the removed instances
+
+        Returns
+        -------
+        bool
+            True if the directories were removed on their remotes
+
+        Throws
+        -------
+        none
+
+        """
+        if self.config['unison_remote_archive_dir'] == "" or len(instance_names) == 0:
+            return True
+
+        removed = True
+
+        for remote in self.config['unison_remotes']:
+            remote_instances = self.get_remote_instances(instance_names, remote)
+
+            if len(remote_instances) == 0:
+                continue
+
+            script = "rm -rf -- " + " ".join(
+                shlex.quote(self.config['unison_remote_archive_dir'] + "/" + x) for x in remote_instances
+            )
+
+            try:
+                result = subprocess.run(
+                    self.remote_shell.get_ssh_command(remote) + [script],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    timeout=self.REMOTE_TIMEOUT
+                )
+                error = result.stderr.decode('utf-8', 'replace').strip() if result.returncode != 0 else None
+
+            except (OSError, subprocess.TimeoutExpired) as e:
+                error = str(e)
+
+            if error is not None:
+                self.logger.warning(
+                    "Could not remove unison archive directories on remote '" +
+                    remote['name'] + "', retrying next run: " + error
+                )
+                removed = False
+
+        return removed
+
+    def has_archive(self, instance_name):
+        """Check if an instance has an archive from an earlier run.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        bool
+            True if unison left archive files for the instance
+
+        Throws
+        -------
+        none
+
+        """
+        archive_dir = self.config['unison_archive_dir'] + os.sep + instance_name
+
+        try:
+            return any(entry.name.startswith("ar") for entry in os.scandir(archive_dir))
+        except OSError:
+            return False
+
+    def collect_garbage(self, instance_names):
+        """Remove archive directories of instances which no longer exist.
+
+        The remote archive directories are removed first. The local ones are
+        only removed once that succeeded on every remote, so a failed removal
+        is retried on the next run.
+
+        Parameters
+        ----------
+        set[str]
+            names of all instances which may still use their archive
+
+        Returns
+        -------
+        list[str]
+            names of the instances whose archive was removed
+
+        Throws
+        -------
+        none
+
+        """
+        if not os.path.isdir(self.config['unison_archive_dir']):
+            return []
+
+        stale = [
+            entry for entry in os.scandir(self.config['unison_archive_dir'])
+            if entry.is_dir() and entry.name not in instance_names
+        ]
+
+        if not self.remove_remote_archives([entry.name for entry in stale]):
+            return []
+
+        removed = []
+
+        for entry in stale:
+            self.logger.info(
+                "Removing unison archive directory of '" + entry.name + "', " +
+                "which is no longer in the sync rules."
+            )
+
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed.append(entry.name)
+
+        return removed
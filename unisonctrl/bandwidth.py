@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# This script splits a global bandwidth budget between the unison instances,
+# so a large initial sync can not starve the other instances of the link
+
+import glob
+import os
+
+
+class BandwidthBudget():
+    """BandwidthBudget - share 'bandwidth_limit' between running instances.
+
+    Each instance gets a share of the limit in proportion to the
+    "bandwidth_weight" of its rule. Bandwidth left unused by idle instances
+    goes to the instances which are transferring: idle instances only keep
+    'bandwidth_idle_reserve' of their share, so a transfer starting before
+    the next rebalance is not starved. Shares are written to a rate file per
+    instance, which the throttling pipe in the ssh transport of the instance
+    re-reads while it runs, so shares change without restarting instances.
+    """
+
+    # Lowest share of an instance, in bytes per second, so a starved
+    # transport does not time out
+    MIN_RATE = 1024
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, logger):
+        """Prepare the bandwidth budget.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) logging.Logger
+            logger to report changed shares to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.logger = logger
+
+    def get_pipe_path(self):
+        """Return the path of the throttling pipe script.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        str
+            path of throttlepipe.py, which unison runs in place of ssh
+
+        Throws
+        -------
+        none
+
+        """
+        return os.path.dirname(os.path.abspath(__file__)) + os.sep + "throttlepipe.py"
+
+    def get_weight(self, rule):
+        """Return the weight of the instances of a rule.
+
+        Parameters
+        ----------
+        dict
+            sync rule (may be None)
+
+        Returns
+        -------
+        float
+            the "bandwidth_weight" of the rule, 1 by default
+
+        Throws
+        -------
+        none
+
+        """
+        if rule is None:
+            return 1
+
+        return rule.get('bandwidth_weight', 1)
+
+    def get_share(self, weight, total_weight):
+        """Return the bytes per second an instance may use.
+
+        Parameters
+        ----------
+        1) float
+            weight of the instance
+        2) float
+            weight of all running instances, including this one
+
+        Returns
+        -------
+        int
+            bytes per second
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> BandwidthBudget({'bandwidth_limit': 1000000}, None).get_share(3, 4)
+        750000
+
+        """
+        return max(int(self.config['bandwidth_limit'] * weight / total_weight), self.MIN_RATE)
+
+    def get_shares(self, instances):
+        """Split the limit between instances, giving idle bandwidth to busy ones.
+
+        Parameters
+        ----------
+        list[tuple]
+            (weight, True if transferring) of every throttled instance
+
+        Returns
+        -------
+        list[int]
+            bytes per second of each instance, in the same order
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> BB = BandwidthBudget({'bandwidth_limit': 1000000, 'bandwidth_idle_reserve': 0.1}, None)
+
+        >>> BB.get_shares([(1, False), (1, False), (0.25, False)])
+        [444444, 444444, 111111]
+
+        >>> BB.get_shares([(1, False), (1, False), (0.25, True)])
+        [44444, 44444, 911111]
+
+        >>> BB.get_shares([(1, True), (1, False), (0.25, True)])
+        [764444, 44444, 191111]
+
+        """
+        total_weight = sum(weight for weight, active in instances)
+        active_weight = sum(weight for weight, active in instances if active)
+
+        # Without any transfer, the plain weighted shares apply
+        if active_weight == 0:
+            return [self.get_share(weight, total_weight) for weight, active in instances]
+
+        reserve = self.config['bandwidth_idle_reserve']
+        idle_total = sum(
+            self.config['bandwidth_limit'] * reserve * weight / total_weight
+            for weight, active in instances if not active
+        )
+        spare = self.config['bandwidth_limit'] - idle_total
+
+        return [
+            max(int(spare * weight / active_weight), self.MIN_RATE) if active else
+            max(int(self.config['bandwidth_limit'] * reserve * weight / total_weight), self.MIN_RATE)
+            for weight, active in instances
+        ]
+
+    def write_rate(self, rate_file, rate):
+        """Write the share of an instance to its rate file, if it changed.
+
+        The file is replaced atomically, so the pipe never reads half a rate.
+
+        Parameters
+        ----------
+        1) str
+            path of the rate file
+        2) int
+            bytes per second
+
+        Returns
+        -------
+        bool
+            True if the rate changed
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            with open(rate_file) as f:
+                if f.read().strip() == str(rate):
+                    return False
+        except OSError:
+            pass
+
+        os.makedirs(os.path.dirname(rate_file), exist_ok=True)
+
+        with open(rate_file + ".tmp", 'w') as f:
+            f.write(str(rate) + "\n")
+
+        os.replace(rate_file + ".tmp", rate_file)
+
+        return True
+
+    def update(self, instances):
+        """Split the budget between running instances.
+
+        Parameters
+        ----------
+        list[tuple]
+            (stored data, True if transferring) of every running instance, of
+            all sync roots
+
+        Returns
+        -------
+        int
+            number of instances whose share changed
+
+        Throws
+        -------
+        none
+
+        """
+        throttled = [x for x in instances if 'rate_file' in x[0]]
+        rates = self.get_shares([(x[0]['bandwidth_weight'], x[1]) for x in throttled])
+        changed = 0
+
+        for (instance_info, active), rate in zip(throttled, rates):
+            if self.write_rate(instance_info['rate_file'], rate):
+                changed += 1
+                self.logger.debug(
+                    "Instance '%s' Bandwidth share is now %s bytes per second.",
+                    instance_info['syncname'], rate
+                )
+
+        return changed
+
+    def prune(self, instance_names):
+        """Remove the rate files of instances which are no longer running.
+
+        Parameters
+        ----------
+        set[str]
+            names of the running instances of the sync root
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        for rate_file in glob.glob(self.config['bandwidth_rate_dir'] + os.sep + "*.rate"):
+            if os.path.basename(rate_file)[:-len(".rate")] not in instance_names:
+                try:
+                    os.remove(rate_file)
+                except OSError:
+                    pass
@@ -21,6 +21,26 @@ unison_home_dir = "/home/syncd"
 # setting can override the auto-detected value
 # unison_user = "syncd"
 
+# Each instance gets its own unison archive directory, in a directory named
+# after the instance below 'unison_archive_dir'. This avoids all instances
+# reading and writing the same archive in ~/.unison. Directories are kept
+# across restarts, and removed once their rule is removed from
+# 'sync_hierarchy_rules'. Enabling this for the first time causes a one-time
+# full scan of every instance.
+# isolate_unison_archives = True
+# unison_archive_dir = "/home/syncd/.unison-instances"
+
+# The unison server on the remote gets an archive directory per instance as
+# well, below 'unison_remote_archive_dir' (relative to the home directory of
+# the remote user), through the 'servercmd' preference. The unison executable
+# on the remote is still set with "-servercmd" in
+# 'global_unison_config_options'. Set 'unison_remote_archive_dir' to "" to
+# leave the remote side on the shared ~/.unison, in which case only the local
+# side is isolated. Remote directories of removed rules are removed over ssh
+# (with the keyfile of the remote), on the remote their instance synced with.
+# Changing this setting takes effect as instances restart.
+# unison_remote_archive_dir = ".unison-instances"
+
 # Define unsion root directories
 # unison_local_root="/mnt/local/pcnart"
 unison_local_root = "/mnt/lan/pcnart"
@@ -51,6 +71,27 @@ unison_remote_ssh_conn = "aws-artshare-sync"
 # This keyfile will be specified if this is set
 # unison_remote_ssh_keyfile = "/home/syncd/.ssh/keys/pcnartsync_unison_key"
 
+# To replicate to more than one site, list the remotes here instead of using
+# the settings above. The directory scan and the sync rules are evaluated once
+# per run, and every remote gets its own set of instances, named
+# "<syncname>@<remote name>". "ssh_keyfile" and "max_instances" (the maximum
+# number of instances running for this remote, 0 for no limit) are optional.
+#
+# unison_remotes = [
+#     {
+#         "name": "aws",
+#         "ssh_conn": "aws-artshare-sync",
+#         "root": "/mnt/local/pcnart",
+#         "max_instances": 8,
+#     },
+#     {
+#         "name": "office",
+#         "ssh_conn": "syncd@10.100.1.247",
+#         "root": "/srv/pcnart",
+#         "ssh_keyfile": "/home/syncd/.ssh/keys/pcnartsync_unison_key",
+#     },
+# ]
+
 
 # Path to unison if we can not find it by default
 # unison_path="/usr/bin/unison"
@@ -65,12 +106,15 @@ unison_remote_ssh_conn = "aws-artshare-sync"
 
 sync_hierarchy_rules = [
 
-    # Sync the 3 highest-counted folders starting with "11" in their
-    # own unison instance
+    # Sync the folders starting with "11" in a chain of unison instances,
+    # highest-counted first: the first 5 in one instance, the next 3 in
+    # another, and so on
     {
         # Name = of the unison profile which will be created
         # can be any alphanumeric string (a-z, A-Z, 1-9) to identify the sync
-        "syncname": "recent-phone-orders-batch-1",
+        # A rule with "tiers" creates one instance per tier, named
+        # "recent-phone-orders-batch-1", "recent-phone-orders-batch-2", ...
+        "syncname": "recent-phone-orders",
 
         # Select the directories which will be synced with this profile
         # Use standard shell globbing to select files from the root directory
@@ -80,7 +124,9 @@ sync_hierarchy_rules = [
         # Select a method to sort the files
         # Current options:
         #   name_highfirst
-        #   name_highfirst
+        #   name_lowfirst
+        #   activity_highfirst (most recently changed first, see 'Activity
+        #     index' below)
         # FUTURE:
         #   creation_date_highfirst
         #   creation_date_lowfirst
@@ -88,130 +134,151 @@ sync_hierarchy_rules = [
 
         # Select X from the top of the list you sorted above
         # "sort_count": 4,
-        # This is for debugging, to ensure each instance restarts every tim
-        "sort_count": 5,
-    },
-
-    # Sync the next 3 highest-counted folders starting with "11" in their
-    # own unison instance
-    {
-        "syncname": "recent-phone-orders-batch-2",
-        "dir_selector": "Art Department/11*",
-        "sort_method": "name_highfirst",
-
-        "sort_count": 3,
-    },
-
-    # Sync the next 4 highest-counted folders starting with "11" in their
-    # own unison instance
-    {
-        "syncname": "recent-phone-orders-batch-3",
-        "dir_selector": "Art Department/11*",
-        "sort_method": "name_highfirst",
-
-        "sort_count": 4,
-    },
-
-    # Sync the next 8 highest-counted folders starting with "11" in their
-    # own unison instance
-    {
-        "syncname": "recent-phone-orders-batch-4",
-        "dir_selector": "Art Department/11*",
-        "sort_method": "name_highfirst",
-
-        "sort_count": 8,
-    },
-
-    # Sync the 3 highest-counted folders starting with "M" in their
-    # own unison instance
-    {
-        "syncname": "recent-magento-orders-batch-1",
-        "dir_selector": "Art Department/M0*",
-        "sort_method": "name_highfirst",
-
-        "sort_count": 3,
-    },
-
-    # Sync the next 3 highest-counted folders starting with "M" in their
-    # own unison instance
-    {
-        "syncname": "recent-magento-orders-batch-2",
-        "dir_selector": "Art Department/M0*",
-        "sort_method": "name_highfirst",
-
-        "sort_count": 3,
-    },
-
-    # Sync the next 6 highest-counted folders starting with "M" in their
-    # own unison instance
-    {
-        "syncname": "recent-magento-orders-batch-3",
-        "dir_selector": "Art Department/M0*",
-        "sort_method": "name_highfirst",
 
-        "sort_count": 4,
+        # Or split the sorted list into tiers, each synced in its own
+        # instance. Each tier takes the next "sort_count" folders. A tier can
+        # also be a dict, whose settings apply to that tier only. Settings of
+        # the rule itself apply to every tier. A rule with tiers can not set
+        # "sort_count" or "overlap".
+        "tiers": [
+            {
+                # This is for debugging, to ensure each instance restarts every tim
+                "sort_count": 5,
+
+                # Scheduling priority class of the unison process, see
+                # 'priority_classes' below. Defaults to 'default_priority'.
+                "priority": "high",
+
+                # Never merge this rule with others while memory is short, see
+                # 'Memory pressure' below
+                "pinned": True,
+            },
+            3,
+            4,
+            8,
+        ],
+
+        # Optionally pin the unison process to a set of CPUs
+        # "cpu_affinity": [0, 1],
+
+        # By default, each rule keeps a unison instance running continuously.
+        # For cold data, "scheduled" mode instead runs a one-shot sync every
+        # "interval" seconds, using a worker slot (see 'scheduled_workers').
+        # Switching the mode of a rule restarts its running instance.
+        # "mode": "scheduled",
+        # "interval": 3600,
+
+        # Restart the instance if it makes no progress for this many seconds,
+        # see 'watchdog_max_cycle_time' below
+        # "max_cycle_time": 900,
+
+        # Unison options of this rule, merged with
+        # 'global_unison_config_options' below. An option replaces the global
+        # option of the same name; options which may be repeated, like
+        # "-ignore", are added. Only instances whose merged options change
+        # are restarted when the options are edited.
+        # "unison_options": ["-repeat=2"],
+
+        # Share of 'bandwidth_limit' of this rule, relative to the other
+        # running rules
+        # "bandwidth_weight": 4,
     },
 
-
-    # Sync the next 6 highest-counted folders starting with "M" in their
-    # own unison instance
+    # Sync the folders starting with "M" in a chain of unison instances,
+    # highest-counted first
     {
-        "syncname": "recent-magento-orders-batch-4",
+        "syncname": "recent-magento-orders",
         "dir_selector": "Art Department/M0*",
         "sort_method": "name_highfirst",
 
-        "sort_count": 6,
+        "tiers": [{"sort_count": 3, "priority": "high", "pinned": True}, 3, 4, 6],
     },
 
-    # Sync the 3 highest-counted folders starting with 'O' in their
-    # own unison instance
+    # Sync the folders starting with "O" in a chain of unison instances,
+    # highest-counted first
     {
-        "syncname": "recent-web-orders-batch-1",
+        "syncname": "recent-web-orders",
         "dir_selector": "Art Department/O*",
         "sort_method": "name_highfirst",
-        "sort_count": 3,
-    },
-
 
-    # Sync the next 3 highest-counted folders starting with 'O' in their
-    # own unison instance
-    {
-        "syncname": "recent-web-orders-batch-2",
-        "dir_selector": "Art Department/O*",
-        "sort_method": "name_highfirst",
-        "sort_count": 3,
+        "tiers": [{"sort_count": 3, "priority": "high", "pinned": True}, 3, 4, 6],
     },
 
-    # Sync the next 6 highest-counted folders starting with 'O' in their
-    # own unison instance
-    {
-        "syncname": "recent-web-orders-batch-3",
-        "dir_selector": "Art Department/O*",
-        "sort_method": "name_highfirst",
-        "sort_count": 4,
-    },
-
-    # Sync the next 6 highest-counted folders starting with 'O' in their
-    # own unison instance
-    {
-        "syncname": "recent-web-orders-batch-4",
-        "dir_selector": "Art Department/O*",
-        "sort_method": "name_highfirst",
-        "sort_count": 6,
-    },
+    # Sync the 5 most recently changed folders not caught above, like
+    # reopened old orders, in their own instance. This samples every folder
+    # of the selector, see 'Activity index' below.
+    # {
+    #     "syncname": "recently-active-orders",
+    #     "dir_selector": "Art Department/*",
+    #     "sort_method": "activity_highfirst",
+    #     "sort_count": 5,
+    #     "priority": "high",
+    #     "pinned": True,
+    # },
 
     # Sync any files not caught above in their own instance
     {
         "syncname": "catch-all",
         "dir_selector": "*",
 
-        # NOTE: This option not yet implemented
+        # Keep the full rescans from competing with the hot batches
+        "priority": "idle",
+        "unison_options": ["-repeat=60"],
+        "bandwidth_weight": 0.25,
+
         # This generates ignore statements for each of the directories
         # already handled in other instances, to ensure no overlap
-        # "include_ignores": True,
+        "include_ignores": True,
     },
 ]
 
+# Multiple sync roots
+# To manage several shares with one controller, list them here instead of
+# using 'unison_local_root' and 'sync_hierarchy_rules' above. Each root needs a
+# unique "name", and may set "unison_local_root", "sync_hierarchy_rules",
+# "unison_remote_root", "unison_remote_ssh_conn", "unison_remote_ssh_keyfile"
+# and "unison_remotes", overriding the settings above. Roots are reconciled in
+# parallel, up to 'max_parallel_roots' at once (0 for all of them), and keep
+# their running data, state, logs and archives in a subdirectory named after
+# the root. Unison profiles are named 'unisonctrl-<root>.<syncname>', so rules
+# of different roots may share a syncname. Root names can not contain '/' or
+# '.'. Stop all instances before switching an existing setup to roots.
+#
+# sync_roots = [
+#     {
+#         "name": "art",
+#         "unison_local_root": "/mnt/lan/pcnart",
+#         "unison_remote_root": "/mnt/local/pcnart",
+#         "sync_hierarchy_rules": [
+#             {"syncname": "catch-all", "dir_selector": "*"},
+#         ],
+#     },
+#     {
+#         "name": "accounting",
+#         "unison_local_root": "/mnt/lan/accounting",
+#         "unison_remote_root": "/mnt/local/accounting",
+#         "sync_hierarchy_rules": [
+#             {"syncname": "catch-all", "dir_selector": "*"},
+#         ],
+#     },
+# ]
+# max_parallel_roots = 0
+
+# Sharding between hosts
+# Several unisonctrl hosts can split the sync rules between them. Each host
+# claims rules through lease files in 'shard_state_dir', a directory shared by
+# all hosts (for example an NFS mount), and only runs the rules it holds. Rules
+# are balanced by their measured CPU cost. Hosts write a heartbeat every run;
+# once a host misses heartbeats for 'shard_lease_ttl' seconds, its rules are
+# taken over by the others. A host gives up a rule when it has more than
+# 'shard_rebalance_slack' above an even share, once the instances of the rule
+# are stopped on it. Leave empty to disable.
+#
+# shard_state_dir = "/mnt/shared/unisonctrl-shards"
+# shard_node_name = "pcnartsync"
+# shard_lease_ttl = 300
+# shard_rebalance_slack = 0.25
+
 # Log rotation
 # First option is "off", which logs to a single file and never rotates.
 # Second is "time", which rotates daily, keeping the past 14 days.
@@ -221,7 +288,273 @@ sync_hierarchy_rules = [
 #
 rotate_logs = "time"
 
+# Format of the unisonctrl log file
+# "json" writes one JSON object per line, with structured fields like
+# "syncname", "pid", "phase" and "duration_ms" where known. "text" writes
+# plain lines, like the console output.
+#
+# "text" is default if this config entry isn't found, so tools reading the
+# existing logs keep working. Set "json" to opt in.
+#
+# log_format = "json"
+
+# Unison instance log rotation
+# Unison appends to the log of each instance forever. Logs are rotated right
+# before an instance starts, since unison keeps its log open. Instances which
+# keep running are restarted once their log is due, within the restart budgets
+# below. Rotated logs are named after the time of rotation, and compressed
+# with gzip in the background.
+#
+# Rotate once a log reaches this size in bytes, or this age in seconds.
+# 0 disables either limit.
+# instance_log_max_bytes = 52428800
+# instance_log_max_age = 604800
+#
+# Number of rotated logs kept per instance, and the age in seconds after which
+# rotated logs are removed (0 keeps them regardless of age)
+# instance_log_backups = 5
+# instance_log_retention = 2592000
+#
+# instance_log_compress = True
+
+# Restart budgets
+# When the directories or config of an instance change, the instance has to be
+# restarted, which causes unison to rescan. These settings limit how often that
+# can happen. Changes which are not allowed yet are queued and applied on a
+# later run.
+#
+# Minimum number of seconds an instance runs before it may be restarted, so it
+# can finish its initial scan. Can be overridden per rule with
+# "restart_min_interval".
+# instance_restart_min_interval = 600
+#
+# A change must stay the same for this many seconds before it is applied, so
+# bursts of new directories settle into one restart. Can be overridden per rule
+# with "restart_debounce".
+# restart_debounce = 120
+#
+# Apply a queued change after this many seconds, even if it keeps changing
+# restart_debounce_max = 900
+#
+# At most this many restarts, across all instances, per window of seconds
+# global_restart_limit = 4
+# global_restart_window = 300
+#
+# A restart would throw away a partial transfer, so instances which are busy
+# propagating changes are restarted once they are idle. An instance is busy
+# when its log shows a copy in progress, or when it moved at least
+# transfer_active_bytes_per_second since the previous run.
+# transfer_active_bytes_per_second = 65536
+#
+# Restart a busy instance anyway once its change waited this many seconds.
+# Can be overridden per rule with "restart_max_defer".
+# restart_max_defer = 3600
+#
+# Changes to these parts of the config are applied without waiting for
+# transfers: "name", "dirs", "ignore", "remote" and "options". Running with
+# --urgent does the same for all changes.
+# urgent_restart_components = ["remote"]
+
+# Activity index
+# The "activity_highfirst" sort method ranks directories by how recently and
+# how often they changed. Each directory has a score, which grows whenever a
+# newer modification time is found in it, and halves every this many seconds.
+# activity_half_life = 86400
+#
+# Directories are sampled at most once per this many seconds, and at most this
+# many directories per run, stalest first
+# activity_sample_interval = 300
+# activity_max_samples_per_run = 100
+#
+# A sample stats up to 'activity_sample_entries' randomly chosen entries of the
+# directory, and of its subdirectories down to 'activity_sample_depth' levels.
+# Every sample costs a stat per entry on the local root, which competes with
+# the unison scans, so raise these with care on a busy share.
+# activity_sample_depth = 1
+# activity_sample_entries = 32
+
+# Remote listing
+# Rules normally only see directories which exist in the local root, so a new
+# directory created on a remote reaches the rules only once the catch-all has
+# copied it. With this enabled, the parent of each "dir_selector" (the part
+# before the last "/", which must not contain wildcards) is also listed on
+# every remote, once per run, and matching remote directories are added to the
+# rules. Parents are only listed again when their modification time changed.
+# The remotes need a POSIX shell and GNU find.
+# remote_listing = False
+#
+# Command which runs the listing script, read from stdin, in the remote root.
+# By default, ssh to the remote with 'unison_remote_ssh_keyfile' and
+# "sh -s". The same command is used for every remote, and is told which remote
+# to list in the environment variables UNISONCTRL_REMOTE_NAME,
+# UNISONCTRL_REMOTE_SSH_CONN and UNISONCTRL_REMOTE_ROOT. Replace with a local
+# command to test without ssh.
+# remote_listing_command = ""
+# remote_listing_command = """sh -c 'exec ssh -J bastion "$UNISONCTRL_REMOTE_SSH_CONN" sh -s'"""
+#
+# Seconds to wait for a listing, before using the cached one
+# remote_listing_timeout = 30
+
+# Latency probes
+# Measure how long a change takes to reach each remote. Every this many
+# seconds, a small canary file is written to a directory each continuous
+# instance syncs (".unisonctrl-canaries/<instance name>" in the local root),
+# and later runs look for it in the remote root. The latency, from writing the
+# canary to its change time on the remote, is kept per rule and shown by
+# 'unisonctrl.py status'. The clocks of both sides must be in sync. 0 disables
+# probes. Enabling them restarts all continuous instances once.
+# latency_probe_interval = 0
+#
+# Command which runs the check script, read from stdin, in the remote root. By
+# default, ssh to the remote and "sh -s". The remotes need GNU find. Like
+# 'remote_listing_command', the command is told which remote to check in
+# UNISONCTRL_REMOTE_NAME, UNISONCTRL_REMOTE_SSH_CONN and UNISONCTRL_REMOTE_ROOT.
+# latency_probe_command = ""
+#
+# Seconds to wait for the check command
+# latency_probe_timeout = 30
+#
+# Seconds after which a canary which has not arrived counts as a timeout
+# latency_probe_max_wait = 3600
+
+# Memory pressure
+# Every unison process keeps its archive in memory. When the unison processes
+# use more than 'consolidation_max_rss' bytes in total, or the system uses more
+# than 'consolidation_memory_percent' percent of its memory, adjacent rules are
+# merged into shared instances of up to 'consolidation_group_size' rules (0 for
+# no limit). Rules marked "pinned", scheduled rules, "include_ignores" rules
+# and rules whose unison options, priority or bandwidth weight differ from
+# their neighbours keep their own instances. 0 disables a limit.
+# consolidation_max_rss = 0
+# consolidation_memory_percent = 0
+# consolidation_group_size = 4
+#
+# Every merge and split starts instances with a new profile and archive, which
+# rescan all their directories in full. With 'max_instance_starts_per_run'
+# set, merges and splits start at most that many instances per run, and the
+# rest wait for later runs with the old instances still running. Splitting a
+# group starts one instance per rule, so keep that limit at or above
+# 'consolidation_group_size', or the directories of a split wait a run.
+#
+# Rules are split again after at least 'consolidation_min_time' seconds, once
+# memory use plus the memory saved by merging stays below the limits lowered by
+# this fraction
+# consolidation_min_time = 3600
+# consolidation_hysteresis = 0.1
+
+# Bandwidth budget
+# Total bytes per second all instances may send and receive over ssh, 0 for no
+# limit. When set, the ssh transport of each instance runs through a throttling
+# pipe, and the budget is split between the running instances in proportion to
+# the "bandwidth_weight" of their rules (1 by default). Shares are rebalanced
+# every run without restarting instances, but setting a limit for the first
+# time restarts all instances to insert the pipe.
+# bandwidth_limit = 0
+#
+# Fraction of its share an idle instance keeps while other instances are
+# transferring (see transfer_active_bytes_per_second). The rest of the
+# idle shares goes to the transferring instances by weight, so a low weight
+# rule gets the whole link when it is the only one busy. When nothing is
+# transferring, every instance gets its plain share.
+# bandwidth_idle_reserve = 0.1
+#
+# Directory of the files holding the current share of each instance. To change
+# a share by hand until the next run, write bytes per second to its file.
+# bandwidth_rate_dir = "/tmp/unisonctrl/bandwidth"
+#
+# Command the throttling pipe runs as the transport, with the arguments unison
+# passes to ssh appended.
+# bandwidth_ssh_command = "ssh"
+
+# Crash loops
+# An instance which exits on its own within this many seconds of starting (for
+# example because of a bad path, or the remote being down) has failed. Exits
+# are noticed on the next run, so keep this above the cron interval.
+# crash_fast_failure_time = 300
+#
+# A failed instance is started again after a delay, which doubles with every
+# consecutive failure up to a maximum. A random fraction of up to
+# crash_backoff_jitter is added, so instances which fail together spread out.
+# crash_backoff_base = 60
+# crash_backoff_max = 3600
+# crash_backoff_jitter = 0.2
+#
+# After this many consecutive failures, the instance is quarantined and only
+# tried again after crash_quarantine_time seconds. Failures are logged as
+# errors, and kept in the controller state.
+# crash_quarantine_after = 5
+# crash_quarantine_time = 86400
+
+# Scheduling priority classes, selected per rule with "priority"
+# Each class sets the nice value (-20 to 19), the IO scheduling class
+# ("best-effort" or "idle"), the best-effort IO level (0 to 7, lower is
+# higher priority) and optionally a list of CPUs to pin the process to.
+# Unison is started through nice, ionice and taskset, so its ssh transport
+# gets the same class. Changing the class of a rule is applied to running
+# instances and their transports without a restart.
+#
+# priority_classes = {
+#     "high": {"nice": 0, "ionice_class": "best-effort", "ionice_level": 0},
+#     "normal": {"nice": 5, "ionice_class": "best-effort", "ionice_level": 4},
+#     "low": {"nice": 10, "ionice_class": "best-effort", "ionice_level": 7},
+#     "idle": {"nice": 19, "ionice_class": "idle"},
+# }
+#
+# Class used for rules which do not set "priority"
+# default_priority = "normal"
+#
+# Classes are listed from highest to lowest priority. This order is also used
+# to decide which waiting instance is started first, see below.
+
+# Admission control
+# New instances are only started while the host has capacity. Instances which
+# can not be started wait, highest priority class first, then in rule order,
+# and are started on a later run once capacity frees up. With several sync
+# roots, the limits apply to the instances of all roots together. Set any of
+# these to 0 to disable the check.
+#
+# Maximum number of unison instances running at once
+# max_instances = 0
+#
+# Maximum number of instances started in one run. Memory and load lag behind
+# new processes, so this spreads a large number of starts over several runs.
+# max_instance_starts_per_run = 0
+#
+# Do not start new instances while system memory usage is at or above this
+# percentage
+# max_memory_percent = 90
+#
+# Do not start new instances while the 1 minute load average, divided by the
+# number of CPUs, is at or above this value
+# max_load_per_cpu = 2.0
+
+# Stuck instance watchdog
+# An instance which is still running, but neither writes to its log nor uses
+# CPU time (including its ssh transport), is considered stuck. This happens
+# when unison hangs on a stale network share or a dead ssh connection. Stuck
+# instances are reported in the log and restarted.
+#
+# Seconds without progress before an instance is restarted. Can be overridden
+# per rule with "max_cycle_time". 0 disables the watchdog.
+# watchdog_max_cycle_time = 1800
+#
+# CPU seconds an instance has to use to count as progress. Unison rescans
+# every "-repeat" seconds, so a healthy instance uses some CPU time even when
+# there is nothing to sync.
+# watchdog_min_cpu_seconds = 1.0
+
+# Scheduled rules
+# Number of one-shot syncs of "scheduled" rules which may run at once. When
+# more rules are due, the most overdue ones are started first, and the rest
+# wait for a free worker. 0 uses the number of CPUs. Due syncs are also
+# subject to the admission limits, like 'max_instances'.
+# scheduled_workers = 0
+
 # These options are passed through to unison on every run
+# They are written to the generated profile of each instance, so use the
+# command line form (like "-prefer=newer" or "-fastcheck"). Rules may override
+# them with "unison_options". Changing an option restarts every instance which
+# uses it, unless its rule overrides it.
 global_unison_config_options = [
     # Test for space handling
     "-copyquoterem=true",
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# This script merges cold sync rules into fewer unison instances while memory
+# is short, since every unison process keeps its archive in memory
+
+import collections
+import time
+import psutil
+
+from registry import InstanceRecord
+
+
+class MemoryConsolidator():
+    """MemoryConsolidator - run adjacent cold rules in shared instances.
+
+    Consolidation starts once the unison processes use more than
+    'consolidation_max_rss' bytes in total, or the system uses more than
+    'consolidation_memory_percent' of its memory. It ends once the memory
+    saved by consolidating would fit below both limits lowered by
+    'consolidation_hysteresis', after at least 'consolidation_min_time'
+    seconds. While active, runs of adjacent rules which may share an instance
+    are merged into groups of up to 'consolidation_group_size' rules (0 for
+    no limit).
+    """
+
+    # Key used to persist the consolidation mode in the data storage backend
+    STATE_KEY = "consolidation"
+
+    # Suffix of the instance name of merged rules
+    GROUP_SUFFIX = "-consolidated"
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger, read_only=False):
+        """Prepare the consolidator.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist the consolidation mode
+        3) logging.Logger
+            logger to report mode changes to
+        4) bool
+            if True, the mode is reported but never changed
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+        self.read_only = read_only
+
+    def get_unison_rss(self, instances):
+        """Return the memory used by unison instances and their ssh transports.
+
+        Parameters
+        ----------
+        list[dict]
+            stored data of the running instances
+
+        Returns
+        -------
+        int
+            resident set size in bytes, summed over all processes
+
+        Throws
+        -------
+        none
+
+        """
+        rss = 0
+
+        for instance_info in instances:
+            proc = InstanceRecord(instance_info['syncname'], instance_info).get_process()
+
+            if proc is None:
+                continue
+
+            try:
+                for member in [proc] + proc.children(recursive=True):
+                    rss += member.memory_info().rss
+
+            except psutil.Error:
+                continue
+
+        return rss
+
+    def is_over(self, rss, memory_percent, factor):
+        """Check if memory use is over the limits.
+
+        Parameters
+        ----------
+        1) int
+            total RSS of the unison processes
+        2) float
+            percent of system memory in use
+        3) float
+            factor applied to the limits
+
+        Returns
+        -------
+        bool
+            True if any enabled limit, times the factor, is reached
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> MC = MemoryConsolidator({'consolidation_max_rss': 1000, 'consolidation_memory_percent': 0}, None, None)
+
+        >>> MC.is_over(950, 99.0, 1.0)
+        False
+
+        >>> MC.is_over(950, 99.0, 0.9)
+        True
+
+        """
+        return (
+            (self.config['consolidation_max_rss'] > 0 and rss >= self.config['consolidation_max_rss'] * factor) or
+            (
+                self.config['consolidation_memory_percent'] > 0 and
+                memory_percent >= self.config['consolidation_memory_percent'] * factor
+            )
+        )
+
+    def update(self, instances):
+        """Decide if cold rules are consolidated in this run.
+
+        Parameters
+        ----------
+        list[dict]
+            stored data of the running instances of all sync roots
+
+        Returns
+        -------
+        bool
+            True if cold rules are consolidated
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.data_storage.get_state(self.STATE_KEY, {'active': False})
+
+        if self.read_only:
+            return state['active']
+
+        now = time.time()
+        memory = psutil.virtual_memory()
+        rss = self.get_unison_rss(instances)
+
+        if not state['active']:
+            if not self.is_over(rss, memory.percent, 1.0):
+                return False
+
+            self.logger.warning(
+                "Memory is short (unison uses " + str(rss // (1024 * 1024)) + " MiB, " +
+                "system " + str(memory.percent) + "%). Consolidating cold rules."
+            )
+
+            state = {'active': True, 'since': now, 'rss_before': rss, 'rss_min': rss}
+            self.data_storage.set_state(self.STATE_KEY, state)
+
+            return True
+
+        # The memory saved is estimated by the drop since consolidating, so
+        # splitting does not push memory use straight back over the limits
+        state['rss_min'] = min(state['rss_min'], rss)
+        saved = max(state['rss_before'] - state['rss_min'], 0)
+
+        if now - state['since'] >= self.config['consolidation_min_time'] and not self.is_over(
+            rss + saved, memory.percent + 100.0 * saved / memory.total,
+            1.0 - self.config['consolidation_hysteresis']
+        ):
+            self.logger.info("Memory pressure is over. Splitting consolidated rules.")
+            state = {'active': False}
+
+        self.data_storage.set_state(self.STATE_KEY, state)
+
+        return state['active']
+
+    def consolidate(self, dirs_by_rule, rules, get_merge_key):
+        """Merge runs of adjacent rules into groups.
+
+        Parameters
+        ----------
+        1) dict
+            directories of each rule, keyed by syncname, in rule order
+        2) list[dict]
+            the sync rules
+        3) function
+            returns a key for a rule, equal for rules which may share an
+            instance, or None if the rule must keep its own instance
+
+        Returns
+        -------
+        dict
+            directories of each instance, keyed by the syncname of single
+            rules, or by the first syncname of a group plus GROUP_SUFFIX.
+            Groups carry the syncname of their first rule, whose settings the
+            instance uses, and the syncnames of all merged rules in 'rules'.
+
+        Throws
+        -------
+        none
+
+        """
+        groups = []
+        group_key = None
+
+        for rule in rules:
+            # Rules without directories do not break a run
+            if rule['syncname'] not in dirs_by_rule:
+                continue
+
+            key = get_merge_key(rule)
+
+            if key is None or key != group_key or (
+                self.config['consolidation_group_size'] > 0 and
+                len(groups[-1]) >= self.config['consolidation_group_size']
+            ):
+                groups.append([])
+
+            groups[-1].append(rule['syncname'])
+            group_key = key
+
+        consolidated = collections.OrderedDict()
+
+        for group in groups:
+            if len(group) == 1:
+                consolidated[group[0]] = dirs_by_rule[group[0]]
+                continue
+
+            consolidated[group[0] + self.GROUP_SUFFIX] = {
+                'sync': [x for syncname in group for x in dirs_by_rule[syncname]['sync']],
+                'ignore': [x for syncname in group for x in dirs_by_rule[syncname]['ignore']],
+                'syncname': group[0],
+                'rules': group,
+            }
+
+        return consolidated
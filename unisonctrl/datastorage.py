@@ -12,6 +12,8 @@ import os
 import glob
 import atexit
 
+from registry import InstanceRegistry
+
 
 class DataStorage():
     """DataStorage - store and retrieve files."""
@@ -19,18 +21,33 @@ class DataStorage():
     # data associated with each running unison instance
     running_data = {}
 
+    # running_data, indexed by instance name and PID
+    registry = None
+
+    # controller state which must survive between runs, but which does not
+    # describe a running unison instance (restart budgets, pending changes...)
+    state_data = {}
+
     # configuration values
     config = {}
 
     # Enables extra output
     DEBUG = False
 
-    def __init__(self, debug, config):
+    # Never create, change or delete files, for inspecting a running system
+    read_only = False
+
+    def __init__(self, debug, config, read_only=False):
         """Import configuration and running script data.
 
         Parameters
         ----------
-        none
+        1) bool
+            enables extra output
+        2) dict
+            unisonctrl configuration
+        3) bool
+            only read the stored data, and never write it back
 
         Returns
         -------
@@ -47,14 +64,22 @@ class DataStorage():
         # Pass along parent's debug status
         self.DEBUG = debug
 
+        # Each storage keeps its own data, so several sync roots can each
+        # have their own storage
+        self.running_data = {}
+
         # Import config from parent
         self.config = config
 
-        # Register exit handler
-        atexit.register(self.exit_handler)
+        self.read_only = read_only
+
+        # Register exit handler, which writes the data back
+        if not read_only:
+            atexit.register(self.exit_handler)
 
         # Get data associated with running unison instances
         self.read_data_from_filesystem()
+        self.registry = InstanceRegistry(self.running_data)
 
     def get_data(self, key):
         """Getter method for the data.
@@ -111,6 +136,7 @@ class DataStorage():
         """
         # Store the data to the array
         self.running_data[key] = data
+        self.registry.add(key, data)
 
         # Also store back to files, for data persistence
         self.write_running_data
@@ -139,6 +165,8 @@ class DataStorage():
         if key in self.running_data:
             del self.running_data[key]
 
+        self.registry.remove(key)
+
         # If file exists in filesystem, delete it
         file_to_remove = self.config['running_data_dir'] + os.sep + key + ".json"
 
@@ -148,53 +176,106 @@ class DataStorage():
         # Data has been removed from memory and filesystem
         return
 
-    def read_data_from_filesystem(self):
-        """Prepare UnisonHandler to manage unison instances.
+    def get_state(self, key, default=None):
+        """Getter method for controller state.
 
         Parameters
         ----------
+        1) str
+            key of the state to get
+        2) any
+            value to return if the key does not exist
+
+        Returns
+        -------
+        any
+            requested state (or default, if not existing)
+
+        Throws
+        -------
         none
 
+        """
+        if key in self.state_data:
+            return self.state_data[key]
+        else:
+            return default
+
+    def set_state(self, key, data):
+        """Setter method for controller state.
+
+        Unlike set_data, state is written back to the filesystem immediately,
+        since it is small and must not be lost if the run is interrupted.
+
+        Parameters
+        ----------
+        1) str
+            key of the state to store
+        2) any
+            json-serializable value of the state to store
+
         Returns
         -------
-        File data (also stores to self.running_data)
+        none
 
         Throws
         -------
         none
 
-        Doctests
+        """
+        self.state_data[key] = data
+
+        self.file_put_contents(
+            self.config['state_data_dir'] + os.sep + key + ".json",
+            json.dumps(data)
+        )
+
+    def remove_state(self, key):
+        """Remove controller state by key.
+
+        Parameters
+        ----------
+        1) str
+            key of the state to delete
+
+        Returns
         -------
+        none
+
+        Throws
+        -------
+        none
 
         """
-        # Ensure permissions are properly set before continuing
-        self.check_running_data_dir_permissions()
+        if key in self.state_data:
+            del self.state_data[key]
 
-        # Make dir for pid files, if config allows it
-        if (
-            (not os.path.exists(self.config['running_data_dir'])) and
-            (self.config['make_root_directories_if_not_found'])
-        ):
-            os.makedirs(self.config['running_data_dir'])
+        file_to_remove = self.config['state_data_dir'] + os.sep + key + ".json"
 
-        # If directory doesn't exist and config doesn't allow new ones to be
-        # created, throw exception
-        elif (not os.path.exists(self.config['running_data_dir'])):
-            raise IOError(
-                "The directory '" + self.config['running_data_dir'] + "' does not " +
-                "and auto-creation is disabled")
+        if os.path.isfile(file_to_remove):
+            os.remove(file_to_remove)
 
-        # Make directory for json files
-        if not os.path.exists(self.config['running_data_dir']):
-            os.makedirs(self.config['running_data_dir'])
+    def read_data_from_filesystem(self):
+        """Prepare UnisonHandler to manage unison instances.
 
-        # Make directory for unison logs
-        if not os.path.exists(self.config['unison_log_dir']):
-            os.makedirs(self.config['unison_log_dir'])
+        Parameters
+        ----------
+        none
 
-        # Make directory for unisonctrl logs
-        if not os.path.exists(self.config['unisonctrl_log_dir']):
-            os.makedirs(self.config['unisonctrl_log_dir'])
+        Returns
+        -------
+        File data (also stores to self.running_data)
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+
+        """
+        if not self.read_only:
+            self.make_data_directories()
 
         # Get files by extension
         json_data_files = glob.glob(
@@ -243,11 +324,101 @@ class DataStorage():
                     "invalid json"
                 )
 
+        # Controller state is stored the same way, in its own directory
+        self.read_state_from_filesystem()
+
         if(self.DEBUG):
             print("It appears the file data was successfully imported")
 
         return self.running_data
 
+    def make_data_directories(self):
+        """Create the data and log directories, if they do not exist.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        IOError if a directory is missing and may not be created
+
+        """
+        # Ensure permissions are properly set before continuing
+        self.check_running_data_dir_permissions()
+
+        # Make dir for pid files, if config allows it
+        if (
+            (not os.path.exists(self.config['running_data_dir'])) and
+            (self.config['make_root_directories_if_not_found'])
+        ):
+            os.makedirs(self.config['running_data_dir'])
+
+        # If directory doesn't exist and config doesn't allow new ones to be
+        # created, throw exception
+        elif (not os.path.exists(self.config['running_data_dir'])):
+            raise IOError(
+                "The directory '" + self.config['running_data_dir'] + "' does not " +
+                "and auto-creation is disabled")
+
+        # Make directory for json files
+        if not os.path.exists(self.config['running_data_dir']):
+            os.makedirs(self.config['running_data_dir'])
+
+        # Make directory for controller state
+        if not os.path.exists(self.config['state_data_dir']):
+            os.makedirs(self.config['state_data_dir'])
+
+        # Make directory for unison logs
+        if not os.path.exists(self.config['unison_log_dir']):
+            os.makedirs(self.config['unison_log_dir'])
+
+        # Make directory for unisonctrl logs
+        if not os.path.exists(self.config['unisonctrl_log_dir']):
+            os.makedirs(self.config['unisonctrl_log_dir'])
+
+    def read_state_from_filesystem(self):
+        """Import controller state from 'state_data_dir'.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        State data (also stores to self.state_data)
+
+        Throws
+        -------
+        none
+
+        """
+        self.state_data = {}
+
+        for json_state_filename in glob.glob(
+            self.config['state_data_dir'] + os.sep + "*.json"
+        ):
+            key = self.get_filename_from_path(json_state_filename)[:-5]
+
+            try:
+                self.state_data[key] = json.loads(
+                    self.file_get_contents(json_state_filename)
+                )
+            except ValueError:
+                # State is only advisory, so a corrupted file is discarded
+                # rather than stopping the whole run
+                if(self.DEBUG):
+                    print("Warning: corrupted json state in " + json_state_filename)
+
+                if not self.read_only:
+                    os.remove(json_state_filename)
+
+        return self.state_data
+
     def check_running_data_dir_permissions(self):
         """Check 'running_data_dir' to ensure proper permissions are set.
 
@@ -297,6 +468,9 @@ class DataStorage():
     def file_put_contents(self, filename, filecontent):
         """Small helper function to write a file.
 
+        The content is written to a temporary file first, which then replaces
+        the file, so a crash mid-write never leaves a truncated file behind.
+
         Parameters
         ----------
         1) str
@@ -313,14 +487,10 @@ class DataStorage():
         none
 
         """
-        # Open file descriptor
-        f = open(filename, "w")
-
-        # Write to file
-        f.write(filecontent)
+        with open(filename + ".tmp", "w") as f:
+            f.write(filecontent)
 
-        # Close file descriptor
-        f.close()
+        os.replace(filename + ".tmp", filename)
 
         return
 
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# This script measures how long changes take to reach the remote, end to end,
+# by writing canary files and watching for them on the remote side
+
+import os
+import shlex
+import subprocess
+import time
+
+from remoteshell import RemoteShell
+
+
+class LatencyProbe():
+    """LatencyProbe - measure the propagation latency of each sync instance.
+
+    Every continuous instance also syncs its own canary directory below the
+    local root. Every 'latency_probe_interval' seconds, a canary file named
+    after its write time is created there, and later runs look for it in the
+    remote root, through one batched command per remote. The latency is the
+    change time of the remote copy minus the write time, so the clocks of both
+    sides must agree. Observed canaries are removed again, and unison removes
+    the remote copies.
+    """
+
+    # Key used to persist pending probes and results in the data storage backend
+    STATE_KEY = "latency"
+
+    # Directory of the canary directories, relative to the roots
+    CANARY_DIR = ".unisonctrl-canaries"
+
+    # Latencies kept per rule
+    SAMPLE_LIMIT = 20
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger):
+        """Prepare the latency probe.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist pending probes and results
+        3) logging.Logger
+            logger to report latencies to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+        self.remote_shell = RemoteShell(config)
+
+    def get_remote_ctimes(self, remote, paths):
+        """Return the change times of canaries which reached a remote.
+
+        Parameters
+        ----------
+        1) dict
+            remote, from 'unison_remotes'
+        2) list[str]
+            canary paths, relative to the root
+
+        Returns
+        -------
+        dict
+            change time of each canary found, keyed by path, or None if the
+            remote could not be checked
+
+        Throws
+        -------
+        none
+
+        """
+        script = "cd -- " + shlex.quote(remote['root']) + " || exit 1\n" + "".join(
+            "find " + shlex.quote(path) + " -maxdepth 0 -printf '%p\\t%C@\\0' 2>/dev/null\n"
+            for path in paths
+        ) + "exit 0\n"
+
+        try:
+            result = subprocess.run(
+                self.remote_shell.get_command(remote, self.config['latency_probe_command']),
+                input=script.encode('utf-8'),
+                env=self.remote_shell.get_env(remote),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=self.config['latency_probe_timeout']
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+
+        if result.returncode != 0:
+            return None
+
+        ctimes = {}
+
+        for record in result.stdout.decode('utf-8', 'surrogateescape').split("\0"):
+            path, separator, ctime = record.rpartition("\t")
+
+            if separator != "":
+                ctimes[path] = float(ctime)
+
+        return ctimes
+
+    def record(self, results, rule, latency):
+        """Record the outcome of a probe.
+
+        Parameters
+        ----------
+        1) dict
+            results, keyed by rule
+        2) str
+            syncname of the rule
+        3) float
+            latency in seconds, or None if the canary never arrived
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        result = results.setdefault(rule, {'last': None, 'samples': [], 'timeouts': 0})
+
+        if latency is None:
+            result['timeouts'] += 1
+            return
+
+        result['last'] = round(latency, 3)
+        result['samples'] = (result['samples'] + [result['last']])[-self.SAMPLE_LIMIT:]
+
+    def remove_canary(self, path):
+        """Remove a local canary file.
+
+        Parameters
+        ----------
+        str
+            canary path, relative to the local root
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            os.remove(self.config['unison_local_root'] + os.sep + path)
+        except OSError:
+            pass
+
+    def check(self, running_data, remotes):
+        """Look for pending canaries on the remotes, and record latencies.
+
+        Parameters
+        ----------
+        1) dict
+            stored data of the running instances, keyed by instance name
+        2) dict
+            remotes, keyed by remote name
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.data_storage.get_state(self.STATE_KEY, {'pending': {}, 'results': {}})
+        now = time.time()
+
+        pending_by_remote = {}
+
+        for instance_name, probe in state['pending'].items():
+            pending_by_remote.setdefault(probe['remote'], []).append(instance_name)
+
+        for remote_name, instance_names in pending_by_remote.items():
+            ctimes = {}
+
+            if remote_name in remotes:
+                ctimes = self.get_remote_ctimes(
+                    remotes[remote_name], [state['pending'][x]['path'] for x in instance_names]
+                )
+
+                if ctimes is None:
+                    self.logger.warning("Checking latency probes on remote '" + remote_name + "' failed.")
+                    continue
+
+            for instance_name in instance_names:
+                probe = state['pending'][instance_name]
+
+                if probe['path'] in ctimes:
+                    latency = ctimes[probe['path']] - probe['written']
+                    self.record(state['results'], probe['rule'], latency)
+
+                    self.logger.debug(
+                        "Instance '%s' Change propagated in %s seconds.", instance_name, round(latency, 3),
+                        extra={'syncname': instance_name, 'phase': "probe", 'duration_ms': int(latency * 1000)}
+                    )
+
+                elif instance_name not in running_data or running_data[instance_name]['pid'] != probe['pid']:
+                    # The instance was restarted or killed, so the canary may
+                    # never arrive. This is not counted against the rule.
+                    pass
+
+                elif now - probe['written'] >= self.config['latency_probe_max_wait']:
+                    self.record(state['results'], probe['rule'], None)
+
+                    self.logger.warning(
+                        "Instance '" + instance_name + "' " +
+                        "Change did not propagate within " +
+                        str(self.config['latency_probe_max_wait']) + " seconds."
+                    )
+
+                else:
+                    continue
+
+                self.remove_canary(probe['path'])
+                del state['pending'][instance_name]
+
+        self.data_storage.set_state(self.STATE_KEY, state)
+
+    def start(self, running_data):
+        """Write canaries for instances which are due for a probe.
+
+        Parameters
+        ----------
+        dict
+            stored data of the running instances, keyed by instance name
+
+        Returns
+        -------
+        int
+            number of probes started
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.data_storage.get_state(self.STATE_KEY, {'pending': {}, 'results': {}})
+        last_probes = state.setdefault('last_probe', {})
+        now = time.time()
+        started = 0
+
+        for instance_name, instance_info in running_data.items():
+            if instance_info.get('mode', 'continuous') != 'continuous' or instance_name in state['pending']:
+                continue
+
+            if now - last_probes.get(instance_name, 0) < self.config['latency_probe_interval']:
+                continue
+
+            path = self.CANARY_DIR + "/" + instance_name + "/" + str(int(now * 1000))
+
+            try:
+                with open(self.config['unison_local_root'] + os.sep + path, 'w') as f:
+                    f.write(str(now) + "\n")
+            except OSError:
+                continue
+
+            state['pending'][instance_name] = {
+                'path': path,
+                'written': now,
+                'pid': instance_info['pid'],
+                'rule': instance_info.get('rule', instance_name),
+                'remote': instance_info.get('remote', ""),
+            }
+            last_probes[instance_name] = now
+            started += 1
+
+        # Forget instances and rules which are gone
+        state['last_probe'] = {k: v for k, v in last_probes.items() if k in running_data}
+        rules = set(x.get('rule', x['syncname']) for x in running_data.values())
+        state['results'] = {k: v for k, v in state['results'].items() if k in rules}
+
+        self.data_storage.set_state(self.STATE_KEY, state)
+
+        return started
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# This script formats unisonctrl log records as JSON lines, so the logs can be
+# searched and aggregated by instance, phase and duration
+
+import json
+import logging
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """JsonLinesFormatter - format each log record as one JSON object per line.
+
+    Besides the time, level and message, the structured fields below are
+    included when they were passed to the logger with 'extra'.
+    """
+
+    # Structured fields copied from the log record, if set
+    FIELDS = ('root', 'syncname', 'pid', 'phase', 'duration_ms')
+
+    def format(self, record):
+        """Format a log record as a JSON line.
+
+        Parameters
+        ----------
+        logging.LogRecord
+            record to format
+
+        Returns
+        -------
+        str
+            JSON object, without a trailing newline
+
+        Throws
+        -------
+        none
+
+        """
+        entry = {
+            'time': self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+
+        # Records from the log queue only hold the formatted traceback
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
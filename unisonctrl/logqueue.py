@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# This script queues unisonctrl log records for the listener thread, keeping
+# the traceback of a record apart from its message
+
+import copy
+import logging
+import logging.handlers
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """LogQueueHandler - queue log records without folding in their traceback.
+
+    The standard QueueHandler formats the traceback into the message, so the
+    handlers behind the listener only see text. Here the traceback is kept in
+    exc_text, which formatters print after the message, and the JSON lines
+    formatter stores as a field of its own.
+    """
+
+    # Formats the traceback of a record, like any logging.Formatter
+    exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        """Prepare a record for the queue.
+
+        The message is merged with its arguments, and the traceback is
+        formatted, so the record holds no references to objects which may
+        change or go away before the listener handles it.
+
+        Parameters
+        ----------
+        logging.LogRecord
+            record to queue
+
+        Returns
+        -------
+        logging.LogRecord
+            copy of the record to queue
+
+        Throws
+        -------
+        none
+
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
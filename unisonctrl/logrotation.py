@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# This script rotates the log files of the unison instances, which unison
+# itself appends to forever
+
+import os
+import subprocess
+import time
+
+
+class InstanceLogRotator():
+    """InstanceLogRotator - rotate, compress and expire unison instance logs.
+
+    Unison keeps its log file open, so a log is only rotated while no unison
+    process writes to it: right before an instance is started. Instances
+    which run for a long time are restarted once their log is due for
+    rotation, within the restart budget. Rotated segments are compressed by a
+    background gzip process, and removed once past the retention limits.
+    """
+
+    # Key used to persist when each log was started in the data storage backend
+    STATE_KEY = "instance-logs"
+
+    # Format of the timestamp appended to rotated segments, sorts by age
+    SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger):
+        """Prepare the log rotator.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist the age of each log
+        3) logging.Logger
+            logger to report rotations to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+
+    def get_logfile(self, instance_name):
+        """Return the path of the log file of an instance.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        str
+            path of the log file unison writes to
+
+        Throws
+        -------
+        none
+
+        """
+        return self.config['unison_log_dir'] + os.sep + instance_name + ".log"
+
+    def needs_rotation(self, instance_name):
+        """Check if the log of an instance is due for rotation.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        bool
+            True if the log is over 'instance_log_max_bytes', or older than
+            'instance_log_max_age'
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            size = os.stat(self.get_logfile(instance_name)).st_size
+        except OSError:
+            return False
+
+        if size == 0:
+            return False
+
+        if self.config['instance_log_max_bytes'] > 0 and size >= self.config['instance_log_max_bytes']:
+            return True
+
+        if self.config['instance_log_max_age'] > 0:
+            log_starts = self.data_storage.get_state(self.STATE_KEY, {})
+
+            # Logs from before rotation was enabled start counting now
+            if instance_name not in log_starts:
+                log_starts[instance_name] = time.time()
+                self.data_storage.set_state(self.STATE_KEY, log_starts)
+
+            return time.time() - log_starts[instance_name] >= self.config['instance_log_max_age']
+
+        return False
+
+    def get_segment_name(self, logfile):
+        """Return an unused name for a rotated segment of a log.
+
+        Segments rotated in the same second, like those of an instance which
+        keeps crashing, get a counter appended, so none is overwritten.
+
+        Parameters
+        ----------
+        str
+            path of the log file
+
+        Returns
+        -------
+        str
+            path of the segment, which exists neither plain nor compressed
+
+        Throws
+        -------
+        none
+
+        """
+        segment = logfile + "." + time.strftime(self.SEGMENT_TIME_FORMAT)
+        candidate = segment
+        counter = 0
+
+        while os.path.exists(candidate) or os.path.exists(candidate + ".gz"):
+            counter += 1
+            candidate = segment + "-" + str(counter)
+
+        return candidate
+
+    def rotate_if_needed(self, instance_name):
+        """Rotate the log of an instance, if it is due.
+
+        Must only be called while no unison process writes to the log.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        bool
+            True if the log was rotated
+
+        Throws
+        -------
+        none
+
+        """
+        if not self.needs_rotation(instance_name):
+            return False
+
+        logfile = self.get_logfile(instance_name)
+        segment = self.get_segment_name(logfile)
+
+        self.logger.info(
+            "Instance '" + instance_name + "' " +
+            "Rotating log file to '" + segment + "'."
+        )
+
+        os.replace(logfile, segment)
+
+        log_starts = self.data_storage.get_state(self.STATE_KEY, {})
+        log_starts[instance_name] = time.time()
+        self.data_storage.set_state(self.STATE_KEY, log_starts)
+
+        if self.config['instance_log_compress']:
+            self.compress(segment)
+
+        return True
+
+    def compress(self, segment):
+        """Compress a rotated segment in the background.
+
+        The gzip process is not waited for, so large logs do not hold up the
+        run. It replaces the segment with a '.gz' file once done.
+
+        Parameters
+        ----------
+        str
+            path of the rotated segment
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            subprocess.Popen(
+                ["nice", "-n", "19", "gzip", "-f", segment],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+
+        except OSError:
+            self.logger.warning(
+                "Could not start gzip to compress '" + segment + "', " +
+                "keeping it uncompressed."
+            )
+
+    def prune(self, instance_names):
+        """Remove rotated segments past the retention limits.
+
+        Keeps at most 'instance_log_backups' segments per instance, and none
+        older than 'instance_log_retention' seconds.
+
+        Parameters
+        ----------
+        set[str]
+            names of all instances which may still log
+
+        Returns
+        -------
+        int
+            number of segments removed
+
+        Throws
+        -------
+        none
+
+        """
+        if not os.path.isdir(self.config['unison_log_dir']):
+            return 0
+
+        now = time.time()
+        segments_by_instance = {}
+
+        for entry in os.scandir(self.config['unison_log_dir']):
+            name = entry.name
+
+            if name.endswith(".gz"):
+                name = name[:-len(".gz")]
+
+            instance_name, separator, timestamp = name.rpartition(".log.")
+
+            if separator == "" or not entry.is_file():
+                continue
+
+            segments_by_instance.setdefault(instance_name, []).append((timestamp, entry))
+
+        removed = 0
+
+        for instance_name, segments in segments_by_instance.items():
+            # Newest first, since the timestamps sort by age
+            segments.sort(key=lambda x: x[0], reverse=True)
+
+            for position, (timestamp, entry) in enumerate(segments):
+                expired = (
+                    self.config['instance_log_retention'] > 0 and
+                    now - entry.stat().st_mtime > self.config['instance_log_retention']
+                )
+
+                if position < self.config['instance_log_backups'] and not expired:
+                    continue
+
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+
+        if removed > 0:
+            self.logger.debug("Removed %s expired instance log segments.", removed)
+
+        # Forget log ages of instances which no longer exist
+        log_starts = self.data_storage.get_state(self.STATE_KEY, {})
+        kept_log_starts = {k: v for k, v in log_starts.items() if k in instance_names}
+
+        if len(kept_log_starts) != len(log_starts):
+            self.data_storage.set_state(self.STATE_KEY, kept_log_starts)
+
+        return removed
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# This script holds the changes a run would make to the unison instances, so
+# they can be previewed before they are applied
+
+
+class ReconcilePlan():
+    """ReconcilePlan - the instances a run would start, restart and kill.
+
+    A plan is computed from the config, the directory scan and the stored
+    instance data, without changing anything. Applying it is left to the
+    UnisonHandler, which still applies the restart budgets and admission
+    limits, so a plan is an upper bound of what a run does.
+    """
+
+    def __init__(self):
+        """Create an empty plan.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        # Directories of every instance which should exist, in rule order,
+        # keyed by instance name
+        self.instances = {}
+
+        # Names of every instance the sync rules may create, used to expire
+        # data of rules which were removed
+        self.all_instance_names = set()
+
+        # Running instances which are no longer needed
+        self.kill = []
+
+        # Instances which are not running, and may be started
+        self.start = []
+
+        # Instances which are not running, and wait out a crash backoff
+        self.backoff = []
+
+        # Running instances whose config changed, with the changed parts of
+        # the config, keyed by instance name
+        self.restart = {}
+
+        # Running instances whose config is unchanged
+        self.keep = []
+
+        # (instance name, sync rule) of the scheduled instances
+        self.scheduled = []
+
+        # Scheduled instances whose one-shot sync is still running
+        self.running_scheduled = []
+
+        # Scheduled instances which are due, and fit in the worker pool
+        self.due = []
+
+        # Instances started or restarted without an existing unison archive,
+        # which therefore rescan everything
+        self.cold = []
+
+        # Rules merged into shared instances while memory is short, keyed by
+        # the name of the shared instance
+        self.consolidated = {}
+
+        # Directories of the rules assigned to another host, keyed by
+        # syncname. Their leases are released once no instance syncs them.
+        self.released = {}
+
+        # Milliseconds taken by the directory scan of the sync rules
+        self.scan_ms = 0
+
+    def get_rescan_dirs(self):
+        """Return the number of directories unison rescans if applied.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        int
+            directories of all instances which are started or restarted
+
+        Throws
+        -------
+        none
+
+        """
+        return sum(
+            len(self.instances[x]['sync'])
+            for x in self.start + list(self.restart) + self.due
+        )
+
+    def to_dict(self):
+        """Return the plan as a json-serializable dict.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            the plan
+
+        Throws
+        -------
+        none
+
+        """
+        return {
+            'start': self.start,
+            'restart': self.restart,
+            'kill': self.kill,
+            'backoff': self.backoff,
+            'due': self.due,
+            'keep': self.keep,
+            'cold': self.cold,
+            'consolidated': self.consolidated,
+            'released': sorted(self.released),
+            'scan_ms': self.scan_ms,
+            'rescan_dirs': self.get_rescan_dirs(),
+        }
+
+    def format_text(self, prefix=""):
+        """Format the plan for the terminal.
+
+        Parameters
+        ----------
+        str
+            prefix of every line, like the name of the sync root
+
+        Returns
+        -------
+        str
+            one line per change, and a summary
+
+        Throws
+        -------
+        none
+
+        """
+        lines = [
+            "Plan for " + str(len(self.instances)) + " sync instances " +
+            "(directory scan took " + str(self.scan_ms) + " ms):"
+        ]
+
+        for instance_name in self.start:
+            lines.append(
+                "  start    " + instance_name + " (" +
+                str(len(self.instances[instance_name]['sync'])) + " dirs" +
+                (", no archive yet" if instance_name in self.cold else "") + ")"
+            )
+
+        for instance_name, changed in self.restart.items():
+            lines.append(
+                "  restart  " + instance_name + " (changed: " + ", ".join(changed) + ")"
+            )
+
+        for instance_name in self.kill:
+            lines.append("  kill     " + instance_name)
+
+        for instance_name in self.due:
+            lines.append("  run      " + instance_name + " (scheduled sync is due)")
+
+        for instance_name in self.backoff:
+            lines.append("  wait     " + instance_name + " (backing off after failures)")
+
+        for instance_name, syncnames in self.consolidated.items():
+            lines.append("  merge    " + ", ".join(syncnames) + " (memory is short)")
+
+        for syncname in self.released:
+            lines.append("  release  " + syncname + " (assigned to another host)")
+
+        lines.append(str(len(self.keep)) + " running instances unchanged.")
+        lines.append(
+            "Starts and restarts rescan " + str(self.get_rescan_dirs()) +
+            " directories, " + str(len(self.cold)) + " instances without an archive."
+        )
+
+        return "\n".join(prefix + line for line in lines)
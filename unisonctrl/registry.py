@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# This script indexes the running unison instances by name and PID, and tells
+# if a PID still belongs to the instance it was recorded for
+
+import psutil
+
+
+class InstanceRecord():
+    """InstanceRecord - identity of the process of one running instance.
+
+    A PID alone is not an identity, since PIDs are reused once a process
+    exits, and after a reboot. A process only belongs to the instance if its
+    start time matches the recorded one, and its command line carries the
+    label of the instance.
+    """
+
+    __slots__ = ('name', 'pid', 'create_time', 'label', 'info')
+
+    # Seconds the start time reported for a process may drift, since it is
+    # derived from the boot time, which moves with clock adjustments
+    CREATE_TIME_TOLERANCE = 1.0
+
+    def __init__(self, name, info):
+        """Create the record of an instance from its stored data.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            stored data of the instance
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.name = name
+        self.pid = int(info['pid'])
+
+        # Instances started by older versions have no recorded start time,
+        # and are identified by their label only
+        self.create_time = info.get('create_time')
+
+        # Instances started by older versions have no recorded label, which
+        # was always made from the instance name
+        self.label = "-label=" + info.get('label', "unisonctrl-" + name)
+        self.info = info
+
+    def get_process(self):
+        """Return the process of the instance, if it is still running.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        psutil.Process
+            the process, or None if the PID is gone or now belongs to another
+            process
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            proc = psutil.Process(self.pid)
+
+            if (
+                self.create_time is not None and
+                abs(proc.create_time() - self.create_time) > self.CREATE_TIME_TOLERANCE
+            ):
+                return None
+
+            if self.label not in proc.cmdline():
+                return None
+
+            # A process which exited, but was not reaped yet, is gone too
+            if proc.status() == psutil.STATUS_ZOMBIE:
+                return None
+
+        except psutil.Error:
+            return None
+
+        return proc
+
+    def is_running(self):
+        """Check if the process of the instance is still running.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        bool
+            True if the recorded process is running
+
+        Throws
+        -------
+        none
+
+        """
+        return self.get_process() is not None
+
+
+class InstanceRegistry():
+    """InstanceRegistry - running instances, indexed by name and by PID."""
+
+    def __init__(self, running_data=None):
+        """Index the stored data of the running instances.
+
+        Parameters
+        ----------
+        dict
+            stored data of the running instances, keyed by instance name
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.by_name = {}
+        self.by_pid = {}
+
+        for name, info in (running_data or {}).items():
+            self.add(name, info)
+
+    def add(self, name, info):
+        """Add or replace the record of an instance.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            stored data of the instance
+
+        Returns
+        -------
+        InstanceRecord
+            the new record
+
+        Throws
+        -------
+        none
+
+        """
+        self.remove(name)
+
+        record = InstanceRecord(name, info)
+        self.by_name[name] = record
+        self.by_pid[record.pid] = record
+
+        return record
+
+    def remove(self, name):
+        """Remove the record of an instance, if there is one.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        record = self.by_name.pop(name, None)
+
+        if record is not None and self.by_pid.get(record.pid) is record:
+            del self.by_pid[record.pid]
+
+    def get(self, name):
+        """Return the record of an instance by name.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        InstanceRecord
+            the record, or None if the instance is not running
+
+        Throws
+        -------
+        none
+
+        """
+        return self.by_name.get(name)
+
+    def get_by_pid(self, pid):
+        """Return the record of an instance by PID.
+
+        Parameters
+        ----------
+        int
+            PID of the unison process
+
+        Returns
+        -------
+        InstanceRecord
+            the record, or None if no instance was started with this PID
+
+        Throws
+        -------
+        none
+
+        """
+        return self.by_pid.get(int(pid))
+
+    def get_records(self):
+        """Return the records of all instances.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        list[InstanceRecord]
+            all records
+
+        Throws
+        -------
+        none
+
+        """
+        return list(self.by_name.values())
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# This script lists the directories of the remote roots, so the sync rules see
+# new remote directories before unison has copied them to the local root
+
+import fnmatch
+import glob
+import os
+import shlex
+import subprocess
+
+from remoteshell import RemoteShell
+
+
+class RemoteListing():
+    """RemoteListing - cached listing of the selector parents on each remote.
+
+    The parent of a "dir_selector" (like 'Art Department' for
+    'Art Department/11*') is listed on every remote by one batched shell
+    script per run, sent to 'remote_listing_command' (ssh to the remote by
+    default), which is told the remote it runs for by environment variables.
+    The script only lists parents whose modification time changed
+    since the cached listing, so an unchanged remote costs one round trip and
+    a few bytes. The remote needs a POSIX shell and GNU find.
+    """
+
+    # Key used to persist the cached listings in the data storage backend
+    STATE_KEY = "remote-listing"
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger, read_only=False):
+        """Prepare the remote listing.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist the cached listings
+        3) logging.Logger
+            logger to report failed listings to
+        4) bool
+            if True, refreshed listings are not saved. Listings are loaded by
+            refresh().
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+        self.read_only = read_only
+        self.remote_shell = RemoteShell(config)
+
+        # Listings of each remote, keyed by remote name, then by parent
+        self.listings = {}
+
+    def split_selector(self, dir_selector):
+        """Split a directory selector into the parent to list, and a pattern.
+
+        Parameters
+        ----------
+        str
+            "dir_selector" of a sync rule
+
+        Returns
+        -------
+        tuple
+            (parent, pattern of the directory names), or None if the parent
+            contains wildcards, and can not be listed in one go
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> RL = RemoteListing({}, None, None)
+
+        >>> RL.split_selector("Art Department/11*")
+        ('Art Department', '11*')
+
+        >>> RL.split_selector("*")
+        ('.', '*')
+
+        >>> RL.split_selector("*/11*") is None
+        True
+
+        """
+        parent, separator, pattern = dir_selector.strip().rstrip("/").rpartition("/")
+
+        if glob.has_magic(parent):
+            return None
+
+        return (parent if parent != "" else ".", pattern)
+
+    def get_script(self, remote, parents):
+        """Return the shell script listing the changed parents on a remote.
+
+        The script prints NUL terminated records: 'U<tab>parent' for an
+        unchanged parent, 'P<tab>parent<tab>mtime' for a changed one,
+        followed by 'D<tab>name' for each of its subdirectories.
+
+        Parameters
+        ----------
+        1) dict
+            remote, from 'unison_remotes'
+        2) list[str]
+            parents to list, relative to the remote root
+
+        Returns
+        -------
+        str
+            the script
+
+        Throws
+        -------
+        none
+
+        """
+        cached = self.listings.get(remote['name'], {})
+
+        lines = [
+            "cd -- " + shlex.quote(remote['root']) + " || exit 1",
+            "list() {",
+            "  m=$(find \"$1\" -maxdepth 0 -printf '%T@' 2>/dev/null)",
+            "  [ -n \"$m\" ] || return 0",
+            "  if [ \"$m\" = \"$2\" ]; then printf 'U\\t%s\\0' \"$1\"; return 0; fi",
+            "  printf 'P\\t%s\\t%s\\0' \"$1\" \"$m\"",
+            "  find \"$1\" -mindepth 1 -maxdepth 1 -type d -printf 'D\\t%f\\0'",
+            "}",
+        ]
+
+        for parent in parents:
+            lines.append(
+                "list " + shlex.quote(parent) + " " +
+                shlex.quote(cached.get(parent, {}).get('mtime', ""))
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def parse_output(self, output, cached):
+        """Parse the output of the listing script.
+
+        Parameters
+        ----------
+        1) bytes
+            output of the script
+        2) dict
+            cached listing of the remote, keyed by parent
+
+        Returns
+        -------
+        dict
+            listing of the remote, keyed by parent. Parents which no longer
+            exist are left out.
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> RL = RemoteListing({}, None, None)
+
+        >>> RL.parse_output(b"U\\ta\\0P\\tb\\t5.0\\0D\\tx\\0", {'a': {'mtime': "1.0", 'dirs': ["y"]}})
+        {'a': {'mtime': '1.0', 'dirs': ['y']}, 'b': {'mtime': '5.0', 'dirs': ['x']}}
+
+        """
+        listing = {}
+        current = None
+
+        for record in output.decode('utf-8', 'surrogateescape').split("\0"):
+            kind, separator, value = record.partition("\t")
+
+            if kind == "U" and value in cached:
+                listing[value] = cached[value]
+                current = None
+
+            elif kind == "P":
+                parent, separator, mtime = value.rpartition("\t")
+                current = {'mtime': mtime, 'dirs': []}
+                listing[parent] = current
+
+            elif kind == "D" and current is not None:
+                current['dirs'].append(value)
+
+        return listing
+
+    def refresh(self, dir_selectors):
+        """List the parents of the selectors on every remote.
+
+        A remote which can not be listed keeps its cached listing.
+
+        Parameters
+        ----------
+        list[str]
+            "dir_selector" of every sync rule
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        parents = sorted(set(
+            x[0] for x in map(self.split_selector, dir_selectors) if x is not None
+        ))
+
+        self.listings = dict(self.data_storage.get_state(self.STATE_KEY, {}))
+
+        for remote in self.config['unison_remotes']:
+            try:
+                result = subprocess.run(
+                    self.remote_shell.get_command(remote, self.config['remote_listing_command']),
+                    input=self.get_script(remote, parents).encode('utf-8'),
+                    env=self.remote_shell.get_env(remote),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    timeout=self.config['remote_listing_timeout']
+                )
+
+            except (OSError, subprocess.TimeoutExpired) as e:
+                self.logger.warning(
+                    "Listing remote '" + remote['name'] + "' failed, using " +
+                    "the cached listing: " + str(e)
+                )
+                continue
+
+            if result.returncode != 0:
+                self.logger.warning(
+                    "Listing remote '" + remote['name'] + "' failed with exit code " +
+                    str(result.returncode) + ", using the cached listing: " +
+                    result.stderr.decode('utf-8', 'replace').strip()
+                )
+                continue
+
+            self.listings[remote['name']] = self.parse_output(
+                result.stdout, self.listings.get(remote['name'], {})
+            )
+
+        # Forget remotes which were removed from the config
+        self.listings = {
+            x['name']: self.listings[x['name']]
+            for x in self.config['unison_remotes'] if x['name'] in self.listings
+        }
+
+        if not self.read_only and self.listings != self.data_storage.get_state(self.STATE_KEY, {}):
+            self.data_storage.set_state(self.STATE_KEY, self.listings)
+
+    def get_dirs(self, dir_selector):
+        """Return the remote directories matching a selector.
+
+        Parameters
+        ----------
+        str
+            "dir_selector" of a sync rule
+
+        Returns
+        -------
+        list[str]
+            local paths of the matching directories on any remote
+
+        Throws
+        -------
+        none
+
+        """
+        split = self.split_selector(dir_selector)
+
+        if split is None:
+            return []
+
+        parent, pattern = split
+        prefix = self.config['unison_local_root'] + os.sep
+
+        if parent != ".":
+            prefix += parent + os.sep
+
+        dirs = set()
+
+        for listing in self.listings.values():
+            for name in listing.get(parent, {}).get('dirs', []):
+                # Like glob, wildcards do not match hidden directories
+                if name.startswith(".") and not pattern.startswith("."):
+                    continue
+
+                if fnmatch.fnmatchcase(name, pattern):
+                    dirs.add(prefix + name)
+
+        return sorted(dirs)
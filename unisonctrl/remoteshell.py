@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# This script runs shell scripts on the remotes, for the helpers which look
+# at the remote side directly instead of through unison
+
+import os
+import shlex
+
+
+class RemoteShell():
+    """RemoteShell - the command and environment to run a script on a remote.
+
+    By default, the script is read by "sh -s" over ssh, with the keyfile of
+    the remote. A configured command replaces ssh for every remote, so it is
+    told which remote to run on by environment variables.
+    """
+
+    def __init__(self, config):
+        """Prepare the remote shell.
+
+        Parameters
+        ----------
+        dict
+            unisonctrl configuration
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+
+    def get_ssh_command(self, remote):
+        """Return the ssh command which connects to a remote.
+
+        Parameters
+        ----------
+        dict
+            remote, from 'unison_remotes'
+
+        Returns
+        -------
+        list[str]
+            ssh and its arguments, up to the host
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> RS = RemoteShell({})
+
+        >>> RS.get_ssh_command({'ssh_conn': "user@host", 'ssh_keyfile': "/keys/id"})
+        ['ssh', '-o', 'BatchMode=yes', '-i', '/keys/id', 'user@host']
+
+        """
+        cmd = ["ssh", "-o", "BatchMode=yes"]
+
+        if remote['ssh_keyfile'] != "":
+            cmd += ["-i", remote['ssh_keyfile']]
+
+        return cmd + [remote['ssh_conn']]
+
+    def get_command(self, remote, command=""):
+        """Return the command which reads a shell script from stdin on a remote.
+
+        Parameters
+        ----------
+        1) dict
+            remote, from 'unison_remotes'
+        2) str
+            configured command replacing ssh, or "" for ssh
+
+        Returns
+        -------
+        list[str]
+            the command
+
+        Throws
+        -------
+        none
+
+        """
+        if command != "":
+            return shlex.split(command)
+
+        return self.get_ssh_command(remote) + ["sh", "-s"]
+
+    def get_env(self, remote):
+        """Return the environment of the command of a remote.
+
+        Parameters
+        ----------
+        dict
+            remote, from 'unison_remotes'
+
+        Returns
+        -------
+        dict
+            environment variables, with the remote in UNISONCTRL_REMOTE_NAME,
+            UNISONCTRL_REMOTE_SSH_CONN and UNISONCTRL_REMOTE_ROOT
+
+        Throws
+        -------
+        none
+
+        """
+        env = dict(os.environ)
+        env['UNISONCTRL_REMOTE_NAME'] = remote['name']
+        env['UNISONCTRL_REMOTE_SSH_CONN'] = remote['ssh_conn']
+        env['UNISONCTRL_REMOTE_ROOT'] = remote['root']
+
+        return env
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+# This script decides when a running unison instance is allowed to be
+# restarted, so that bursts of directory changes do not cause restart storms,
+# and when an instance which keeps crashing is allowed to be started again
+
+import random
+import time
+
+
+class RestartPolicy():
+    """RestartPolicy - rate limit and debounce sync instance restarts."""
+
+    # Key used to persist the policy state in the data storage backend
+    STATE_KEY = "restart-policy"
+
+    # configuration values
+    config = {}
+
+    # Apply config changes without waiting for transfers to finish
+    urgent = False
+
+    def __init__(self, config, data_storage, logger, urgent=False):
+        """Prepare the restart policy.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist pending changes across runs
+        3) logging.Logger
+            logger to report deferred restarts to
+        4) bool
+            restart instances with changed config even if they are busy
+            transferring (the restart budgets still apply)
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+        self.urgent = urgent
+
+    def get_policy_state(self):
+        """Return the persisted policy state, creating it if needed.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            ['pending'] - pending changes, keyed by instance name
+            ['history'] - timestamps of recent restarts, for the global budget
+            ['failures'] - consecutive fast failures, keyed by instance name
+            ['restarts'] - time and reason of the last restart, keyed by
+            instance name
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.data_storage.get_state(self.STATE_KEY)
+
+        if state is None:
+            state = {'pending': {}, 'history': []}
+
+        state.setdefault('failures', {})
+        state.setdefault('restarts', {})
+
+        return state
+
+    def get_rule_setting(self, rule, key, config_key):
+        """Return a per-rule override of a setting, or the global setting.
+
+        Parameters
+        ----------
+        1) dict
+            sync rule (may be None)
+        2) str
+            key of the per-rule override
+        3) str
+            key of the global config setting
+
+        Returns
+        -------
+        int
+            effective value of the setting
+
+        Throws
+        -------
+        none
+
+        """
+        if rule is not None and key in rule:
+            return rule[key]
+
+        return self.config[config_key]
+
+    def check_restart(self, instance_name, config_hash, instance_info, rule,
+                      changed_components=(), transferring=False):
+        """Decide if an instance with a changed config may be restarted now.
+
+        If the restart is not allowed yet, the change is queued in the
+        persisted state, and will be reconsidered on the next run.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) str
+            hash of the newly requested config
+        3) dict
+            stored data of the running instance
+        4) dict
+            sync rule the instance was created from (may be None)
+        5) list[str]
+            names of the changed config components
+        6) bool
+            True if the instance is busy propagating changes
+
+        Returns
+        -------
+        bool
+            True if the instance may be restarted now
+            False if the restart has been deferred
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        state = self.get_policy_state()
+        pending = state['pending'].get(instance_name)
+
+        # Queue the change, or refresh it if the config changed again since
+        if pending is None:
+            pending = {'config_hash': config_hash, 'first_seen': now, 'last_changed': now}
+            state['pending'][instance_name] = pending
+            self.data_storage.set_state(self.STATE_KEY, state)
+
+        elif pending['config_hash'] != config_hash:
+            pending['config_hash'] = config_hash
+            pending['last_changed'] = now
+            self.data_storage.set_state(self.STATE_KEY, state)
+
+        # Let bursts of changes settle, but not forever
+        debounce = self.get_rule_setting(rule, 'restart_debounce', 'restart_debounce')
+        settled = (now - pending['last_changed']) >= debounce
+        overdue = (now - pending['first_seen']) >= self.config['restart_debounce_max']
+
+        if not settled and not overdue:
+            self.logger.debug(
+                "Instance '%s' Config change queued, waiting for changes to settle.",
+                instance_name
+            )
+            return False
+
+        # Do not throw away a partial transfer, unless the change is urgent
+        # or has waited long enough
+        max_defer = self.get_rule_setting(rule, 'restart_max_defer', 'restart_max_defer')
+        urgent = self.urgent or any(
+            x in self.config['urgent_restart_components'] for x in changed_components
+        )
+
+        if transferring and not urgent and (now - pending['first_seen']) < max_defer:
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                "Config change queued, instance is transferring. Restarting " +
+                "once idle, or in at most " +
+                str(int(max_defer - (now - pending['first_seen']))) + "s."
+            )
+            return False
+
+        return self.check_budget(instance_name, instance_info, rule, "Config change queued")
+
+    def check_budget(self, instance_name, instance_info, rule, postponed_message):
+        """Check if the restart budgets allow restarting an instance now.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            stored data of the running instance
+        3) dict
+            sync rule the instance was created from (may be None)
+        4) str
+            start of the message logged if the restart has to wait
+
+        Returns
+        -------
+        bool
+            True if the instance may be restarted now
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        state = self.get_policy_state()
+
+        # Give each instance time to finish its initial scan
+        min_interval = self.get_rule_setting(
+            rule, 'restart_min_interval', 'instance_restart_min_interval'
+        )
+        uptime = now - instance_info.get('start_time', 0)
+
+        if uptime < min_interval:
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                postponed_message + ", instance was started " +
+                str(int(uptime)) + "s ago."
+            )
+            return False
+
+        # Finally, ensure the global restart budget is not used up
+        window_start = now - self.config['global_restart_window']
+        recent_restarts = [x for x in state['history'] if x >= window_start]
+
+        if len(recent_restarts) >= self.config['global_restart_limit']:
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                postponed_message + ", global restart budget of " +
+                str(self.config['global_restart_limit']) + " restarts per " +
+                str(self.config['global_restart_window']) + "s is used up."
+            )
+            return False
+
+        return True
+
+    def record_restart(self, instance_name, reason):
+        """Record that an instance has been restarted.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance which was restarted
+        2) str
+            why the instance was restarted
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        state = self.get_policy_state()
+
+        state['pending'].pop(instance_name, None)
+
+        # Only keep history which is still inside the budget window
+        window_start = now - self.config['global_restart_window']
+        state['history'] = [x for x in state['history'] if x >= window_start]
+        state['history'].append(now)
+
+        state['restarts'][instance_name] = {'time': now, 'reason': reason}
+
+        self.data_storage.set_state(self.STATE_KEY, state)
+
+    def clear_pending(self, instance_name):
+        """Forget a queued change, if any.
+
+        Used when the requested config returns to the running config, or when
+        the instance is no longer needed.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.get_policy_state()
+
+        if instance_name in state['pending']:
+            del state['pending'][instance_name]
+            self.data_storage.set_state(self.STATE_KEY, state)
+
+    def record_exit(self, instance_info):
+        """Record that an instance exited unexpectedly.
+
+        An instance which exited within 'crash_fast_failure_time' of its start
+        is failing, and is only started again after an exponential backoff.
+        After 'crash_quarantine_after' consecutive fast failures, it is
+        quarantined for 'crash_quarantine_time'.
+
+        Parameters
+        ----------
+        dict
+            stored data of the instance which exited
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        instance_name = instance_info['syncname']
+        state = self.get_policy_state()
+
+        # Exit is only noticed on a later run, so this is an upper bound
+        uptime = now - instance_info.get('start_time', 0)
+
+        if uptime >= self.config['crash_fast_failure_time']:
+            # Ran fine for a while, this is not a crash loop
+            if state['failures'].pop(instance_name, None) is not None:
+                self.data_storage.set_state(self.STATE_KEY, state)
+            return
+
+        failure = state['failures'].setdefault(instance_name, {'count': 0})
+        failure['count'] += 1
+        failure['last_failure'] = now
+
+        if failure['count'] >= self.config['crash_quarantine_after']:
+            failure['quarantined'] = True
+            failure['next_attempt'] = now + self.config['crash_quarantine_time']
+
+            self.logger.error(
+                "Instance '" + instance_name + "' " +
+                "Exited within " + str(int(uptime)) + "s of starting, " +
+                str(failure['count']) + " times in a row. Quarantined for " +
+                str(self.config['crash_quarantine_time']) + "s.",
+                extra={'syncname': instance_name, 'pid': instance_info['pid'], 'phase': "crash"}
+            )
+
+        else:
+            # Double the delay with every failure, with jitter so instances
+            # which fail together (like when the remote is down) spread out
+            backoff = min(
+                self.config['crash_backoff_base'] * 2 ** (failure['count'] - 1),
+                self.config['crash_backoff_max']
+            )
+            backoff *= 1 + random.uniform(0, self.config['crash_backoff_jitter'])
+            failure['next_attempt'] = now + backoff
+
+            self.logger.warning(
+                "Instance '" + instance_name + "' " +
+                "Exited within " + str(int(uptime)) + "s of starting. " +
+                "Starting again in " + str(int(backoff)) + "s.",
+                extra={'syncname': instance_name, 'pid': instance_info['pid'], 'phase': "crash"}
+            )
+
+        self.data_storage.set_state(self.STATE_KEY, state)
+
+    def record_healthy(self, instance_name, instance_info):
+        """Reset the failure count of an instance which keeps running.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            stored data of the running instance
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.get_policy_state()
+
+        if instance_name not in state['failures']:
+            return
+
+        uptime = time.time() - instance_info.get('start_time', 0)
+
+        if uptime >= self.config['crash_fast_failure_time']:
+            del state['failures'][instance_name]
+            self.data_storage.set_state(self.STATE_KEY, state)
+
+    def check_start(self, instance_name):
+        """Decide if an instance which is not running may be started now.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        bool
+            True if the instance may be started
+            False if it is backing off after failures, or quarantined
+
+        Throws
+        -------
+        none
+
+        """
+        failure = self.get_policy_state()['failures'].get(instance_name)
+
+        if failure is None:
+            return True
+
+        remaining = failure['next_attempt'] - time.time()
+
+        if remaining <= 0:
+            return True
+
+        if failure.get('quarantined', False):
+            self.logger.debug(
+                "Instance '%s' Quarantined after %s failures, not starting " +
+                "for another %ss.",
+                instance_name, failure['count'], int(remaining)
+            )
+        else:
+            self.logger.debug(
+                "Instance '%s' Backing off after %s failures, not starting " +
+                "for another %ss.",
+                instance_name, failure['count'], int(remaining)
+            )
+
+        return False
+
+    def prune_failures(self, instance_names):
+        """Forget failures, restarts and queued changes of instances which no longer exist.
+
+        Parameters
+        ----------
+        set[str]
+            names of all instances which may still be started
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        state = self.get_policy_state()
+        failures = {k: v for k, v in state['failures'].items() if k in instance_names}
+        restarts = {k: v for k, v in state['restarts'].items() if k in instance_names}
+        pending = {k: v for k, v in state['pending'].items() if k in instance_names}
+
+        if (
+            len(failures) != len(state['failures']) or
+            len(restarts) != len(state['restarts']) or
+            len(pending) != len(state['pending'])
+        ):
+            state['failures'] = failures
+            state['restarts'] = restarts
+            state['pending'] = pending
+            self.data_storage.set_state(self.STATE_KEY, state)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# This script decides which 'scheduled' sync rules are due to run, for rules
+# which do not need a permanently running unison instance
+
+import os
+import time
+
+
+class SyncScheduler():
+    """SyncScheduler - run one-shot syncs of scheduled rules in a bounded pool.
+
+    Scheduled rules do not keep a resident unison process. Instead, each run
+    of unisonctrl starts a non-repeating unison for the rules which are due,
+    most overdue first, as long as a worker slot is free. The one-shot
+    processes are tracked in the data storage like any other instance, and
+    their slot frees up when they exit.
+    """
+
+    # Key used to persist run times in the data storage backend
+    STATE_KEY = "schedule"
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger):
+        """Prepare the scheduler.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist run times across runs
+        3) logging.Logger
+            logger to report scheduling decisions to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+
+    def is_scheduled(self, rule):
+        """Check if a sync rule runs in scheduled mode.
+
+        Parameters
+        ----------
+        dict
+            sync rule (may be None)
+
+        Returns
+        -------
+        bool
+            True if the rule runs one-shot syncs on an interval
+
+        Throws
+        -------
+        none
+
+        """
+        return rule is not None and rule.get('mode', 'continuous') == 'scheduled'
+
+    def get_worker_count(self):
+        """Return the number of one-shot syncs which may run at once.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        int
+            size of the worker pool
+
+        Throws
+        -------
+        none
+
+        """
+        if self.config['scheduled_workers'] > 0:
+            return self.config['scheduled_workers']
+
+        return os.cpu_count() or 1
+
+    def get_due_instances(self, instances, running_instances):
+        """Return the scheduled instances to start now, most overdue first.
+
+        Parameters
+        ----------
+        1) list[tuple]
+            (instance name, sync rule) of the scheduled instances which have
+            directories to sync
+        2) list[str]
+            names of the one-shot syncs which are still running
+
+        Returns
+        -------
+        list[str]
+            names of the instances to start, limited to the free worker slots
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        schedule = self.data_storage.get_state(self.STATE_KEY, {})
+        free_slots = self.get_worker_count() - len(running_instances)
+
+        due = []
+
+        for order, (instance_name, rule) in enumerate(instances):
+            if instance_name in running_instances:
+                continue
+
+            last_start = schedule.get(instance_name, {}).get('last_start', 0)
+            overdue = now - (last_start + rule['interval'])
+
+            if overdue >= 0:
+                # Sort by most overdue, then by rule order
+                due.append((-overdue, order, instance_name))
+
+        due.sort()
+
+        if len(due) > free_slots:
+            self.logger.info(
+                str(len(due) - max(free_slots, 0)) + " scheduled syncs are " +
+                "due, but waiting for a free worker."
+            )
+
+        return [entry[2] for entry in due[:max(free_slots, 0)]]
+
+    def get_unison_options(self, options):
+        """Return the unison options for a one-shot run.
+
+        Parameters
+        ----------
+        list[str]
+            unison options of a continuous instance
+
+        Returns
+        -------
+        list[str]
+            options with '-repeat' removed, so unison exits after one sync
+
+        Throws
+        -------
+        none
+
+        """
+        return [x for x in options if not x.startswith("-repeat")]
+
+    def record_start(self, instance_name):
+        """Record that a one-shot sync has been started.
+
+        Parameters
+        ----------
+        str
+            name of the scheduled instance
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        schedule = self.data_storage.get_state(self.STATE_KEY, {})
+        schedule.setdefault(instance_name, {})['last_start'] = time.time()
+        self.data_storage.set_state(self.STATE_KEY, schedule)
+
+    def record_finish(self, instance_info):
+        """Record that a one-shot sync has exited.
+
+        Parameters
+        ----------
+        dict
+            stored data of the one-shot instance
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        schedule = self.data_storage.get_state(self.STATE_KEY, {})
+        entry = schedule.setdefault(instance_info['syncname'], {})
+
+        # Exit is only noticed on the next run, so this is an upper bound
+        entry['last_finish'] = now
+        entry['last_duration'] = now - instance_info.get('start_time', now)
+
+        self.data_storage.set_state(self.STATE_KEY, schedule)
+
+        self.logger.debug(
+            "Scheduled sync '%s' finished after at most %ss.",
+            instance_info['syncname'], int(entry['last_duration']),
+            extra={
+                'syncname': instance_info['syncname'],
+                'pid': instance_info['pid'],
+                'phase': "scheduled",
+                'duration_ms': int(entry['last_duration'] * 1000),
+            }
+        )
+
+    def prune(self, instance_names):
+        """Drop run times of instances whose rule no longer exists.
+
+        Parameters
+        ----------
+        set[str]
+            names of the instances of all current rules
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        schedule = self.data_storage.get_state(self.STATE_KEY, {})
+        pruned = {k: v for k, v in schedule.items() if k in instance_names}
+
+        if pruned != schedule:
+            self.data_storage.set_state(self.STATE_KEY, pruned)
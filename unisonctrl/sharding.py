@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+
+# This script splits the sync rules between several unisonctrl hosts, using
+# lease files in a directory shared by all of them
+
+import json
+import os
+import time
+
+
+class ShardCoordinator():
+    """ShardCoordinator - claim sync rules through leases in a shared directory.
+
+    Every run, each host writes a heartbeat, and computes the same assignment
+    of rules to the live hosts, balanced by the measured cost of each rule.
+    A host only runs the rules it holds a lease for. Leases are renewed every
+    run, released when the assignment moves a rule to another host and the
+    host stopped its instances, and taken over once they expire, for example
+    when a host goes down. Released and expired leases keep the measured cost
+    of their rule.
+    """
+
+    # Lowest cost of a rule, so idle rules are still spread by count
+    MIN_COST = 0.01
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, logger, read_only=False):
+        """Prepare the shard coordinator.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) logging.Logger
+            logger to report lease changes to
+        3) bool
+            only read the leases, for previewing a run
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.logger = logger
+        self.node = config['shard_node_name']
+
+        self.nodes_dir = config['shard_state_dir'] + os.sep + "nodes"
+        self.leases_dir = config['shard_state_dir'] + os.sep + "leases"
+
+        # Rules assigned to another host, which this host still holds until
+        # their instances are stopped
+        self.releasing = set()
+
+        if read_only:
+            return
+
+        for directory in (self.nodes_dir, self.leases_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def read_json(self, filename):
+        """Read a json file from the shared directory.
+
+        Parameters
+        ----------
+        str
+            path of the file
+
+        Returns
+        -------
+        dict
+            file content, or None if missing or half written
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_json(self, filename, data):
+        """Atomically write a json file to the shared directory.
+
+        Parameters
+        ----------
+        1) str
+            path of the file
+        2) dict
+            content to write
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        tmp_filename = filename + "." + self.node + ".tmp"
+
+        with open(tmp_filename, "w") as f:
+            json.dump(data, f)
+
+        os.replace(tmp_filename, filename)
+
+    def get_lease_file(self, syncname):
+        """Return the path of the lease file of a rule.
+
+        Parameters
+        ----------
+        str
+            syncname of the rule
+
+        Returns
+        -------
+        str
+            path of the lease file
+
+        Throws
+        -------
+        none
+
+        """
+        return self.leases_dir + os.sep + syncname + ".json"
+
+    def heartbeat(self):
+        """Record that this host is alive, and return all live hosts.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        list[str]
+            sorted names of the hosts with a recent heartbeat
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+
+        self.write_json(
+            self.nodes_dir + os.sep + self.node + ".json",
+            {'node': self.node, 'heartbeat': now}
+        )
+
+        live_nodes = []
+
+        for entry in os.scandir(self.nodes_dir):
+            if not entry.name.endswith(".json"):
+                continue
+
+            node_info = self.read_json(entry.path)
+
+            if node_info is not None and now - node_info['heartbeat'] < self.config['shard_lease_ttl']:
+                live_nodes.append(node_info['node'])
+
+        return sorted(live_nodes)
+
+    def get_rule_costs(self, syncnames, leases):
+        """Return the cost of each rule, as last measured by its owner.
+
+        Rules which were never measured get the median cost of the others.
+        No rule costs less than MIN_COST.
+
+        Parameters
+        ----------
+        1) list[str]
+            syncnames of all rules
+        2) dict
+            current lease of each rule (or None)
+
+        Returns
+        -------
+        dict
+            cost of each rule, keyed by syncname
+
+        Throws
+        -------
+        none
+
+        """
+        measured = sorted(
+            max(leases[x]['cost'], self.MIN_COST) for x in syncnames
+            if leases[x] is not None and leases[x].get('cost') is not None
+        )
+
+        if len(measured) > 0:
+            default_cost = measured[len(measured) // 2]
+        else:
+            default_cost = 1.0
+
+        costs = {}
+
+        for syncname in syncnames:
+            lease = leases[syncname]
+
+            if lease is not None and lease.get('cost') is not None:
+                costs[syncname] = max(lease['cost'], self.MIN_COST)
+            else:
+                costs[syncname] = default_cost
+
+        return costs
+
+    def get_assignment(self, syncnames, leases, live_nodes):
+        """Assign every rule to a live host, balancing the total cost.
+
+        Every host computes the same assignment from the same shared state.
+        Rules stay with their current owner while that keeps the owner within
+        'shard_rebalance_slack' of an even share, to avoid needless moves.
+
+        Parameters
+        ----------
+        1) list[str]
+            syncnames of all rules
+        2) dict
+            current lease of each rule (or None)
+        3) list[str]
+            names of the live hosts
+
+        Returns
+        -------
+        dict
+            host name of each rule, keyed by syncname
+
+        Throws
+        -------
+        none
+
+        """
+        costs = self.get_rule_costs(syncnames, leases)
+        even_share = sum(costs.values()) / len(live_nodes)
+        load = {node: 0.0 for node in live_nodes}
+        assignment = {}
+
+        # Place the most expensive rules first
+        for syncname in sorted(syncnames, key=lambda x: (-costs[x], x)):
+            lease = leases[syncname]
+            owner = lease['node'] if lease is not None else None
+
+            if (
+                owner in load and
+                load[owner] + costs[syncname] <= even_share * (1 + self.config['shard_rebalance_slack'])
+            ):
+                node = owner
+            else:
+                node = min(live_nodes, key=lambda x: (load[x], x))
+
+            assignment[syncname] = node
+            load[node] += costs[syncname]
+
+        return assignment
+
+    def break_stale_lock(self, lock_file, now):
+        """Remove a lock left behind by a crashed host.
+
+        The stale lock is renamed to a name of this host first, which only
+        one host can do. If another host replaced it with a fresh lock in the
+        meantime, the fresh lock is put back instead of removed.
+
+        Parameters
+        ----------
+        1) str
+            path of the lock file
+        2) float
+            current time
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            stale = os.stat(lock_file)
+        except OSError:
+            return
+
+        if now - stale.st_mtime <= self.config['shard_lease_ttl']:
+            return
+
+        moved_file = lock_file + "." + self.node + "-" + str(os.getpid()) + ".stale"
+
+        try:
+            os.rename(lock_file, moved_file)
+            moved = os.stat(moved_file)
+        except OSError:
+            return
+
+        if (moved.st_ino, moved.st_mtime) != (stale.st_ino, stale.st_mtime):
+            try:
+                os.link(moved_file, lock_file)
+            except OSError:
+                pass
+
+        try:
+            os.remove(moved_file)
+        except OSError:
+            pass
+
+    def lock(self, lease_file):
+        """Take the lock of a lease file.
+
+        A lock file created with O_EXCL ensures two hosts never change the
+        same lease at once.
+
+        Parameters
+        ----------
+        str
+            path of the lease file
+
+        Returns
+        -------
+        int
+            inode of the lock file, to release it with, or None if another
+            host holds the lock
+
+        Throws
+        -------
+        none
+
+        """
+        lock_file = lease_file + ".lock"
+
+        # Locks left behind by a crashed host expire with the leases
+        self.break_stale_lock(lock_file, time.time())
+
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return None
+
+        try:
+            return os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+
+    def unlock(self, lease_file, lock_inode):
+        """Release the lock of a lease file, unless it was taken from this host.
+
+        Parameters
+        ----------
+        1) str
+            path of the lease file
+        2) int
+            inode of the lock file, as returned by lock()
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        lock_file = lease_file + ".lock"
+
+        try:
+            if os.stat(lock_file).st_ino == lock_inode:
+                os.remove(lock_file)
+        except OSError:
+            pass
+
+    def claim(self, syncname, lease, cost):
+        """Take or renew the lease of a rule for this host.
+
+        Parameters
+        ----------
+        1) str
+            syncname of the rule
+        2) dict
+            current lease of the rule (or None)
+        3) float
+            measured cost of the rule, or None if not measured yet
+
+        Returns
+        -------
+        bool
+            True if this host holds the lease
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        lease_file = self.get_lease_file(syncname)
+        lock_inode = self.lock(lease_file)
+
+        if lock_inode is None:
+            return False
+
+        try:
+            # Re-read under the lock, another host may have just claimed it
+            lease = self.read_json(lease_file)
+
+            if lease is not None and lease['node'] != self.node and lease['expires'] > now:
+                return False
+
+            if lease is None or lease['node'] != self.node:
+                self.logger.info(
+                    "Claimed sync rule '" + syncname + "' for host '" + self.node + "'."
+                )
+
+            if cost is None and lease is not None:
+                cost = lease.get('cost')
+
+            self.write_json(lease_file, {
+                'node': self.node,
+                'expires': now + self.config['shard_lease_ttl'],
+                'cost': cost,
+            })
+
+            return True
+
+        finally:
+            self.unlock(lease_file, lock_inode)
+
+    def release(self, syncname):
+        """Give up the lease of a rule, so another host can claim it.
+
+        Called once the instances of the rule are stopped on this host. The
+        lease keeps the cost of the rule, for balancing the rules.
+
+        Parameters
+        ----------
+        str
+            syncname of the rule
+
+        Returns
+        -------
+        bool
+            True if the lease was released, False if it is locked by another
+            host, and is released on a later run
+
+        Throws
+        -------
+        none
+
+        """
+        lease_file = self.get_lease_file(syncname)
+        lock_inode = self.lock(lease_file)
+
+        if lock_inode is None:
+            return False
+
+        try:
+            lease = self.read_json(lease_file)
+
+            if lease is not None and lease['node'] == self.node:
+                self.logger.info(
+                    "Releasing sync rule '" + syncname + "' from host '" + self.node +
+                    "' to rebalance."
+                )
+
+                self.write_json(lease_file, {'node': None, 'expires': 0, 'cost': lease.get('cost')})
+
+            self.releasing.discard(syncname)
+
+            return True
+
+        finally:
+            self.unlock(lease_file, lock_inode)
+
+    def get_held_rules(self, syncnames):
+        """Return the rules this host holds an unexpired lease for.
+
+        Unlike get_owned_rules(), no lease is claimed, renewed or released.
+
+        Parameters
+        ----------
+        list[str]
+            syncnames of all rules
+
+        Returns
+        -------
+        set[str]
+            syncnames of the rules this host holds the lease for
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        held = set()
+
+        for syncname in syncnames:
+            lease = self.read_json(self.get_lease_file(syncname))
+
+            if lease is not None and lease['node'] == self.node and lease['expires'] > now:
+                held.add(syncname)
+
+        return held
+
+    def get_owned_rules(self, syncnames, measured_costs):
+        """Update leases, and return the rules this host should run.
+
+        Rules assigned to another host which this host still holds stay
+        leased, and are listed in releasing. Call release() for them once
+        their instances are stopped.
+
+        Parameters
+        ----------
+        1) list[str]
+            syncnames of all rules
+        2) dict
+            cost measured on this host for the rules it runs, keyed by
+            syncname
+
+        Returns
+        -------
+        set[str]
+            syncnames of the rules this host holds the lease for
+
+        Throws
+        -------
+        none
+
+        """
+        if len(syncnames) == 0:
+            return set()
+
+        now = time.time()
+        live_nodes = self.heartbeat()
+        leases = {x: self.read_json(self.get_lease_file(x)) for x in syncnames}
+
+        # Expired leases belong to nobody, but keep the cost of their rule
+        for syncname, lease in leases.items():
+            if lease is not None and lease['expires'] <= now and lease['node'] != self.node:
+                leases[syncname] = dict(lease, node=None)
+
+        assignment = self.get_assignment(syncnames, leases, live_nodes)
+        owned = set()
+        self.releasing = set()
+
+        for syncname in syncnames:
+            lease = leases[syncname]
+            held = lease is not None and lease['node'] == self.node
+
+            if assignment[syncname] == self.node:
+                if self.claim(syncname, lease, measured_costs.get(syncname)):
+                    owned.add(syncname)
+
+            # A rule moving to another host stays leased to this host until
+            # its instances are stopped, see release()
+            elif held and self.claim(syncname, lease, measured_costs.get(syncname)):
+                self.releasing.add(syncname)
+
+        return owned
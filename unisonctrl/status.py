@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# This script reports the state of the unison instances, without changing
+# anything, so monitoring can poll it as often as it likes
+
+import os
+import re
+import time
+import psutil
+
+from admission import AdmissionControl
+from latencyprobe import LatencyProbe
+from restartpolicy import RestartPolicy
+from scheduler import SyncScheduler
+
+
+class StatusReport():
+    """StatusReport - describe running instances from stored data and /proc.
+
+    Only the data storage and the process table are read. Nothing is scanned,
+    started, killed or written, so a report takes milliseconds.
+    """
+
+    # Bytes read from the end of an instance log to find completed syncs
+    LOG_TAIL_BYTES = 65536
+
+    # Line unison logs when a sync is complete, with its local time of day
+    SYNC_COMPLETE_PATTERN = re.compile(rb"^Synchronization complete at (\d+):(\d+):(\d+)", re.MULTILINE)
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage):
+        """Prepare a status report of one sync root.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, opened read-only
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+
+    def get_process_usage(self, instance_name):
+        """Return the resource usage of an instance and its ssh transport.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        dict
+            resource usage, or None if the instance is no longer running
+
+        Throws
+        -------
+        none
+
+        """
+        proc = self.data_storage.registry.get(instance_name).get_process()
+
+        if proc is None:
+            return None
+
+        try:
+            usage = {'cpu_seconds': 0.0, 'rss_bytes': 0, 'read_bytes': 0, 'write_bytes': 0}
+
+            for member in [proc] + proc.children(recursive=True):
+                with member.oneshot():
+                    usage['cpu_seconds'] += sum(member.cpu_times()[:2])
+                    usage['rss_bytes'] += member.memory_info().rss
+
+                    # IO counters need the same user, or root
+                    try:
+                        io = member.io_counters()
+                        usage['read_bytes'] += io.read_bytes
+                        usage['write_bytes'] += io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        pass
+
+        except psutil.Error:
+            return None
+
+        usage['cpu_seconds'] = round(usage['cpu_seconds'], 2)
+
+        return usage
+
+    def get_logfile(self, instance_info):
+        """Return the log file of an instance.
+
+        Parameters
+        ----------
+        dict
+            stored data of the instance
+
+        Returns
+        -------
+        str
+            path of the log file
+
+        Throws
+        -------
+        none
+
+        """
+        return instance_info.get(
+            'logfile',
+            self.config['unison_log_dir'] + os.sep + instance_info['syncname'] + ".log"
+        )
+
+    def get_last_activity(self, instance_info):
+        """Return when an instance last wrote to its log.
+
+        Parameters
+        ----------
+        dict
+            stored data of the instance
+
+        Returns
+        -------
+        float
+            modification time of the log, or None if there is no log
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            return os.stat(self.get_logfile(instance_info)).st_mtime
+        except OSError:
+            return None
+
+    def get_log_cycle_time(self, instance_info):
+        """Return the time between the last two syncs an instance completed.
+
+        A continuous instance syncs, waits for its '-repeat' interval, and
+        syncs again, so this is how long a change may wait to be synced.
+        Only the end of the log is read.
+
+        Parameters
+        ----------
+        dict
+            stored data of the instance
+
+        Returns
+        -------
+        int
+            seconds, or None if the log does not show two completed syncs
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            with open(self.get_logfile(instance_info), 'rb') as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - self.LOG_TAIL_BYTES, 0))
+                tail = f.read()
+        except OSError:
+            return None
+
+        return self.get_cycle_time_from_log(tail)
+
+    def get_cycle_time_from_log(self, log):
+        """Return the time between the last two completed syncs in a log.
+
+        Parameters
+        ----------
+        bytes
+            content of the log
+
+        Returns
+        -------
+        int
+            seconds, or None if the log does not show two completed syncs
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> SR = StatusReport({}, None)
+
+        >>> SR.get_cycle_time_from_log(
+        ...     b"Synchronization complete at 23:59:30  (1 item transferred, 0 skipped, 0 failed)\\n" +
+        ...     b"Synchronization complete at 00:00:45  (2 items transferred, 0 skipped, 0 failed)\\n"
+        ... )
+        75
+
+        >>> SR.get_cycle_time_from_log(b"Nothing to do: replicas have not changed since last sync.\\n") is None
+        True
+
+        """
+        times = [
+            int(h) * 3600 + int(m) * 60 + int(s)
+            for h, m, s in self.SYNC_COMPLETE_PATTERN.findall(log)[-2:]
+        ]
+
+        if len(times) < 2:
+            return None
+
+        # The log only has the time of day, so a sync may cross midnight
+        return (times[1] - times[0]) % 86400
+
+    def get_instances(self):
+        """Return the status of every instance this root knows about.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        list[dict]
+            status of each running, waiting or quarantined instance
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        schedule = self.data_storage.get_state(SyncScheduler.STATE_KEY, {})
+        failures = self.data_storage.get_state(RestartPolicy.STATE_KEY, {}).get('failures', {})
+        latencies = self.data_storage.get_state(LatencyProbe.STATE_KEY, {}).get('results', {})
+        instances = []
+
+        for instance_name, instance_info in sorted(self.data_storage.running_data.items()):
+            usage = self.get_process_usage(instance_name)
+            uptime = now - instance_info.get('start_time', now)
+            last_activity = self.get_last_activity(instance_info)
+            last_run = schedule.get(instance_name, {})
+
+            # One-shot syncs are timed by the scheduler, continuous instances
+            # by the syncs they log
+            if instance_info.get('mode', "continuous") == "scheduled":
+                last_cycle_time = last_run.get('last_duration')
+            else:
+                last_cycle_time = self.get_log_cycle_time(instance_info)
+
+            status = {
+                'name': instance_name,
+                'state': "running" if usage is not None else "dead",
+                'rule': instance_info.get('rule', instance_name),
+                'remote': instance_info.get('remote', ""),
+                'mode': instance_info.get('mode', "continuous"),
+                'pid': instance_info['pid'],
+                'uptime': int(uptime),
+                'dirs': len(instance_info['dirs_to_sync']),
+                'ignores': len(instance_info.get('dirs_to_ignore', [])),
+                'priority': instance_info.get('priority', {}).get('class'),
+                'last_activity': None if last_activity is None else int(now - last_activity),
+                'last_cycle_time': last_cycle_time,
+                'latency': latencies.get(instance_info.get('rule', instance_name), {}).get('last'),
+                'usage': usage,
+            }
+
+            if usage is not None:
+                status['usage']['cpu_percent'] = round(100 * usage['cpu_seconds'] / max(uptime, 1), 1)
+
+            instances.append(status)
+
+        for instance_name in self.data_storage.get_state(AdmissionControl.STATE_KEY, []):
+            instances.append({'name': instance_name, 'state': "waiting"})
+
+        for instance_name, failure in sorted(failures.items()):
+            if instance_name in self.data_storage.running_data:
+                continue
+
+            instances.append({
+                'name': instance_name,
+                'state': "quarantined" if failure.get('quarantined', False) else "backing-off",
+                'failures': failure['count'],
+                'next_attempt': int(max(failure['next_attempt'] - now, 0)),
+            })
+
+        return instances
+
+    def format_text(self, instances):
+        """Format instance statuses as a table for the terminal.
+
+        Parameters
+        ----------
+        list[dict]
+            statuses, as returned by get_instances()
+
+        Returns
+        -------
+        str
+            one line per instance
+
+        Throws
+        -------
+        none
+
+        """
+        columns = ["NAME", "STATE", "PID", "UPTIME", "DIRS", "ACTIVITY", "CYCLE", "LATENCY", "CPU%", "RSS"]
+        rows = [columns]
+
+        for status in instances:
+            usage = status.get('usage') or {}
+
+            rows.append([
+                status['root'] + "/" + status['name'] if 'root' in status else status['name'],
+                status['state'],
+                str(status.get('pid', "-")),
+                self.format_seconds(status.get('uptime')),
+                str(status.get('dirs', "-")),
+                self.format_seconds(status.get('last_activity')),
+                self.format_seconds(status.get('last_cycle_time')),
+                "-" if status.get('latency') is None else str(status['latency']) + "s",
+                str(usage.get('cpu_percent', "-")),
+                str(usage.get('rss_bytes', 0) // (1024 * 1024)) + "M" if 'rss_bytes' in usage else "-",
+            ])
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+
+        return "\n".join(
+            "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+            for row in rows
+        )
+
+    def format_seconds(self, seconds):
+        """Format a number of seconds for the status table.
+
+        Parameters
+        ----------
+        int
+            seconds (may be None)
+
+        Returns
+        -------
+        str
+            duration like '3h12m', or '-'
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> StatusReport({}, None).format_seconds(42)
+        '42s'
+
+        >>> StatusReport({}, None).format_seconds(11520)
+        '3h12m'
+
+        """
+        if seconds is None:
+            return "-"
+
+        seconds = int(seconds)
+
+        if seconds < 60:
+            return str(seconds) + "s"
+
+        if seconds < 3600:
+            return str(seconds // 60) + "m" + str(seconds % 60) + "s"
+
+        return str(seconds // 3600) + "h" + str(seconds % 3600 // 60) + "m"
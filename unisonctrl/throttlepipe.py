@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Unison runs this script in place of ssh when a bandwidth budget is set. It
+# starts the real ssh command, and relays its traffic at the rate unisonctrl
+# writes to the rate file of the instance.
+
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+
+class ThrottledTransport():
+    """ThrottledTransport - relay a unison transport at a limited rate.
+
+    Traffic in both directions shares one token bucket. The rate file holds
+    the allowed bytes per second (0 for no limit), and is re-read while the
+    transport runs, so unisonctrl can move bandwidth between instances
+    without restarting them.
+    """
+
+    # Bytes relayed per read, small enough to keep the rate smooth
+    CHUNK_SIZE = 16384
+
+    # Seconds of unused allowance which may be spent in a burst
+    BURST_SECONDS = 0.5
+
+    # Seconds between checks of the rate file
+    RATE_CHECK_INTERVAL = 1.0
+
+    def __init__(self, rate_file, command):
+        """Prepare the transport.
+
+        Parameters
+        ----------
+        1) str
+            path of the file holding the allowed bytes per second
+        2) list[str]
+            command of the real transport, like ssh and its arguments
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.rate_file = rate_file
+        self.command = command
+        self.rate = 0
+        self.rate_checked = 0
+        self.next_free = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_rate(self):
+        """Return the allowed bytes per second, from the rate file.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        int
+            allowed bytes per second, 0 for no limit
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.monotonic()
+
+        if now - self.rate_checked >= self.RATE_CHECK_INTERVAL:
+            self.rate_checked = now
+
+            # Keep the previous rate while the file is being replaced
+            try:
+                with open(self.rate_file) as f:
+                    self.rate = max(int(f.read().strip()), 0)
+            except (OSError, ValueError):
+                pass
+
+        return self.rate
+
+    def consume(self, size):
+        """Wait until a number of bytes may be relayed.
+
+        Parameters
+        ----------
+        int
+            bytes about to be relayed
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        with self.lock:
+            rate = self.get_rate()
+            now = time.monotonic()
+
+            if rate <= 0:
+                self.next_free = now
+                return
+
+            # Allowance left unused for a while is capped to a short burst
+            self.next_free = max(self.next_free, now - self.BURST_SECONDS) + size / rate
+            delay = self.next_free - now - self.BURST_SECONDS
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def pump(self, source, destination):
+        """Relay data from one file descriptor to another until end of file.
+
+        Parameters
+        ----------
+        1) int
+            file descriptor to read from
+        2) int
+            file descriptor to write to, closed at end of file
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            while True:
+                data = os.read(source, self.CHUNK_SIZE)
+
+                if len(data) == 0:
+                    break
+
+                self.consume(len(data))
+
+                while len(data) > 0:
+                    data = data[os.write(destination, data):]
+
+        except OSError:
+            pass
+
+        finally:
+            try:
+                os.close(destination)
+            except OSError:
+                pass
+
+    def run(self):
+        """Start the real transport, and relay its traffic until it exits.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        int
+            exit code of the real transport
+
+        Throws
+        -------
+        none
+
+        """
+        proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        # Unison may keep its end open after the transport exits, so the
+        # upstream relay must not keep this process alive
+        upstream = threading.Thread(
+            target=self.pump, args=(sys.stdin.fileno(), proc.stdin.fileno()), daemon=True
+        )
+        downstream = threading.Thread(
+            target=self.pump, args=(proc.stdout.fileno(), sys.stdout.fileno())
+        )
+
+        upstream.start()
+        downstream.start()
+
+        returncode = proc.wait()
+        downstream.join()
+
+        return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(ThrottledTransport(
+        os.environ['UNISONCTRL_RATE_FILE'],
+        shlex.split(os.environ.get('UNISONCTRL_SSH_COMMAND', "ssh")) + sys.argv[1:]
+    ).run())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# This script detects unison instances which are in the middle of propagating
+# changes, so they are not restarted halfway through a large transfer
+
+import os
+import time
+import psutil
+
+
+class TransferMonitor():
+    """TransferMonitor - tell if an instance is busy propagating changes.
+
+    An instance is busy if the tail of its log shows a copy which has begun
+    but not ended, or if it (or its ssh transport) moved more than
+    'transfer_active_bytes_per_second' since the previous run.
+    """
+
+    # Key used to persist IO samples in the data storage backend
+    STATE_KEY = "transfers"
+
+    # Bytes read from the end of the log to find unfinished copies
+    LOG_TAIL_BYTES = 16384
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger):
+        """Prepare the transfer monitor.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist IO samples across runs
+        3) logging.Logger
+            logger to report busy instances to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+
+    def get_io_bytes(self, pid):
+        """Return the bytes moved by a process and its children so far.
+
+        On Linux, this counts pipe and socket traffic of the ssh transport
+        too, not just disk IO.
+
+        Parameters
+        ----------
+        int
+            PID of the unison process
+
+        Returns
+        -------
+        int
+            bytes read and written, or None if the process is gone or its
+            counters are not readable
+
+        Throws
+        -------
+        none
+
+        """
+        io_bytes = 0
+
+        try:
+            proc = psutil.Process(pid)
+
+            for member in [proc] + proc.children(recursive=True):
+                io = member.io_counters()
+                io_bytes += getattr(io, 'read_chars', io.read_bytes)
+                io_bytes += getattr(io, 'write_chars', io.write_bytes)
+
+        except (psutil.Error, AttributeError):
+            return None
+
+        return io_bytes
+
+    def sample(self, running_data):
+        """Record the IO rate of every running instance since the last run.
+
+        Parameters
+        ----------
+        dict
+            stored data of the running instances, keyed by instance name
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        previous_samples = self.data_storage.get_state(self.STATE_KEY, {})
+        samples = {}
+
+        for instance_name, instance_info in running_data.items():
+            io_bytes = self.get_io_bytes(instance_info['pid'])
+
+            if io_bytes is None:
+                continue
+
+            sample = {'pid': instance_info['pid'], 'io_bytes': io_bytes, 'time': now, 'rate': 0}
+            previous = previous_samples.get(instance_name)
+
+            if previous is not None and previous['pid'] == instance_info['pid'] and now > previous['time']:
+                sample['rate'] = int((io_bytes - previous['io_bytes']) / (now - previous['time']))
+
+            samples[instance_name] = sample
+
+        self.data_storage.set_state(self.STATE_KEY, samples)
+
+    def log_shows_transfer(self, instance_info):
+        """Check if the log of an instance ends inside a copy.
+
+        Unison logs '[BGN]' when it starts propagating a change, and '[END]'
+        when it is done.
+
+        Parameters
+        ----------
+        dict
+            stored data of the instance
+
+        Returns
+        -------
+        bool
+            True if the last '[BGN]' in the log has no '[END]' after it
+
+        Throws
+        -------
+        none
+
+        """
+        logfile = instance_info.get(
+            'logfile',
+            self.config['unison_log_dir'] + os.sep + instance_info['syncname'] + ".log"
+        )
+
+        try:
+            with open(logfile, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - self.LOG_TAIL_BYTES, 0))
+                tail = f.read()
+        except OSError:
+            return False
+
+        return tail.rfind(b"[BGN]") > tail.rfind(b"[END]")
+
+    def is_transferring(self, instance_name, instance_info):
+        """Check if an instance is busy propagating changes.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            stored data of the running instance
+
+        Returns
+        -------
+        bool
+            True if a restart now would interrupt a transfer
+
+        Throws
+        -------
+        none
+
+        """
+        if self.log_shows_transfer(instance_info):
+            self.logger.debug("Instance '%s' Log shows a copy in progress.", instance_name)
+            return True
+
+        sample = self.data_storage.get_state(self.STATE_KEY, {}).get(instance_name)
+
+        if (
+            sample is not None and
+            sample['pid'] == instance_info['pid'] and
+            sample['rate'] >= self.config['transfer_active_bytes_per_second']
+        ):
+            self.logger.debug(
+                "Instance '%s' Moving %s bytes per second.", instance_name, sample['rate']
+            )
+            return True
+
+        return False
@@ -3,7 +3,38 @@
 
 # Run this script to run unisonctrl
 
+import argparse
+
 from unisonhandler import UnisonHandler
 
-US = UnisonHandler()
-US.run()
+parser = argparse.ArgumentParser(
+    description="Manage multiple unison instances. Run without a command from cron."
+)
+parser.add_argument(
+    'command', nargs='?', default="run", choices=["run", "status", "plan"],
+    help="'run' starts, restarts and stops instances (default), 'status' " +
+    "reports the instances and 'plan' shows what 'run' would change, " +
+    "both without changing anything"
+)
+parser.add_argument(
+    '--json', action='store_true',
+    help="print the status or plan as JSON"
+)
+parser.add_argument(
+    '--urgent', action='store_true',
+    help="apply config changes to instances which are busy transferring, " +
+    "instead of waiting for them to finish"
+)
+args = parser.parse_args()
+
+if args.command == "status":
+    US = UnisonHandler(read_only=True)
+    print(US.report_status(as_json=args.json))
+
+elif args.command == "plan":
+    US = UnisonHandler(read_only=True)
+    print(US.report_plan(as_json=args.json))
+
+else:
+    US = UnisonHandler(urgent=args.urgent)
+    US.run()
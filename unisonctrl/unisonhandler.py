@@ -10,20 +10,51 @@
 
 import subprocess
 import os
+import json
 import glob
 import atexit
 import itertools
 import hashlib
-# import time
+import time
 import psutil
 import getpass
 import platform
 import copy
+import shutil
+import threading
+import concurrent.futures
 
+import queue
 import logging
 import logging.handlers
 
 from datastorage import DataStorage
+from restartpolicy import RestartPolicy
+from admission import AdmissionControl
+from scheduler import SyncScheduler
+from archives import ArchiveManager
+from sharding import ShardCoordinator
+from watchdog import InstanceWatchdog
+from logrotation import InstanceLogRotator
+from logformatter import JsonLinesFormatter
+from logqueue import LogQueueHandler
+from status import StatusReport
+from reconcileplan import ReconcilePlan
+from transfers import TransferMonitor
+from bandwidth import BandwidthBudget
+from activity import ActivityIndex
+from remotelisting import RemoteListing
+from latencyprobe import LatencyProbe
+from consolidation import MemoryConsolidator
+
+
+class SyncRootLogAdapter(logging.LoggerAdapter):
+    """Prefixes log messages with the name of the sync root they concern."""
+
+    def process(self, msg, kwargs):
+        """Add the sync root name to a log message and its structured fields."""
+        kwargs['extra'] = dict(kwargs.get('extra', {}), root=self.extra['root'])
+        return "[" + self.extra['root'] + "] " + msg, kwargs
 
 
 class UnisonHandler():
@@ -32,24 +63,112 @@ class UnisonHandler():
     # Object for data storage backend
     data_storage = None
 
+    # Object deciding when instances may be restarted
+    restart_policy = None
+
+    # Object deciding when scheduled rules run
+    scheduler = None
+
+    # Object managing per-instance unison archives
+    archives = None
+
+    # Object splitting the sync rules between hosts, if sharding is enabled
+    shards = None
+
+    # Object finding running instances which no longer make progress
+    watchdog = None
+
+    # Object rotating the log files of the unison instances
+    log_rotator = None
+
+    # Object telling if an instance is busy propagating changes
+    transfers = None
+
+    # Object sharing 'bandwidth_limit' between the instances
+    bandwidth = None
+
+    # Object ranking directories by recent activity
+    activity = None
+
+    # Object listing the directories of the remotes, if enabled
+    remote_listing = None
+
+    # Object measuring how long changes take to reach the remotes, if enabled
+    latency_probe = None
+
+    # Object merging cold rules while memory is short, if enabled
+    consolidator = None
+
+    # Apply config changes to busy instances right away
+    urgent = False
+
+    # Object describing the instances, when opened read-only
+    status = None
+
+    # Only inspect the running system, never change it
+    read_only = False
+
     # configuration values
     config = {}
 
+    # Unison options which may be given several times. A rule adds these to
+    # the global options, rather than replacing them.
+    REPEATABLE_UNISON_OPTIONS = {
+        'backup', 'backupnot', 'follow', 'ignore', 'ignorenot', 'immutable',
+        'immutablenot', 'merge', 'nocreation', 'nodeletion', 'noupdate', 'path',
+        'rootalias', 'sortfirst', 'sortlast',
+    }
+
+    # Writes queued log records to the log file and console, on its own thread
+    log_listener = None
+
+    # Handlers of each sync root. Contains only this handler, unless
+    # 'sync_roots' is configured.
+    root_handlers = []
+
+    # Top level handler, and name of the sync root, for the handler of a
+    # sync root
+    parent = None
+    root_name = None
+
+    # Instances started by all sync roots during this run, counted on the top
+    # level handler for 'max_instance_starts_per_run'
+    instance_starts_this_run = 0
+
     # Enables extra output
     INFO = True
 
+    # Settings which may be overridden per entry of 'sync_roots'
+    rootSettings = {
+        'unison_local_root',
+        'sync_hierarchy_rules',
+        'unison_remote_root',
+        'unison_remote_ssh_conn',
+        'unison_remote_ssh_keyfile',
+        'unison_remotes',
+    }
+
     # Logging Object
     # logging
 
     # self.config['unisonctrl_log_dir'] + os.sep + "unisonctrl.log"
     # self.config['unisonctrl_log_dir'] + os.sep + "unisonctrl.error"
 
-    def __init__(self):
+    def __init__(self, root=None, parent=None, read_only=False, urgent=False):
         """Prepare UnisonHandler to manage unison instances.
 
         Parameters
         ----------
-        none
+        1) dict
+            entry of 'sync_roots' this handler manages (only with parent)
+        2) UnisonHandler
+            top level handler which created this handler, or None to create
+            the top level handler
+        3) bool
+            only read the stored data to report status, without logging,
+            cleaning up or writing anything
+        4) bool
+            restart instances with changed config even while they transfer
 
         Returns
         -------
@@ -63,68 +182,237 @@ class UnisonHandler():
         -------
 
         """
+        if parent is not None:
+            # Handler of one sync root, sharing the setup of the top level
+            self.parent = parent
+            self.root_name = root['name']
+            self.read_only = parent.read_only
+            self.urgent = parent.urgent
+            self.config = self.get_root_config(parent.config, root)
+            self.logger = SyncRootLogAdapter(parent.logger, {'root': root['name']})
+            self.admission_lock = parent.admission_lock
+            self.init_sync_root()
+            return
+
+        self.read_only = read_only
+        self.urgent = urgent
+
         self.import_config()
         # Set up configuration
 
-        # Register exit handler
-        atexit.register(self.exit_handler)
+        # Serializes starting new instances across sync roots, so the
+        # admission limits apply to all of them together
+        self.admission_lock = threading.Lock()
+
+        if read_only:
+            # Warnings still reach stderr through the logging fallback
+            self.logger = logging.getLogger('unisonctrl.status')
+        else:
+            # Register exit handler
+            atexit.register(self.exit_handler)
+
+            # Set up logging
+            self.setup_logging()
+
+            self.logger.info("UnisonCTRL Starting")
+
+        if len(self.config['sync_roots']) > 0:
+            # The bandwidth budget is shared by the instances of all roots
+            self.bandwidth = BandwidthBudget(self.config, self.logger)
+
+            # Each sync root gets its own handler and state namespace
+            self.root_handlers = [
+                UnisonHandler(root, parent=self) for root in self.config['sync_roots']
+            ]
+        else:
+            self.validate_sync_config()
+            self.init_sync_root()
+
+    def init_sync_root(self):
+        """Prepare the storage and helpers to manage the instances of a root.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        # Disabling debugging on the storage layer, it's no longer needed
+        self.data_storage = DataStorage(False, self.config, self.read_only)
+
+        self.root_handlers = [self]
+
+        self.restart_policy = RestartPolicy(self.config, self.data_storage, self.logger, self.urgent)
+        self.scheduler = SyncScheduler(self.config, self.data_storage, self.logger)
+        self.archives = ArchiveManager(self.config, self.logger)
+        self.bandwidth = BandwidthBudget(self.config, self.logger)
+        self.activity = ActivityIndex(self.config, self.data_storage, self.logger, self.read_only)
+
+        if self.config['remote_listing']:
+            self.remote_listing = RemoteListing(self.config, self.data_storage, self.logger, self.read_only)
+
+        if self.config['consolidation_max_rss'] > 0 or self.config['consolidation_memory_percent'] > 0:
+            self.consolidator = MemoryConsolidator(self.config, self.data_storage, self.logger, self.read_only)
+
+        if self.config['shard_state_dir'] != "":
+            self.shards = ShardCoordinator(self.config, self.logger, self.read_only)
+
+        # Read-only handlers can report and plan, but not apply
+        if self.read_only:
+            self.status = StatusReport(self.config, self.data_storage)
+            return
+
+        self.watchdog = InstanceWatchdog(self.config, self.data_storage, self.logger)
+        self.log_rotator = InstanceLogRotator(self.config, self.data_storage, self.logger)
+        self.transfers = TransferMonitor(self.config, self.data_storage, self.logger)
+
+        if self.config['latency_probe_interval'] > 0:
+            self.latency_probe = LatencyProbe(self.config, self.data_storage, self.logger)
+
+        # Clean up dead processes to ensure data files are in an expected state
+        self.cleanup_dead_processes()
+
+    def setup_logging(self):
+        """Set up the log file and console logging.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
 
-        # Set up logging
+        """
         self.logger = logging.getLogger('unisonctrl')
         self.logger.setLevel(logging.INFO)
 
+        if not os.path.isdir(self.config['unisonctrl_log_dir']):
+            os.makedirs(self.config['unisonctrl_log_dir'])
+
+        logfile = self.config['unisonctrl_log_dir'] + os.sep + 'unisonctrl.log'
+
         # Set up main log file logging
-        logFileFormatter = logging.Formatter(
-            fmt='[%(asctime)-s] %(levelname)-9s : %(message)s',
-            datefmt='%m/%d/%Y %I:%M:%S %p'
-        )
+        if self.config['log_format'] == "json":
+            logFileFormatter = JsonLinesFormatter()
+        else:
+            logFileFormatter = logging.Formatter(
+                fmt='[%(asctime)-s] %(levelname)-9s : %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p'
+            )
 
         # Size based log rotation
         if (self.config['rotate_logs'] == "size"):
             logfileHandler = logging.handlers.RotatingFileHandler(
-                self.config['unisonctrl_log_dir'] + os.sep + 'unisonctrl.log',
-                # maxBytes=50000000,  # 50mb
-                maxBytes=5000,  # 50mb
+                logfile,
+                maxBytes=50 * 1024 * 1024,  # 50mb
                 backupCount=20
             )
 
         # Timed log rotation
         elif (self.config['rotate_logs'] == "time"):
             logfileHandler = logging.handlers.TimedRotatingFileHandler(
-                self.config['unisonctrl_log_dir'] + os.sep + 'unisonctrl.log',
+                logfile,
                 when="midnight",
                 backupCount=14,  # Keep past 14 days
             )
 
         # No log rotation
         elif (self.config['rotate_logs'] == "off"):
-            logfileHandler = logging.FileHandler()
+            logfileHandler = logging.FileHandler(logfile)
 
         else:
-            logfileHandler = logging.FileHandler()
+            raise LookupError("Unknown rotate_logs setting: '" + str(self.config['rotate_logs']) + "'")
 
         logfileHandler.setLevel(logging.DEBUG)
         logfileHandler.setFormatter(logFileFormatter)
-        self.logger.addHandler(logfileHandler)
 
         # Send logs to console when running
         consoleFormatter = logging.Formatter('[%(asctime)-22s] %(levelname)s : %(message)s')
         consoleHandler = logging.StreamHandler()
         consoleHandler.setLevel(logging.INFO)
         consoleHandler.setFormatter(consoleFormatter)
-        self.logger.addHandler(consoleHandler)
 
-        # Disabling debugging on the storage layer, it's no longer needed
-        self.data_storage = DataStorage(False, self.config)
+        # Log calls only queue the record, so slow disks or consoles do not
+        # hold up the run. The listener thread writes them out.
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(LogQueueHandler(log_queue))
 
-        self.logger.info("UnisonCTRL Starting")
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, logfileHandler, consoleHandler, respect_handler_level=True
+        )
+        self.log_listener.start()
 
-        # Clean up dead processes to ensure data files are in an expected state
-        self.cleanup_dead_processes()
+    def get_root_config(self, config, root):
+        """Build the configuration of a single sync root.
+
+        Settings of the root entry override the top level settings. Running
+        data, state, logs and archives are kept in a directory per root, so
+        instances with the same name in different roots do not collide.
+
+        Parameters
+        ----------
+        1) dict
+            top level configuration
+        2) dict
+            entry of 'sync_roots'
+
+        Returns
+        -------
+        dict
+            configuration of the sync root
+
+        Throws
+        -------
+            'LookupError' if the root entry is invalid.
+
+        """
+        root_config = copy.deepcopy(config)
+        root_config['sync_roots'] = []
+
+        for key, value in root.items():
+            if key == 'name':
+                continue
+
+            if key not in self.rootSettings:
+                raise LookupError(
+                    "Unknown config entry '" + key + "' on sync root '" +
+                    root['name'] + "'"
+                )
+
+            root_config[key] = copy.deepcopy(value)
+
+        root_config['unison_local_root'] = self.sanatize_path(root_config['unison_local_root'])
+
+        # Namespace the per-root directories
+        for key in (
+            'running_data_dir', 'state_data_dir', 'unison_log_dir', 'unison_archive_dir',
+            'unison_remote_archive_dir', 'shard_state_dir', 'bandwidth_rate_dir'
+        ):
+            if root_config[key] != "":
+                root_config[key] = root_config[key] + os.sep + root['name']
+
+        self.config = root_config
+        self.validate_sync_config()
+
+        return root_config
 
     def run(self):
         """General wrapper to ensure running instances are up to date.
 
+        With several sync roots, the roots are reconciled concurrently.
+
         Parameters
         ----------
         none
@@ -139,10 +427,35 @@ class UnisonHandler():
         none
 
         """
-        self.create_all_sync_instances()
+        self.instance_starts_this_run = 0
 
-    def create_all_sync_instances(self):
-        """Create multiple sync instances from the config and filesystem info.
+        if self.root_handlers == [self]:
+            self.create_all_sync_instances()
+            self.update_bandwidth_shares()
+            return
+
+        max_workers = self.config['max_parallel_roots']
+
+        if max_workers <= 0:
+            max_workers = len(self.root_handlers)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(handler.create_all_sync_instances): handler
+                for handler in self.root_handlers
+            }
+
+            # A failing root should not stop the other roots
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    futures[future].logger.exception("Reconciling sync root failed.")
+
+        self.update_bandwidth_shares()
+
+    def update_bandwidth_shares(self):
+        """Split 'bandwidth_limit' between the running instances of all roots.
 
         Parameters
         ----------
@@ -150,400 +463,2015 @@ class UnisonHandler():
 
         Returns
         -------
-        list
-            PIDs of dead unison instances which we thought were running.
+        none
 
         Throws
         -------
         none
 
         """
-        # Get directories to sync
-        dirs_to_sync_by_sync_instance = self.get_dirs_to_sync(self.config['sync_hierarchy_rules'])
+        if self.config['bandwidth_limit'] <= 0:
+            return
 
-        # Store all known running sync instances here to potentially kill later
-        # unhandled_sync_instances = copy.deepcopy(dirs_to_sync_by_sync_instance)
-        unhandled_sync_instances = copy.deepcopy(self.data_storage.running_data)
+        # Instances which are transferring get the bandwidth of idle ones
+        changed = self.bandwidth.update([
+            (instance_info, handler.transfers.is_transferring(instance_name, instance_info))
+            for handler in self.root_handlers
+            for instance_name, instance_info in list(handler.data_storage.running_data.items())
+        ])
 
-        # Loop through each entry in the dict and create a sync instance for it
-        for instance_name, dirs_to_sync in dirs_to_sync_by_sync_instance.items():
+        if changed > 0:
+            self.logger.info("Bandwidth shares of " + str(changed) + " instances changed.")
 
-            # Mark this instance as handled so it's not killed later
-            unhandled_sync_instances.pop(instance_name, None)
+    def get_status(self):
+        """Return the status of the instances of all sync roots.
 
-            # Make new sync instance
-            self.create_sync_instance(instance_name, dirs_to_sync)
+        Requires a handler opened read-only.
 
-        # Kill any instances in unhandled_sync_instances, because they are
-        # no longer required needed
+        Parameters
+        ----------
+        none
 
-        for inst_to_kill in unhandled_sync_instances:
-            self.logger.debug(
-                "Cleaning up instance '" + inst_to_kill + "'" +
-                " which is no longer needed."
-            )
-            self.kill_sync_instance_by_pid(self.data_storage.running_data[inst_to_kill]['pid'])
+        Returns
+        -------
+        list[dict]
+            status of each instance, with its 'root' if 'sync_roots' is set
 
-    def get_dirs_to_sync(self, sync_hierarchy_rules):
-        """Start a new sync instance with provided details.
+        Throws
+        -------
+        none
 
-        # Parses the filesystem, and lists l
+        """
+        instances = []
+
+        for handler in self.root_handlers:
+            for status in handler.status.get_instances():
+                if handler.root_name is not None:
+                    status['root'] = handler.root_name
+
+                instances.append(status)
+
+        return instances
+
+    def report_status(self, as_json=False):
+        """Return the status of all instances, ready to print.
 
         Parameters
         ----------
-        Pass through sync_hierarchy_rules from config
+        bool
+            return JSON instead of a table
 
         Returns
         -------
-        dict (nested)
-            [syncname] - name of the sync name for this batch
-                ['sync'] - directories to sync in this instance
-                ['ignore'] - directories to ignore in this instance
+        str
+            status report
 
         Throws
         -------
         none
 
         """
-        # Contains the list of directories which have been handled by the loop
-        # so future iterations don't duplicate work
-        handled_dirs = []
+        instances = self.get_status()
 
-        # Contains list which is built up within the loop and returned at the
-        # end of the method
-        all_dirs_to_sync = {}
+        if as_json:
+            return json.dumps({'time': int(time.time()), 'instances': instances}, indent=2)
 
-        self.logger.debug(
-            "Processing directories to sync. " +
-            str(len(sync_hierarchy_rules)) + " rules to process."
-        )
+        return self.root_handlers[0].status.format_text(instances)
 
-        for sync_instance in sync_hierarchy_rules:
+    def get_all_running_instances(self):
+        """Return the stored data of the running instances of all sync roots.
 
-            self.logger.debug(
-                "Instance '" + sync_instance['syncname'] + "' " +
-                "Parsing rules and directories."
-            )
+        Parameters
+        ----------
+        none
 
-            # Find full list
-            expr = (
-                self.config['unison_local_root'] +
-                os.sep +
-                sync_instance['dir_selector']
-            )
+        Returns
+        -------
+        list[dict]
+            stored data of every running instance
 
-            # Get full list of glob directories
-            all_dirs_from_glob = glob.glob(self.sanatize_path(expr))
+        Throws
+        -------
+        none
 
-            # Remove any dirs already handled in a previous loop, unless
-            # overlap is set
-            if (
-                'overlap' not in sync_instance or
-                sync_instance['overlap'] is False
-            ):
+        """
+        top = self.parent if self.parent is not None else self
 
-                self.logger.debug(
-                    "Instance '" + sync_instance['syncname'] + "' " +
-                    "Removing already handled directories."
-                )
+        return [
+            instance_info
+            for handler in top.root_handlers
+            for instance_info in list(handler.data_storage.running_data.values())
+        ]
 
-                before = len(all_dirs_from_glob)
-                all_unhandled_dirs_from_glob = [x for x in all_dirs_from_glob if x not in handled_dirs]
-                after = len(all_unhandled_dirs_from_glob)
+    def create_all_sync_instances(self):
+        """Create multiple sync instances from the config and filesystem info.
 
-                # Log event if the duplication handler remove directories
-                # Added 'False and' to disable this section. TMI in the logs
-                if(before != after):
-                    self.logger.debug(
-                        "Instance '" + sync_instance['syncname'] + "' " +
-                        "Parse result: " + str(before) + " dirs down to " +
-                        str(after) + " dirs by removing already handled dirs"
-                    )
+        Parameters
+        ----------
+        none
 
-            # By default, use 'name_highfirst'
-            if 'sort_method' not in sync_instance:
-                sync_instance['sort_method'] = 'name_highfirst'
+        Returns
+        -------
+        list
+            PIDs of dead unison instances which we thought were running.
 
-            # Apply sort
-            if sync_instance['sort_method'] == 'name_highfirst':
-                sorted_dirs = sorted(all_unhandled_dirs_from_glob, reverse=True)
-            elif sync_instance['sort_method'] == 'name_lowfirst':
-                sorted_dirs = sorted(all_unhandled_dirs_from_glob)
-            # Add other sort implementations here later, if wanted
-            else:
+        Throws
+        -------
+        none
 
-                # Message for exception and self.logger
-                msg = (
-                    "'" + sync_instance['sort_method'] + "'" +
-                    " is not a valid sort method on sync instance " +
-                    "'" + sync_instance['syncname'] + "'. " +
-                    "Instance will not be created."
-                )
+        """
+        run_start = time.time()
 
-                # Send message to self.logger
-                self.logger.warn(msg)
+        # Stop instances which are hung first, so they are started again
+        # like any other instance which is not running
+        self.restart_stuck_instances()
 
-                # Uncomment this to raise an exception instead of returning blank
-                # raise ValueError(msg)
+        # Measure the IO of each instance, to avoid restarting busy ones
+        self.transfers.sample(self.data_storage.running_data)
 
-                # Return blank dir set, since sort was invalid
-                return {}
+        plan = self.plan_sync_instances()
+        self.apply_plan(plan)
+        self.release_moved_rules(plan)
 
-            # Apply sort_count, if it's set
-            if 'sort_count' in sync_instance:
+        self.logger.info(
+            "Reconciled " + str(len(plan.instances)) + " sync instances.",
+            extra={'phase': "reconcile", 'duration_ms': self.get_duration_ms(run_start)}
+        )
 
-                if (not isinstance(sync_instance['sort_count'], int)):
-                    # if not int, throw warning
-                    self.logger.warning(
-                        "Instance '" + sync_instance['syncname'] + "' " +
-                        "sort_count '" + str(sync_instance['sort_count']) + "'" +
-                        " is not castable to int. Setting sort_count to a " +
-                        "default of '3'."
-                    )
+    def release_moved_rules(self, plan):
+        """Release the leases of moved rules whose instances are stopped.
 
-                    # Then set a default
-                    sync_instance['sort_count'] = 3
+        A rule assigned to another host stays leased to this host until none
+        of its directories is synced here anymore, so two hosts never sync
+        the same directories. Rules whose instances are still stopping are
+        released on a later run.
 
-                else:
-                    # If it's a valid int, use it
-                    self.logger.debug(
-                        "Instance '" + sync_instance['syncname'] + "' " +
-                        "sort_count set at " + str(sync_instance['sort_count']) + "."
-                    )
+        Parameters
+        ----------
+        ReconcilePlan
+            applied changes
 
-                dirs_to_sync = list(
-                    itertools.islice(
-                        sorted_dirs, 0, sync_instance['sort_count'], 1
-                    )
-                )
+        Returns
+        -------
+        none
 
-            else:
-                # if sort_count is not set, sync all dirs
-                dirs_to_sync = sorted_dirs
+        Throws
+        -------
+        none
 
-            # Add all these directories to the handled_dirs so they aren't
-            # duplicated later
-            handled_dirs += dirs_to_sync
+        """
+        if len(plan.released) == 0:
+            return
 
-            # add dirs to final output nested dict
-            if len(dirs_to_sync) > 0:
-                all_dirs_to_sync[sync_instance['syncname']] = dirs_to_sync
+        running_dirs = set()
 
-            self.logger.debug(
-                "Instance '" + sync_instance['syncname'] + "' " +
-                "Syncing " + str(len(dirs_to_sync)) + " directories."
-            )
+        for instance_name in self.data_storage.running_data:
+            running_dirs.update(self.get_running_dirs(instance_name))
 
-            # Shouldn't need this, except when in deep debugging
-            # If you need it, turn it on
-            if(False):
-                dirstr = "\n   ".join(dirs_to_sync)
-                print(
-                    sync_instance['syncname'] +
-                    " directories :\n   " +
-                    dirstr + "\n\n"
+        for syncname, dirs in plan.released.items():
+            if running_dirs.isdisjoint(dirs):
+                self.shards.release(syncname)
+            else:
+                self.logger.debug(
+                    "Instance '%s' Lease kept until its instances are stopped.", syncname
                 )
 
-        self.logger.debug(
-            "Sync rule parsing complete. " +
-            "Syncing " + str(len(handled_dirs)) + " explicit directories " +
-            "in all instances combined"
-        )
-
-        # Shouldn't need this, except when in deep debugging
-        # If you need it, turn it on
-        if(False):
-            print("All directories synced :\n   " + "\n   ".join(handled_dirs))
-
-        return all_dirs_to_sync
+    def plan_sync_instances(self):
+        """Decide which sync instances to start, restart and kill.
 
-    def create_sync_instance(self, instance_name, dirs_to_sync):
-        """Start a new sync instance with provided details, if not already there.
+        Nothing is started or killed here. When not opened read-only, sharding
+        leases are renewed, since they decide which rules this host runs.
 
         Parameters
         ----------
-        dict
-            List of directories to sync with each instance. The key of the dict
-            becomes the name of the sync instance. The value of the dict
-            becomes the list of directories to sync with that instance.
+        none
 
         Returns
         -------
-        bool
-            True if new instance was created
-            False if no new instance was needed
+        ReconcilePlan
+            changes to apply
+
+        Throws
+        -------
+        none
+
+        """
+        plan = ReconcilePlan()
+        scan_start = time.time()
+
+        if self.remote_listing is not None:
+            self.remote_listing.refresh([rule['dir_selector'] for rule in self.config['sync_hierarchy_rules']])
+
+        # Get directories to sync. The scan is done once, and shared by the
+        # instances of every remote.
+        dirs_to_sync_by_rule = self.get_dirs_to_sync(self.config['sync_hierarchy_rules'])
+        self.activity.save()
+
+        plan.scan_ms = self.get_duration_ms(scan_start)
+
+        self.logger.debug(
+            "Scanned directories of %s sync rules.", len(self.config['sync_hierarchy_rules']),
+            extra={'phase': "scan", 'duration_ms': plan.scan_ms}
+        )
+
+        # With sharding, all rules are still evaluated (later rules depend on
+        # the directories taken by earlier ones), but only the rules leased
+        # to this host get instances here
+        if self.shards is not None:
+            syncnames = [rule['syncname'] for rule in self.config['sync_hierarchy_rules']]
+
+            if self.read_only:
+                owned_rules = self.shards.get_held_rules(syncnames)
+            else:
+                owned_rules = self.shards.get_owned_rules(syncnames, self.get_measured_rule_costs())
+
+                plan.released = {
+                    x: dirs_to_sync_by_rule.get(x, {}).get('sync', []) for x in self.shards.releasing
+                }
+
+            dirs_to_sync_by_rule = {
+                k: v for k, v in dirs_to_sync_by_rule.items() if k in owned_rules
+            }
+
+        # While memory is short, adjacent cold rules share instances
+        if self.consolidator is not None and self.consolidator.update(self.get_all_running_instances()):
+            dirs_to_sync_by_rule = self.consolidator.consolidate(
+                dirs_to_sync_by_rule, self.config['sync_hierarchy_rules'], self.get_consolidation_key
+            )
+
+            plan.consolidated = {
+                k: v['rules'] for k, v in dirs_to_sync_by_rule.items() if 'rules' in v
+            }
+
+        for remote in self.config['unison_remotes']:
+            for syncname, dirs in dirs_to_sync_by_rule.items():
+                instance_name = self.get_instance_name(syncname, remote)
+                plan.instances[instance_name] = dict(
+                    dirs, syncname=dirs.get('syncname', syncname), remote=remote['name']
+                )
+
+        plan.all_instance_names = {
+            self.get_instance_name(rule['syncname'], remote)
+            for rule in self.config['sync_hierarchy_rules']
+            for remote in self.config['unison_remotes']
+        }.union(plan.instances)
+
+        # Any running instance which is not needed anymore is killed
+        plan.kill = [x for x in self.data_storage.running_data if x not in plan.instances]
+
+        for instance_name, dirs_to_sync in plan.instances.items():
+            self.plan_instance(plan, instance_name, dirs_to_sync)
+
+        # Fill the free worker slots with the most overdue scheduled rules
+        plan.due = self.scheduler.get_due_instances(plan.scheduled, plan.running_scheduled)
+
+        if self.config['isolate_unison_archives']:
+            plan.cold = [
+                x for x in plan.start + list(plan.restart) + plan.due
+                if not self.archives.has_archive(x)
+            ]
+
+        return plan
+
+    def plan_instance(self, plan, instance_name, dirs_to_sync):
+        """Decide what to do with one planned instance, and add it to the plan.
+
+        Parameters
+        ----------
+        1) ReconcilePlan
+            plan to add the instance to
+        2) str
+            name of the sync instance
+        3) dict
+            directories of the instance, like passed to create_sync_instance
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        rule = self.get_sync_rule(dirs_to_sync['syncname'])
+        instance_info = self.data_storage.get_data(instance_name)
+
+        # Scheduled rules are started by the scheduler, not kept running
+        if self.scheduler.is_scheduled(rule):
+            plan.scheduled.append((instance_name, rule))
+
+            if instance_info is None:
+                return
+
+            # A one-shot sync which is still running is left alone, but a
+            # continuous instance of a rule switched to scheduled is stopped,
+            # so the scheduler takes over
+            if instance_info.get('mode') == 'scheduled':
+                plan.running_scheduled.append(instance_name)
+            else:
+                plan.kill.append(instance_name)
+
+            return
+
+        if instance_info is not None:
+            changed = self.get_changed_config_components(
+                instance_info, self.get_config_components(instance_name, dirs_to_sync)
+            )
+
+            if len(changed) > 0:
+                plan.restart[instance_name] = changed
+            else:
+                plan.keep.append(instance_name)
+
+        # Instances which keep crashing wait out their backoff
+        elif not self.restart_policy.check_start(instance_name):
+            plan.backoff.append(instance_name)
+
+        else:
+            plan.start.append(instance_name)
+
+    def get_consolidation_key(self, rule):
+        """Return which rules may share an instance while memory is short.
+
+        Parameters
+        ----------
+        dict
+            sync rule
+
+        Returns
+        -------
+        tuple
+            settings which must be equal for rules to share an instance, or
+            None if the rule always keeps its own instance
+
+        Throws
+        -------
+        none
+
+        """
+        # Pinned rules are hot, scheduled rules already exit between syncs,
+        # and the ignores of include_ignores rules would hide the directories
+        # of the rules merged with them
+        if (
+            rule.get('pinned', False) or
+            rule.get('include_ignores', False) or
+            self.scheduler.is_scheduled(rule)
+        ):
+            return None
+
+        return (
+            str(self.get_effective_unison_options(rule)),
+            self.get_process_priority(rule)['class'],
+            self.bandwidth.get_weight(rule),
+        )
+
+    def apply_plan(self, plan):
+        """Start, restart and kill sync instances as planned.
+
+        Restarts, including instances replaced by others, are still subject
+        to the restart policy, and new instances and due one-shot syncs to
+        admission control.
+
+        Parameters
+        ----------
+        ReconcilePlan
+            changes to apply, as from plan_sync_instances()
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        # Kill instances which are no longer needed. This is done first, to
+        # free capacity for new instances.
+        deferred_dirs, replacing = self.kill_unneeded_instances(plan)
+
+        # Failure counts are kept while their rule exists, so a rule which
+        # briefly has no directories to sync does not escape its backoff
+        self.restart_policy.prune_failures(plan.all_instance_names)
+
+        # Likewise, run times of scheduled rules are kept while the rule exists
+        self.scheduler.prune(plan.all_instance_names)
+
+        # Archives are kept while their rule exists, even if the rule has no
+        # directories to sync right now, so they stay warm
+        if self.config['isolate_unison_archives']:
+            self.archives.collect_garbage(plan.all_instance_names)
+
+        admission = AdmissionControl(self.config, self.data_storage, self.logger)
+        priority_ranks = list(self.config['priority_classes'])
+
+        for order, (instance_name, dirs_to_sync) in enumerate(plan.instances.items()):
+
+            # Instances taking over directories of an instance whose
+            # replacement was deferred wait for it, so no directory is synced
+            # by two instances at once
+            if not deferred_dirs.isdisjoint(dirs_to_sync['sync']) and instance_name not in plan.keep:
+                self.logger.info(
+                    "Instance '" + instance_name + "' " +
+                    "Waiting for the instance it replaces to be stopped."
+                )
+                continue
+
+            # Running instances already hold their slot, so they are updated
+            # (and restarted if needed) right away
+            if instance_name in plan.keep or instance_name in plan.restart:
+                self.restart_policy.record_healthy(instance_name, self.data_storage.get_data(instance_name))
+                self.create_sync_instance(instance_name, dirs_to_sync)
+
+            # New instances wait for capacity, highest priority first. The
+            # directories of stopped instances they replace are not synced
+            # until they start, so replacements go before all others.
+            elif instance_name in plan.start:
+                priority = self.get_process_priority(self.get_sync_rule(dirs_to_sync['syncname']))
+                admission.enqueue(
+                    instance_name,
+                    -1 if instance_name in replacing else priority_ranks.index(priority['class']),
+                    order, self.get_remote(dirs_to_sync['remote'])
+                )
+
+        # Due one-shot syncs wait for capacity too. They queue behind new
+        # continuous instances of the same priority, most overdue first.
+        for order, instance_name in enumerate(plan.due, len(plan.instances)):
+            if not deferred_dirs.isdisjoint(plan.instances[instance_name]['sync']):
+                continue
+
+            priority = self.get_process_priority(self.get_sync_rule(plan.instances[instance_name]['syncname']))
+            admission.enqueue(
+                instance_name, priority_ranks.index(priority['class']), order,
+                self.get_remote(plan.instances[instance_name]['remote'])
+            )
+
+        # Admission limits apply to the instances of all sync roots together,
+        # including the starts of the roots reconciled before this one
+        top = self.parent if self.parent is not None else self
+
+        with self.admission_lock:
+            admitted = admission.admit(self.get_all_running_instances(), top.instance_starts_this_run)
+            top.instance_starts_this_run += len(admitted)
+
+            for instance_name in admitted:
+                self.create_sync_instance(instance_name, plan.instances[instance_name])
+
+                # A due sync which is not admitted stays due for the next run
+                if instance_name in plan.due:
+                    self.scheduler.record_start(instance_name)
+
+        # Expire rotated logs, including the ones rotated during this run
+        self.log_rotator.prune(plan.all_instance_names)
+
+        self.bandwidth.prune(set(self.data_storage.running_data))
+
+        if self.latency_probe is not None:
+            self.latency_probe.check(
+                self.data_storage.running_data,
+                {remote['name']: remote for remote in self.config['unison_remotes']}
+            )
+            self.latency_probe.start(self.data_storage.running_data)
+
+    def kill_unneeded_instances(self, plan):
+        """Stop the running instances which are no longer planned.
+
+        An instance whose directories move to other planned instances, for
+        example when rules are merged, split or renamed, is replaced, which
+        is a restart. The instances replaced together, like all rules of a
+        merge, are only stopped once the restart policy allows a restart of
+        each of them, like a config change. The new instances of a
+        replacement have a new profile and archive, so they rescan all their
+        directories in full. To spread the rescans, replacements start at
+        most 'max_instance_starts_per_run' new instances per run, but the
+        first replacement of a run is always allowed.
+
+        Parameters
+        ----------
+        ReconcilePlan
+            changes to apply
+
+        Returns
+        -------
+        tuple
+            (set of the directories of the replaced instances which keep
+            running, since their replacement was deferred, set of the new
+            instances replacing stopped ones)
+
+        Throws
+        -------
+        none
+
+        """
+        deferred_dirs = set()
+        replacing = set()
+        max_starts = self.config['max_instance_starts_per_run']
+
+        for planned, replaced in self.get_replacement_groups(plan):
+            new_instances = set(x for x in planned if x in plan.start)
+
+            if len(planned) > 0:
+                if max_starts > 0 and 0 < len(replacing) and len(replacing) + len(new_instances) > max_starts:
+                    for inst in sorted(replaced):
+                        self.logger.info(
+                            "Instance '" + inst + "' " +
+                            "Replacement waits for a later run, max_instance_starts_per_run reached."
+                        )
+                    deferred_dirs.update(x for name in replaced for x in self.get_running_dirs(name))
+                    continue
+
+                # Every replaced instance is checked, so each queues its change
+                allowed = [
+                    self.restart_policy.check_restart(
+                        inst, "replaced", self.data_storage.running_data[inst],
+                        self.get_sync_rule(self.data_storage.running_data[inst].get('rule', inst)),
+                        ["replaced"],
+                        self.transfers.is_transferring(inst, self.data_storage.running_data[inst])
+                    )
+                    for inst in sorted(replaced)
+                ]
+
+                if not all(allowed):
+                    deferred_dirs.update(x for name in replaced for x in self.get_running_dirs(name))
+                    continue
+
+                replacing.update(new_instances)
+
+            for inst_to_kill in sorted(replaced):
+                self.logger.debug(
+                    "Cleaning up instance '%s' which is no longer needed.", inst_to_kill,
+                    extra={'syncname': inst_to_kill, 'phase': "kill"}
+                )
+                self.kill_sync_instance_by_pid(self.data_storage.running_data[inst_to_kill]['pid'])
+                self.data_storage.remove_data(inst_to_kill)
+                self.restart_policy.clear_pending(inst_to_kill)
+
+                if len(planned) > 0:
+                    self.restart_policy.record_restart(inst_to_kill, "replaced")
+
+        return deferred_dirs, replacing
+
+    def get_running_dirs(self, instance_name):
+        """Return the directories a running instance syncs.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        set[str]
+            full paths of the directories
+
+        Throws
+        -------
+        none
+
+        """
+        return set(
+            self.config['unison_local_root'] + os.sep + x
+            for x in self.data_storage.running_data[instance_name]['dirs_to_sync']
+        )
+
+    def get_replacement_groups(self, plan):
+        """Group the unneeded instances with the planned instances replacing them.
+
+        Parameters
+        ----------
+        ReconcilePlan
+            changes to apply
+
+        Returns
+        -------
+        list[tuple]
+            (set of planned instances, set of unneeded running instances) of
+            every group, in the order of the unneeded instances. Instances
+            sharing a directory are in the same group, so a merge or split is
+            one group. Unneeded instances which nothing replaces have no
+            planned instances.
+
+        Throws
+        -------
+        none
+
+        """
+        killed_dirs = {x: self.get_running_dirs(x) for x in plan.kill}
+        groups = []
+        grouped = set()
+
+        for inst_to_kill in plan.kill:
+            if inst_to_kill in grouped:
+                continue
+
+            replaced = {inst_to_kill}
+            planned = set()
+
+            # Grow the group until no other instance shares a directory with it
+            while True:
+                dirs = set(x for name in replaced for x in killed_dirs[name])
+                new_planned = set(x for x in plan.instances if not dirs.isdisjoint(plan.instances[x]['sync']))
+                dirs.update(x for name in new_planned for x in plan.instances[name]['sync'])
+                new_replaced = set(x for x in killed_dirs if not dirs.isdisjoint(killed_dirs[x]))
+
+                if new_planned == planned and new_replaced == replaced:
+                    break
+
+                planned, replaced = new_planned, new_replaced
+
+            grouped.update(replaced)
+            groups.append((planned, replaced))
+
+        return groups
+
+    def report_plan(self, as_json=False):
+        """Return the plan of all sync roots, ready to print.
+
+        Requires a handler opened read-only, so nothing is changed.
+
+        Parameters
+        ----------
+        bool
+            return JSON instead of text
+
+        Returns
+        -------
+        str
+            plan of each sync root
+
+        Throws
+        -------
+        none
+
+        """
+        plans = [(handler.root_name, handler.plan_sync_instances()) for handler in self.root_handlers]
+
+        if as_json:
+            return json.dumps(
+                {(root_name or ""): plan.to_dict() for root_name, plan in plans}, indent=2
+            )
+
+        return "\n\n".join(
+            plan.format_text("" if root_name is None else "[" + root_name + "] ")
+            for root_name, plan in plans
+        )
+
+    def get_duration_ms(self, start_time):
+        """Return the milliseconds elapsed since a time, for structured logs.
+
+        Parameters
+        ----------
+        float
+            start time, as returned by time.time()
+
+        Returns
+        -------
+        int
+            elapsed milliseconds
+
+        Throws
+        -------
+        none
+
+        """
+        return int((time.time() - start_time) * 1000)
+
+    def restart_stuck_instances(self):
+        """Stop running instances which have stopped making progress.
+
+        Their data is removed, so they are started again by the caller,
+        subject to admission control. The restart counts towards the global
+        restart budget.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        list[str]
+            names of the instances which were stopped
+
+        Throws
+        -------
+        none
+
+        """
+        stuck_instances = self.watchdog.check_instances(
+            self.data_storage.running_data, self.get_sync_rule
+        )
+
+        for instance_name, reason in stuck_instances:
+            instance_info = self.data_storage.get_data(instance_name)
+
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                "Restarting stuck instance: " + reason + "."
+            )
+
+            self.kill_sync_instance_by_pid(instance_info['pid'])
+            self.data_storage.remove_data(instance_name)
+            self.restart_policy.record_restart(instance_name, "stuck: " + reason)
+
+            # A stuck one-shot sync counts as run, and waits for its interval
+            if instance_info.get('mode') == 'scheduled':
+                self.scheduler.record_finish(instance_info)
+
+        return [x[0] for x in stuck_instances]
+
+    def get_measured_rule_costs(self):
+        """Measure the CPU cost of the rules running on this host.
+
+        The cost of a rule is the average share of a CPU used by its unison
+        processes (including their ssh transports) since they started, summed
+        over the instances of every remote.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            cost of each running rule, keyed by syncname
+
+        Throws
+        -------
+        none
+
+        """
+        costs = {}
+        now = time.time()
+
+        for record in self.data_storage.registry.get_records():
+            instance_info = record.info
+            proc = record.get_process()
+
+            if proc is None:
+                continue
+
+            try:
+                cpu_seconds = sum(proc.cpu_times()[:2])
+
+                for child in proc.children(recursive=True):
+                    cpu_seconds += sum(child.cpu_times()[:2])
+
+            except psutil.Error:
+                continue
+
+            uptime = max(now - instance_info.get('start_time', now), 1)
+            rule = instance_info.get('rule', instance_info['syncname'])
+            costs[rule] = costs.get(rule, 0.0) + cpu_seconds / uptime
+
+        return costs
+
+    def get_sorted_dirs(self, sync_instance, handled_dirs):
+        """Glob the directories of a rule, and sort them.
+
+        Parameters
+        ----------
+        1) dict
+            the sync rule
+        2) set[str]
+            directories handled by previous rules, left out unless the rule
+            sets 'overlap'
+
+        Returns
+        -------
+        list[str]
+            the directories, in the order of the rule's sort method, or None
+            if the sort method is not valid
+
+        Throws
+        -------
+        none
+
+        """
+        # Find full list
+        expr = (
+            self.config['unison_local_root'] +
+            os.sep +
+            sync_instance['dir_selector']
+        )
+
+        # Get full list of glob directories
+        all_dirs_from_glob = glob.glob(self.sanatize_path(expr))
+
+        # Add directories which so far only exist on a remote
+        if self.remote_listing is not None:
+            remote_dirs = set(self.remote_listing.get_dirs(sync_instance['dir_selector']))
+            all_dirs_from_glob += sorted(remote_dirs.difference(all_dirs_from_glob))
+
+        # Overlapping rules see every directory
+        all_unhandled_dirs_from_glob = all_dirs_from_glob
+
+        # Remove any dirs already handled in a previous loop, unless
+        # overlap is set
+        if (
+            'overlap' not in sync_instance or
+            sync_instance['overlap'] is False
+        ):
+
+            self.logger.debug(
+                "Instance '%s' Removing already handled directories.",
+                sync_instance['syncname']
+            )
+
+            before = len(all_dirs_from_glob)
+            all_unhandled_dirs_from_glob = [x for x in all_dirs_from_glob if x not in handled_dirs]
+            after = len(all_unhandled_dirs_from_glob)
+
+            # Log event if the duplication handler remove directories
+            # Added 'False and' to disable this section. TMI in the logs
+            if(before != after):
+                self.logger.debug(
+                    "Instance '%s' Parse result: %s dirs down to %s dirs " +
+                    "by removing already handled dirs",
+                    sync_instance['syncname'], before, after
+                )
+
+        # By default, use 'name_highfirst'
+        if 'sort_method' not in sync_instance:
+            sync_instance['sort_method'] = 'name_highfirst'
+
+        # Apply sort
+        if sync_instance['sort_method'] == 'name_highfirst':
+            sorted_dirs = sorted(all_unhandled_dirs_from_glob, reverse=True)
+        elif sync_instance['sort_method'] == 'name_lowfirst':
+            sorted_dirs = sorted(all_unhandled_dirs_from_glob)
+        elif sync_instance['sort_method'] == 'activity_highfirst':
+            sorted_dirs = self.activity.sort_by_activity(all_unhandled_dirs_from_glob)
+        # Add other sort implementations here later, if wanted
+        else:
+
+            # Message for exception and self.logger
+            msg = (
+                "'" + sync_instance['sort_method'] + "'" +
+                " is not a valid sort method on sync instance " +
+                "'" + sync_instance['syncname'] + "'. " +
+                "Instance will not be created."
+            )
+
+            # Send message to self.logger
+            self.logger.warn(msg)
+
+            # Uncomment this to raise an exception instead of returning blank
+            # raise ValueError(msg)
+
+            # Return nothing, since sort was invalid
+            return None
+
+        return sorted_dirs
+
+    def get_dirs_to_sync(self, sync_hierarchy_rules):
+        """Start a new sync instance with provided details.
+
+        # Parses the filesystem, and lists l
+
+        Parameters
+        ----------
+        Pass through sync_hierarchy_rules from config
+
+        Returns
+        -------
+        dict (nested)
+            [syncname] - name of the sync name for this batch
+                ['sync'] - directories to sync in this instance
+                ['ignore'] - directories to ignore in this instance
+
+        Throws
+        -------
+        none
+
+        """
+        # Contains the set of directories which have been handled by the loop
+        # so future iterations don't duplicate work
+        handled_dirs = set()
+
+        # Contains list which is built up within the loop and returned at the
+        # end of the method
+        all_dirs_to_sync = {}
+
+        # Directories left after each tier of a template, keyed by the
+        # syncname of the template
+        chain_remainders = {}
+
+        self.logger.debug(
+            "Processing directories to sync. %s rules to process.",
+            len(sync_hierarchy_rules)
+        )
+
+        for sync_instance in sync_hierarchy_rules:
+
+            self.logger.debug(
+                "Instance '%s' Parsing rules and directories.",
+                sync_instance['syncname']
+            )
+
+            tier_of = sync_instance.get('tier_of')
+
+            if tier_of in chain_remainders:
+                # Later tiers of a template take the next slice of the list
+                # the first tier globbed and sorted
+                sorted_dirs = chain_remainders[tier_of]
+
+            else:
+                sorted_dirs = self.get_sorted_dirs(sync_instance, handled_dirs)
+
+                # Return blank dir set, since sort was invalid
+                if sorted_dirs is None:
+                    return {}
+
+            # Apply sort_count, if it's set
+            if 'sort_count' in sync_instance:
+
+                if (not isinstance(sync_instance['sort_count'], int)):
+                    # if not int, throw warning
+                    self.logger.warning(
+                        "Instance '" + sync_instance['syncname'] + "' " +
+                        "sort_count '" + str(sync_instance['sort_count']) + "'" +
+                        " is not castable to int. Setting sort_count to a " +
+                        "default of '3'."
+                    )
+
+                    # Then set a default
+                    sync_instance['sort_count'] = 3
+
+                else:
+                    # If it's a valid int, use it
+                    self.logger.debug(
+                        "Instance '%s' sort_count set at %s.",
+                        sync_instance['syncname'], sync_instance['sort_count']
+                    )
+
+                dirs_to_sync = list(
+                    itertools.islice(
+                        sorted_dirs, 0, sync_instance['sort_count'], 1
+                    )
+                )
+
+            else:
+                # if sort_count is not set, sync all dirs
+                dirs_to_sync = sorted_dirs
+
+            if tier_of is not None:
+                chain_remainders[tier_of] = sorted_dirs[len(dirs_to_sync):]
+
+            # Activity ranks shift every run, so the selected directories are
+            # kept in name order, and only a change of the selection restarts.
+            # Later tiers are not sorted again, so they may lack the default.
+            if sync_instance.get('sort_method') == 'activity_highfirst':
+                dirs_to_sync = sorted(dirs_to_sync, reverse=True)
+
+            # Rules covering directories which contain the directories of
+            # previous rules (like a catch-all) can ignore those, so they do
+            # not rescan directories already synced by another instance
+            dirs_to_ignore = []
+
+            if sync_instance.get('include_ignores', False) and len(dirs_to_sync) > 0:
+                dirs_to_ignore = self.get_ignores_for_handled_dirs(dirs_to_sync, handled_dirs)
+
+                self.logger.debug(
+                    "Instance '%s' Ignoring already handled directories " +
+                    "with %s ignore rules.",
+                    sync_instance['syncname'], len(dirs_to_ignore)
+                )
+
+            # Add all these directories to the handled_dirs so they aren't
+            # duplicated later
+            handled_dirs.update(dirs_to_sync)
+
+            # add dirs to final output nested dict
+            if len(dirs_to_sync) > 0:
+                all_dirs_to_sync[sync_instance['syncname']] = {
+                    'sync': dirs_to_sync,
+                    'ignore': dirs_to_ignore,
+                }
+
+            self.logger.debug(
+                "Instance '%s' Syncing %s directories.",
+                sync_instance['syncname'], len(dirs_to_sync)
+            )
+
+            # Shouldn't need this, except when in deep debugging
+            # If you need it, turn it on
+            if(False):
+                dirstr = "\n   ".join(dirs_to_sync)
+                print(
+                    sync_instance['syncname'] +
+                    " directories :\n   " +
+                    dirstr + "\n\n"
+                )
+
+        self.logger.debug(
+            "Sync rule parsing complete. Syncing %s explicit directories " +
+            "in all instances combined",
+            len(handled_dirs)
+        )
+
+        # Shouldn't need this, except when in deep debugging
+        # If you need it, turn it on
+        if(False):
+            print("All directories synced :\n   " + "\n   ".join(sorted(handled_dirs)))
+
+        return all_dirs_to_sync
+
+    def get_ignores_for_handled_dirs(self, dirs_to_sync, handled_dirs):
+        """Build unison ignore paths for directories handled by other instances.
+
+        Only handled directories below one of the directories to sync are
+        relevant. They are grouped by parent directory into a single path
+        pattern per parent, listing the exact names. Wildcards are not used,
+        since they would also hide directories created later, or existing
+        only on the remote, which no other instance syncs yet.
+
+        Parameters
+        ----------
+        1) list[str]
+            directories synced by this instance
+        2) set[str]
+            directories already synced by other instances
+
+        Returns
+        -------
+        list[str]
+            path patterns relative to the local root, for '-ignore=Path ...'
+
+        Throws
+        -------
+        none
+
+        """
+        amount_to_clip = (len(self.config['unison_local_root']) + 1)
+        sync_prefixes = tuple(x + os.sep for x in dirs_to_sync)
+
+        # Group the relevant handled directories by their parent
+        handled_by_parent = {}
+
+        for handled_dir in handled_dirs:
+            if handled_dir.startswith(sync_prefixes):
+                parent, name = os.path.split(handled_dir)
+                handled_by_parent.setdefault(parent, set()).add(name)
+
+        ignores = []
+
+        for parent in sorted(handled_by_parent):
+            patterns = [self.escape_unison_pattern(x) for x in sorted(handled_by_parent[parent])]
+
+            if len(patterns) == 1:
+                alternatives = patterns[0]
+            else:
+                alternatives = "{" + ",".join(patterns) + "}"
+
+            ignores.append(parent[amount_to_clip:] + os.sep + alternatives)
+
+        return ignores
+
+    def escape_unison_pattern(self, name):
+        """Escape characters which have a meaning in unison path patterns.
+
+        Parameters
+        ----------
+        str
+            literal file or directory name
+
+        Returns
+        -------
+        str
+            name, safe to use in a unison pattern
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> US = UnisonHandler(False)
+
+        >>> US.escape_unison_pattern("Order {1,2} *final*")
+        'Order \\{1\\,2\\} \\*final\\*'
+
+        """
+        for char in "\\*?[]{},":
+            name = name.replace(char, "\\" + char)
+
+        return name
+
+    def create_sync_instance(self, instance_name, dirs):
+        """Start a new sync instance with provided details, if not already there.
+
+        Parameters
+        ----------
+        1) str
+            Name of the sync instance
+        2) dict
+            ['sync'] - directories to sync with this instance
+            ['ignore'] - path patterns to ignore in this instance, relative to
+            the local root
+
+        Returns
+        -------
+        bool
+            True if new instance was created
+            False if no new instance was needed
+
+        Throws
+        -------
+        none
+
+        """
+        # TODO: check global config hash here too, not just instance-specific config
+        self.logger.debug(
+            "Processing instance '%s', deciding whether to kill or not",
+            instance_name
+        )
+
+        dirs_to_sync = dirs['sync']
+        rule = self.get_sync_rule(dirs['syncname'])
+        remote = self.get_remote(dirs['remote'])
+
+        # Obtain a hash of the requested config to be able to later check if
+        # the instance should be killed and restarted or not.
+        # This hash will be stored with the instance data, and if it changes,
+        # the instance will be killed and restarted so that new config can be
+        # applied.
+        config_components = self.get_config_components(instance_name, dirs)
+        config_hash = self.get_config_hash(config_components)
+
+        # Get data from requested instance, if there is any
+        requested_instance = self.data_storage.get_data(instance_name)
+
+        # Scheduling priority of the unison process. Changing it does not
+        # require a restart, so it is not part of the config hash.
+        priority = self.get_process_priority(rule)
+        bandwidth_weight = self.bandwidth.get_weight(rule)
+
+        if requested_instance is None:
+
+            # No instance data found, must start new one
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                "No instance data found, starting new sync instance."
+            )
+
+        elif requested_instance['config_hash'] == config_hash:
+            # Existing instance data found, still uses same config - no restart
+            self.logger.debug(
+                "Instance '%s' Instance data found, config still unchanged.",
+                instance_name
+            )
+
+            # Drop any queued change, since the config has returned to the
+            # one the instance is running with
+            self.restart_policy.clear_pending(instance_name)
+
+            # Apply priority changes to the running process in place
+            if requested_instance.get('priority') != priority:
+                self.apply_priority_to_running_instance(requested_instance['pid'], priority)
+                requested_instance['priority'] = priority
+                self.data_storage.set_data(instance_name, requested_instance)
+
+            # Weight changes apply with the next split of the bandwidth budget
+            if 'rate_file' in requested_instance and requested_instance['bandwidth_weight'] != bandwidth_weight:
+                requested_instance['bandwidth_weight'] = bandwidth_weight
+                self.data_storage.set_data(instance_name, requested_instance)
+
+            # Unison keeps its log open, so the log is rotated by restarting
+            # the instance, which loses no log lines
+            if not (
+                self.log_rotator.needs_rotation(instance_name) and
+                not self.transfers.is_transferring(instance_name, requested_instance) and
+                self.restart_policy.check_budget(
+                    instance_name, requested_instance, rule, "Log rotation postponed"
+                )
+            ):
+                return False
+
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                "Log file is due for rotation. Restarting instance."
+            )
+
+            self.kill_sync_instance_by_pid(requested_instance['pid'])
+            self.data_storage.remove_data(requested_instance['syncname'])
+            self.restart_policy.record_restart(instance_name, "log rotation")
+
+        elif not self.restart_policy.check_restart(
+            instance_name, config_hash, requested_instance, rule,
+            self.get_changed_config_components(requested_instance, config_components),
+            self.transfers.is_transferring(instance_name, requested_instance)
+        ):
+            # Config changed, but the restart budget does not allow a restart
+            # yet. The change stays queued until a later run.
+            return False
+
+        else:
+            # Existing instance data found, but uses different config, so restarting
+            self.logger.info(
+                "Instance '" + instance_name + "' " +
+                "Instance data found, but config or directories to sync have" +
+                " changed. Restarting instance."
+            )
+
+            self.kill_sync_instance_by_pid(requested_instance['pid'])
+            self.data_storage.remove_data(requested_instance['syncname'])
+            self.restart_policy.record_restart(
+                instance_name, "changed: " + ", ".join(
+                    self.get_changed_config_components(requested_instance, config_components)
+                )
+            )
+
+        # Process dirs into a format for the unison profile
+        dirs_for_unison = []
+        trimmed_dirs = []
+        amount_to_clip = (len(self.config['unison_local_root']) + 1)
+
+        for dir in dirs_to_sync:
+
+            # Clip off directory from local root
+            dir_trimmed = dir[amount_to_clip:]
+
+            # Format for unison profile
+            pathstr = "path = " + dir_trimmed + ""
+
+            # Append to list for profile
+            dirs_for_unison.append(pathstr)
+
+            # Append to list for config storage
+            trimmed_dirs.append(dir_trimmed)
+
+        for ignore in dirs['ignore']:
+            dirs_for_unison.append("ignore = Path " + ignore)
+
+        # Continuous instances also sync their own canary directory, which
+        # the latency probe writes to
+        if self.config['latency_probe_interval'] > 0 and rule.get('mode', 'continuous') == 'continuous':
+            canary_dir = LatencyProbe.CANARY_DIR + "/" + instance_name
+            os.makedirs(self.config['unison_local_root'] + os.sep + canary_dir, exist_ok=True)
+            dirs_for_unison.append("path = " + canary_dir)
+
+        # Basic verification check (by no means complete)
+
+        # Ensure local root exists
+        if not os.path.isdir(self.config['unison_local_root']):
+            raise IOError("Local root directory does not exist")
+
+        # Convert SSH config info into connection string
+        remote_path_connection_string = (
+            "" +
+            "ssh://" +
+            str(remote['ssh_conn']) +
+            "/" +
+            str(remote['root']) +
+            ""
+        )
+
+        roots_for_unison = [
+            "root = " + str(self.config['unison_local_root']),
+            "root = " + remote_path_connection_string,
+        ]
+
+        # Check if SSH config key is specified
+        if remote['ssh_keyfile'] == "":
+            # Key is not specified, don't use it
+            self.logger.debug("SSH key not specified")
+
+        else:
+            # Key is specified
+            self.logger.debug("Key specified: %s", remote['ssh_keyfile'])
+
+            roots_for_unison.append(
+                "sshargs = -i " + remote['ssh_keyfile']
+            )
+
+        # Set env vars to pass to unison
+        envvars = {
+            'UNISONLOCALHOSTNAME': self.config['unison_local_hostname'],
+            'HOME': self.config['unison_home_dir'],
+            'USER': self.config['unison_user'],
+            'LOGNAME': self.config['unison_user'],
+            'PWD': self.config['unison_home_dir'],
+        }
+
+        # Give each instance its own archive, so instances do not contend
+        # for (or corrupt) the shared archive in ~/.unison
+        if self.config['isolate_unison_archives']:
+            envvars['UNISON'] = self.archives.get_archive_dir(instance_name)
+            unison_dir = envvars['UNISON']
+        else:
+            unison_dir = self.config['unison_home_dir'] + os.sep + ".unison"
+
+        # Route the ssh transport through the throttling pipe, starting with
+        # the share the instance would get now. Shares are rebalanced once
+        # the run is done.
+        rate_file = None
+
+        if self.config['bandwidth_limit'] > 0:
+            rate_file = self.config['bandwidth_rate_dir'] + os.sep + instance_name + ".rate"
+            self.bandwidth.write_rate(rate_file, self.bandwidth.get_share(
+                bandwidth_weight,
+                bandwidth_weight + sum(
+                    x['bandwidth_weight'] for x in self.get_all_running_instances() if 'rate_file' in x
+                )
+            ))
+
+            roots_for_unison.append("sshcmd = " + self.bandwidth.get_pipe_path())
+            envvars['UNISONCTRL_RATE_FILE'] = rate_file
+            envvars['UNISONCTRL_SSH_COMMAND'] = self.config['bandwidth_ssh_command']
+
+        # No unison writes to the log at this point, so it can be rotated
+        logfile = self.log_rotator.get_logfile(instance_name)
+        self.log_rotator.rotate_if_needed(instance_name)
+        self.touch(logfile)
+
+        unison_options = self.get_effective_unison_options(rule)
+        mode = rule.get('mode', 'continuous')
+
+        # Scheduled rules run once and exit
+        if mode == 'scheduled':
+            unison_options = self.scheduler.get_unison_options(unison_options)
+
+        # The unison server on the remote gets its own archive directory too
+        server_lines, unison_options = self.archives.get_remote_profile_lines(instance_name, unison_options)
+
+        # Write all settings to a profile rather than the command line, which
+        # keeps large path lists clear of the argument length limit
+        profile_name = self.write_unison_profile(
+            instance_name,
+            unison_dir,
+            roots_for_unison +
+            server_lines +
+            dirs_for_unison +
+            [self.unison_option_to_profile_line(x) for x in unison_options] +
+            ["log = true"] +
+            [
+                "logfile = " +
+                logfile
+            ]
+        )
+
+        # Start unison. The label stays on the command line so instances can
+        # be recognized in the process list. The priority wrappers exec
+        # unison in the same process, so the ssh transport unison spawns
+        # inherits the priority class.
+        cmd = (
+            self.get_priority_command(instance_name, priority) +
+            [self.config['unison_path']] +
+            [profile_name] +
+            ["-label=" + profile_name]
+        )
+
+        # self.logger.info(" ".join(cmd))
+
+        running_instance_pid = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,  # close_fds=True,
+            env=envvars
+        ).pid
+
+        instance_info = {
+            "pid": running_instance_pid,
+            # Tells the process apart from later processes with the same PID
+            "create_time": self.get_process_create_time(running_instance_pid),
+            "syncname": instance_name,
+            "rule": dirs['syncname'],
+            "remote": remote['name'],
+            "config_hash": config_hash,
+            "config_components": {
+                key: self.get_config_hash([(key, value)]) for key, value in config_components
+            },
+            "dirs_to_sync": trimmed_dirs,
+            "dirs_to_ignore": dirs['ignore'],
+            "start_time": time.time(),
+            "logfile": logfile,
+            "label": profile_name,
+            "priority": priority,
+            "mode": mode
+        }
+
+        if rate_file is not None:
+            instance_info['rate_file'] = rate_file
+            instance_info['bandwidth_weight'] = bandwidth_weight
+
+        self.logger.info(
+            "New instance '" + instance_name + "' " +
+            " (PID " + str(instance_info['pid']) + ").",
+            extra={'syncname': instance_name, 'pid': instance_info['pid'], 'phase': "start"}
+        )
+
+        # Store instance info
+        self.data_storage.set_data(instance_name, instance_info)
+
+        # New instance was created, return true
+        return True
+
+    def get_process_create_time(self, pid):
+        """Return when a process was started.
+
+        Parameters
+        ----------
+        int
+            PID of the process
+
+        Returns
+        -------
+        float
+            start time, or None if the process already exited
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            return psutil.Process(pid).create_time()
+        except psutil.Error:
+            return None
+
+    def get_config_components(self, instance_name, dirs):
+        """Return the parts of the config which require a restart to change.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            directories of the instance, like passed to create_sync_instance
+
+        Returns
+        -------
+        list[tuple]
+            (component name, value as str), in hashing order
+
+        Throws
+        -------
+        none
+
+        """
+        remote = self.get_remote(dirs['remote'])
+        rule = self.get_sync_rule(dirs['syncname'])
+
+        config_components = [
+            # The instance name
+            ('name', str(instance_name)),
+
+            # The directories to sync
+            ('dirs', str(dirs['sync'])),
+
+            # The ignored directories
+            ('ignore', str(dirs['ignore'])),
+
+            # The remote connection
+            ('remote', str([remote['ssh_conn'], remote['root'], remote['ssh_keyfile']])),
+
+            # The global config, with the overrides of the rule
+            ('options', str(self.get_effective_unison_options(rule))),
+        ]
+
+        # The schedule of one-shot syncs. Only hashed for scheduled rules, so
+        # continuous instances keep their config hash.
+        if self.scheduler.is_scheduled(rule):
+            config_components.append(('mode', "scheduled every " + str(rule['interval']) + "s"))
+
+        # The canary directory of the latency probe. Only hashed while
+        # enabled, so instances started without probes keep their config hash.
+        if self.config['latency_probe_interval'] > 0 and rule.get('mode', 'continuous') == 'continuous':
+            config_components.append(('probe', LatencyProbe.CANARY_DIR + "/" + instance_name))
+
+        # The throttling pipe in the ssh transport, likewise
+        if self.config['bandwidth_limit'] > 0:
+            config_components.append(
+                ('transport', str([self.bandwidth.get_pipe_path(), self.config['bandwidth_ssh_command']]))
+            )
+
+        return config_components
+
+    def get_effective_unison_options(self, rule):
+        """Return the unison options of a rule, merged with the global ones.
+
+        A rule option replaces every global option of the same name, at the
+        place of the first one. Options unison accepts several times, like
+        '-ignore' or '-path', are added to the global ones instead.
+
+        Parameters
+        ----------
+        dict
+            sync rule the instance is created from (may be None)
+
+        Returns
+        -------
+        list[str]
+            options to pass to unison
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> US = UnisonHandler(False)
+        >>> US.config['global_unison_config_options'] = ["-fastcheck", "-repeat=5", "-ignore=Name *.tmp"]
+
+        >>> US.get_effective_unison_options({"unison_options": ["-repeat=60", "-ignore=Name *.bak"]})
+        ['-fastcheck', '-repeat=60', '-ignore=Name *.tmp', '-ignore=Name *.bak']
+
+        >>> US.get_effective_unison_options({"unison_options": ["-fastcheck=false"]})
+        ['-fastcheck=false', '-repeat=5', '-ignore=Name *.tmp']
+
+        """
+        options = self.config['global_unison_config_options']
+
+        if rule is None or len(rule.get('unison_options', [])) == 0:
+            return options
+
+        options = list(options)
+
+        for option in rule['unison_options']:
+            name = self.get_unison_option_name(option)
+
+            if name in self.REPEATABLE_UNISON_OPTIONS:
+                options.append(option)
+                continue
+
+            positions = [i for i, x in enumerate(options) if self.get_unison_option_name(x) == name]
+
+            if len(positions) == 0:
+                options.append(option)
+                continue
+
+            options[positions[0]] = option
+            options = [x for i, x in enumerate(options) if i not in positions[1:]]
+
+        return options
+
+    def get_unison_option_name(self, option):
+        """Return the name of a unison command line option.
+
+        Parameters
+        ----------
+        str
+            command line option, like '-repeat=5'
+
+        Returns
+        -------
+        str
+            name of the option, like 'repeat'
+
+        Throws
+        -------
+        none
+
+        Doctests
+        -------
+        >>> US = UnisonHandler(False)
+
+        >>> US.get_unison_option_name("-repeat=5")
+        'repeat'
+
+        >>> US.get_unison_option_name("-fastcheck")
+        'fastcheck'
+
+        """
+        return option.lstrip("-").split("=", 1)[0].strip()
+
+    def get_config_hash(self, config_components):
+        """Hash config components into the hash stored with an instance.
+
+        Parameters
+        ----------
+        list[tuple]
+            (component name, value as str), as from get_config_components
+
+        Returns
+        -------
+        str
+            sha256 hex digest of the concatenated values
+
+        Throws
+        -------
+        none
+
+        """
+        return hashlib.sha256(
+            "".join(value for key, value in config_components).encode('utf-8')
+        ).hexdigest()
+
+    def get_changed_config_components(self, instance_info, config_components):
+        """Return which parts of the config of a running instance changed.
+
+        Parameters
+        ----------
+        1) dict
+            stored data of the running instance
+        2) list[tuple]
+            requested config components, as from get_config_components
+
+        Returns
+        -------
+        list[str]
+            names of the changed, added and removed components, empty if the
+            config hash is unchanged, or ['unknown'] for instances started
+            before components were stored
+
+        Throws
+        -------
+        none
+
+        """
+        if instance_info['config_hash'] == self.get_config_hash(config_components):
+            return []
+
+        if 'config_components' not in instance_info:
+            return ['unknown']
+
+        requested = dict(config_components)
+
+        return [
+            key for key, value in config_components
+            if instance_info['config_components'].get(key) != self.get_config_hash([(key, value)])
+        ] + [
+            key for key in instance_info['config_components'] if key not in requested
+        ]
+
+    def get_sync_rule(self, syncname):
+        """Return the sync hierarchy rule with the given syncname.
+
+        Parameters
+        ----------
+        str
+            syncname of the rule to find
+
+        Returns
+        -------
+        dict
+            the rule from 'sync_hierarchy_rules', or None if not found
+
+        Throws
+        -------
+        none
+
+        """
+        for rule in self.config['sync_hierarchy_rules']:
+            if rule['syncname'] == syncname:
+                return rule
+
+        return None
+
+    def get_process_priority(self, rule):
+        """Return the scheduling settings for a unison process of a rule.
+
+        Parameters
+        ----------
+        dict
+            sync rule the instance is created from (may be None)
+
+        Returns
+        -------
+        dict
+            ['class'] - name of the priority class
+            ['nice'] - nice value (-20 to 19)
+            ['ionice_class'] - 'best-effort' or 'idle'
+            ['ionice_level'] - best-effort level (0 to 7)
+            ['cpu_affinity'] - list of CPUs, or None for all CPUs
+
+        Throws
+        -------
+        none
+
+        """
+        if rule is None:
+            rule = {}
+
+        priority_class = rule.get('priority', self.config['default_priority'])
+
+        # Start from the defaults, then apply the class and rule settings
+        priority = {
+            'class': priority_class,
+            'nice': 0,
+            'ionice_class': 'best-effort',
+            'ionice_level': 4,
+            'cpu_affinity': None,
+        }
+        priority.update(self.config['priority_classes'][priority_class])
+
+        if 'cpu_affinity' in rule:
+            priority['cpu_affinity'] = rule['cpu_affinity']
+
+        return priority
+
+    def apply_process_priority(self, priority, pid=0):
+        """Apply scheduling settings to a process.
+
+        Parameters
+        ----------
+        1) dict
+            scheduling settings, as returned by get_process_priority
+        2) int
+            PID of the process, or 0 for the current process
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        OSError or psutil.Error if the settings can not be applied
+
+        """
+        os.setpriority(os.PRIO_PROCESS, pid, priority['nice'])
+
+        proc = psutil.Process(pid if pid != 0 else None)
+
+        if priority['ionice_class'] == 'idle':
+            proc.ionice(psutil.IOPRIO_CLASS_IDLE)
+        else:
+            proc.ionice(psutil.IOPRIO_CLASS_BE, value=priority['ionice_level'])
+
+        if priority['cpu_affinity'] is not None:
+            os.sched_setaffinity(pid, priority['cpu_affinity'])
+
+    def get_priority_command(self, instance_name, priority):
+        """Return the wrappers which start a process with scheduling settings.
+
+        nice, ionice and taskset each apply a setting and exec the next
+        command, so the wrapped process keeps the PID, and its children
+        inherit the settings from the start. Settings which can not be
+        applied are left out with a warning, and the instance runs with the
+        default for them.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) dict
+            scheduling settings, as returned by get_process_priority
+
+        Returns
+        -------
+        list[str]
+            command to prepend to the command of the process
+
+        Throws
+        -------
+        none
+
+        """
+        # nice adds to the niceness of unisonctrl itself
+        cmd = ["nice", "-n", str(priority['nice'] - os.getpriority(os.PRIO_PROCESS, 0))]
+
+        if shutil.which("ionice") is None:
+            self.logger.warning(
+                "Instance '" + instance_name + "' " +
+                "ionice not found, the I/O priority of class '" + priority['class'] + "' is not applied."
+            )
+        elif priority['ionice_class'] == 'idle':
+            cmd += ["ionice", "-t", "-c", "3"]
+        else:
+            cmd += ["ionice", "-t", "-c", "2", "-n", str(priority['ionice_level'])]
+
+        if priority['cpu_affinity'] is None:
+            return cmd
+
+        # taskset fails, and would not start unison, on unusable CPUs
+        if shutil.which("taskset") is None or not set(priority['cpu_affinity']).issubset(os.sched_getaffinity(0)):
+            self.logger.warning(
+                "Instance '" + instance_name + "' " +
+                "Could not apply the cpu_affinity " + str(priority['cpu_affinity']) +
+                " of class '" + priority['class'] + "', taskset is missing or the CPUs are unavailable."
+            )
+            return cmd
+
+        return cmd + ["taskset", "-c", ",".join(str(x) for x in priority['cpu_affinity'])]
+
+    def apply_priority_to_running_instance(self, pid, priority):
+        """Apply changed scheduling settings to a running unison instance.
+
+        The settings are applied to the unison process and its children (the
+        ssh transport), so the instance does not need to be restarted.
+
+        Parameters
+        ----------
+        1) int
+            PID of the unison instance
+        2) dict
+            scheduling settings, as returned by get_process_priority
+
+        Returns
+        -------
+        none
+
+        Throws
+        -------
+        none
+
+        """
+        if not psutil.pid_exists(pid):
+            return
+
+        try:
+            procs = [psutil.Process(pid)]
+            procs += procs[0].children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+
+        for proc in procs:
+            try:
+                self.apply_process_priority(priority, proc.pid)
+            except (OSError, psutil.Error) as e:
+                self.logger.warning(
+                    "Could not apply priority class '" + priority['class'] +
+                    "' to PID " + str(proc.pid) + ": " + str(e)
+                )
+
+        self.logger.info(
+            "Applied priority class '" + priority['class'] + "' to PID " +
+            str(pid) + " without restarting."
+        )
+
+    def get_profile_name(self, instance_name):
+        """Return the name of the unison profile of an instance.
+
+        The name is also the label on the unison command line, which tells
+        the processes of the instances apart. With several sync roots, it
+        includes the name of the root, since rules of different roots may
+        share a syncname, and their profiles may share ~/.unison.
+
+        Parameters
+        ----------
+        str
+            name of the sync instance
+
+        Returns
+        -------
+        str
+            name of the profile
+
+        Throws
+        -------
+        none
+
+        """
+        if self.root_name is None:
+            return "unisonctrl-" + instance_name
+
+        return "unisonctrl-" + self.root_name + "." + instance_name
+
+    def write_unison_profile(self, instance_name, unison_dir, profile_lines):
+        """Write the unison profile of an instance, if its content changed.
+
+        Parameters
+        ----------
+        1) str
+            name of the sync instance
+        2) str
+            unison directory the instance is started with
+        3) list[str]
+            preference lines of the profile
+
+        Returns
+        -------
+        str
+            name of the profile, to pass to unison
 
         Throws
         -------
         none
 
         """
-        # TODO: check global config hash here too, not just instance-specific config
-        self.logger.debug(
-            "Processing instance '" + instance_name + "' , deciding whether" +
-            "to kill or not"
-        )
-
-        # Obtain a hash of the requested config to be able to later check if
-        # the instance should be killed and restarted or not.
-        # This hash will be stored with the instance data, and if it changes,
-        # the instance will be killed and restarted so that new config can be
-        # applied.
-        config_hash = hashlib.sha256((
+        profile_name = self.get_profile_name(instance_name)
+        profile_path = unison_dir + os.sep + profile_name + ".prf"
 
-            # Include the instance name in the config hash
-            str(instance_name) +
+        content = (
+            "# Generated by unisonctrl for instance '" + instance_name + "'.\n" +
+            "# Do not edit, changes will be overwritten.\n" +
+            "\n".join(profile_lines) + "\n"
+        )
 
-            # Include the directories to sync in the config hash
-            str(dirs_to_sync) +
+        new_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-            # Include the global config in the config hash
-            str(self.config['global_unison_config_options'])
+        if os.path.isfile(profile_path):
+            with open(profile_path, 'rb') as f:
+                old_hash = hashlib.sha256(f.read()).hexdigest()
+        else:
+            old_hash = None
 
-        ).encode('utf-8')).hexdigest()
+        # Leave the file alone if unchanged, so unison does not see it change
+        if new_hash == old_hash:
+            self.logger.debug(
+                "Instance '%s' Profile '%s' unchanged.",
+                instance_name, profile_path
+            )
+            return profile_name
 
-        # Get data from requested instance, if there is any
-        requested_instance = self.data_storage.get_data(instance_name)
+        if not os.path.isdir(unison_dir):
+            os.makedirs(unison_dir)
 
-        if requested_instance is None:
+        # Write to a temporary file first, so a profile is never half written
+        with open(profile_path + ".tmp", 'w') as f:
+            f.write(content)
 
-            # No instance data found, must start new one
-            self.logger.info(
-                "Instance '" + instance_name + "' " +
-                "No instance data found, starting new sync instance."
-            )
+        os.replace(profile_path + ".tmp", profile_path)
 
-        elif requested_instance['config_hash'] == config_hash:
-            # Existing instance data found, still uses same config - no restart
-            self.logger.debug(
-                "Instance '" + instance_name + "' " +
-                "Instance data found, config still unchanged."
-            )
-            return False
-        else:
-            # Existing instance data found, but uses different config, so restarting
-            self.logger.info(
-                "Instance '" + instance_name + "' " +
-                "Instance data found, but config or directories to sync have" +
-                " changed. Restarting instance."
-            )
+        self.logger.debug(
+            "Instance '%s' Wrote profile '%s'.",
+            instance_name, profile_path
+        )
 
-            self.kill_sync_instance_by_pid(requested_instance['pid'])
-            self.data_storage.remove_data(requested_instance['syncname'])
+        return profile_name
 
-        # Process dirs into a format for unison command line arguments
-        dirs_for_unison = []
-        trimmed_dirs = []
-        amount_to_clip = (len(self.config['unison_local_root']) + 1)
+    def unison_option_to_profile_line(self, option):
+        """Convert a unison command line option into a profile line.
 
-        for dir in dirs_to_sync:
+        Parameters
+        ----------
+        str
+            command line option, like '-fastcheck' or '-ignore=Name {*.tmp}'
 
-            # Clip off directory from local root
-            dir_trimmed = dir[amount_to_clip:]
+        Returns
+        -------
+        str
+            preference line for a unison profile
 
-            # Format for unison command line args
-            pathstr = "-path=" + dir_trimmed + ""
+        Throws
+        -------
+        none
 
-            # Append to list for args
-            dirs_for_unison.append(pathstr)
+        Doctests
+        -------
+        >>> US = UnisonHandler(False)
 
-            # Append to list for config storage
-            trimmed_dirs.append(dir_trimmed)
+        >>> US.unison_option_to_profile_line("-prefer=newer")
+        'prefer = newer'
 
-        # Basic verification check (by no means complete)
+        >>> US.unison_option_to_profile_line("-ignore=Name {*.tmp}")
+        'ignore = Name {*.tmp}'
 
-        # Ensure local root exists
-        if not os.path.isdir(self.config['unison_local_root']):
-            raise IOError("Local root directory does not exist")
+        >>> US.unison_option_to_profile_line("-fastcheck")
+        'fastcheck = true'
 
-        # Convert SSH config info into connection string
-        remote_path_connection_string = (
-            "" +
-            "ssh://" +
-            str(self.config['unison_remote_ssh_conn']) +
-            "/" +
-            str(self.config['unison_remote_root']) +
-            ""
-        )
+        """
+        option = option.lstrip("-")
 
-        # todo: add '-label' here
+        if "=" in option:
+            key, value = option.split("=", 1)
+            return key + " = " + value
 
-        # print(remote_path_connection_string)
+        # Flags without a value are booleans
+        return option + " = true"
 
-        # Check if SSH config key is specified
-        if self.config['unison_remote_ssh_keyfile'] == "":
-            # Key is not specified, don't use it
-            # TODO: reformat this entry
-            self.logger.debug("SSH key not specified")
+    def get_instance_name(self, syncname, remote):
+        """Return the name of the sync instance of a rule on a remote.
 
-        else:
-            # Key is specified
-            # TODO: reformat this entry
-            self.logger.debug("Key specified: " + self.config['unison_remote_ssh_keyfile'])
-
-            remote_path_connection_string = (
-                remote_path_connection_string +
-                " -sshargs='-i " +
-                self.config['unison_remote_ssh_keyfile'] +
-                "'"
-            )
+        Parameters
+        ----------
+        1) str
+            syncname of the rule
+        2) dict
+            remote, as found in 'unison_remotes'
 
-        # print(remote_path_connection_string)
+        Returns
+        -------
+        str
+            name of the sync instance
 
-        # Set env vars to pass to unison
-        envvars = {
-            'UNISONLOCALHOSTNAME': self.config['unison_local_hostname'],
-            'HOME': self.config['unison_home_dir'],
-            'USER': self.config['unison_user'],
-            'LOGNAME': self.config['unison_user'],
-            'PWD': self.config['unison_home_dir'],
-        }
+        Throws
+        -------
+        none
 
-        logfile = self.config['unison_log_dir'] + os.sep + instance_name + ".log"
-        self.touch(logfile)
+        """
+        # The unnamed remote of a single-remote config keeps the plain
+        # syncname, so existing instances are not renamed
+        if remote['name'] == "":
+            return syncname
 
-        # Start unison
-        cmd = (
-            [self.config['unison_path']] +
-            ["" + str(self.config['unison_local_root']) + ""] +
-            [remote_path_connection_string] +
-            ["-label=unisonctrl-" + instance_name] +
-            dirs_for_unison +
-            self.config['global_unison_config_options'] +
-            ["-log=true"] +
-            [
-                "-logfile=" +
-                logfile
-            ]
-        )
+        return syncname + "@" + remote['name']
 
-        # self.logger.info(" ".join(cmd))
+    def get_remote(self, name):
+        """Return the remote with the given name.
 
-        running_instance_pid = subprocess.Popen(
-            cmd,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,  # close_fds=True,
-            env=envvars
-        ).pid
+        Parameters
+        ----------
+        str
+            name of the remote
 
-        instance_info = {
-            "pid": running_instance_pid,
-            "syncname": instance_name,
-            "config_hash": config_hash,
-            "dirs_to_sync": trimmed_dirs
-        }
+        Returns
+        -------
+        dict
+            the remote from 'unison_remotes', or None if not found
 
-        self.logger.info(
-            "New instance '" + instance_name + "' " +
-            " (PID " + str(instance_info['pid']) + ")."
-        )
+        Throws
+        -------
+        none
 
-        # Store instance info
-        self.data_storage.set_data(instance_name, instance_info)
+        """
+        for remote in self.config['unison_remotes']:
+            if remote['name'] == name:
+                return remote
 
-        # New instance was created, return true
-        return True
+        return None
 
     def touch(self, fname, mode=0o644, dir_fd=None, **kwargs):
         """Python equuivilent for unix "touch".
@@ -607,37 +2535,16 @@ class UnisonHandler():
         -------
 
         """
-        # Get the list of known pids to ensure we only kill one of those
-        running_data = self.data_storage.running_data
-
         self.logger.debug(
-            "Attempting to kill PID '" + str(pid) + "'"
+            "Attempting to kill PID '%s'", pid,
+            extra={'pid': pid, 'phase': "kill"}
         )
 
-        known_pids = []
-
-        # Gets PIDs of all the known unison processes
-        known_pids = [int(running_data[d]['pid']) for d in running_data]
-
-        # TODO: Rewrite this function, it can probably be done with reduce()
-        # RESOLUTION: Rewritten above, this kept in case it doesn't work
-        # for entry in running_data:
-        #    running_data[entry]
-        #    known_pids.append(int(running_data[entry]['pid']))
-
-        # TODO: Finish this error checking logic here, currently it doesn't check the PID
-
-        # Try and kill with sigint (same as ctrl+c), if we are allowed to
-
-        # First make sure the process exists
-        if not psutil.pid_exists(pid):
-            self.logger.info(
-                "PID " + str(pid) + " was not found. Perhaps already dead?"
-            )
-            return
+        # Only PIDs of known unison instances may be killed
+        record = self.data_storage.registry.get_by_pid(pid)
 
-        # Then make sure it's a process we started
-        elif pid not in known_pids:
+        # Make sure it's a process we started
+        if record is None:
 
             shortmsg = (
                 "PID #" + str(pid) + " is not managed by UnisonCTRL. " +
@@ -656,6 +2563,15 @@ class UnisonHandler():
 
             raise RuntimeError(shortmsg)
 
+        # Then make sure the process still exists, and was not replaced by
+        # another process with the same PID
+        elif not record.is_running():
+            self.logger.info(
+                "PID " + str(pid) + " of instance '" + record.name + "' was not " +
+                "found. Perhaps already dead?"
+            )
+            return
+
         # Finally, kill the process if it exists and we started it
         else:
             return self.kill_pid(pid)
@@ -685,6 +2601,8 @@ class UnisonHandler():
         if not psutil.pid_exists(pid):
             return
 
+        kill_start = time.time()
+
         # If it did not die nicely, get stronger about killing it
         p = psutil.Process(pid)
 
@@ -695,7 +2613,8 @@ class UnisonHandler():
         # Ensure it still exists before continuing
         if not psutil.pid_exists(pid):
             self.logger.debug(
-                "PID " + str(pid) + " was killed with SIGTERM successfully."
+                "PID %s was killed with SIGTERM successfully.", pid,
+                extra={'pid': pid, 'phase': "kill", 'duration_ms': self.get_duration_ms(kill_start)}
             )
             return
 
@@ -705,7 +2624,8 @@ class UnisonHandler():
 
         self.logger.info(
             "PID " + str(pid) + " could not be killed with SIGTERM, and " +
-            "was killed with SIGKILL."
+            "was killed with SIGKILL.",
+            extra={'pid': pid, 'phase': "kill", 'duration_ms': self.get_duration_ms(kill_start)}
         )
 
         return
@@ -734,14 +2654,21 @@ class UnisonHandler():
         none
 
         """
-        # Get the list of processes we know are running and we think are running
-        # Also, convert each PID to int to make sure we can compare
-        actually_running_processes = self.get_running_unison_processes()
-        l = self.data_storage.running_data
-        supposedly_running_processes = [int(l[d]['pid']) for d in l]
+        # Find which instances we think are running but aren't. A PID which
+        # now belongs to another process counts as dead.
+        dead_instances = [
+            record.pid for record in self.data_storage.registry.get_records() if not record.is_running()
+        ]
+
+        # One-shot syncs of scheduled rules are expected to exit
+        for instance_id in list(dead_instances):
+            process = self.get_process_info_by_pid(instance_id)
 
-        # Find which instances we think are running but aren't
-        dead_instances = [x for x in supposedly_running_processes if x not in actually_running_processes]
+            if process.get('mode') == 'scheduled':
+                self.scheduler.record_finish(process)
+                self.data_storage.remove_data(process['syncname'])
+                self.restart_policy.clear_pending(process['syncname'])
+                dead_instances.remove(instance_id)
 
         # Note: if nothing crashes, dead instances should never exist.
         if(len(dead_instances) > 0):
@@ -751,8 +2678,8 @@ class UnisonHandler():
             )
         else:
             self.logger.debug(
-                "Found " + str(len(dead_instances)) + " unexpected dead " +
-                "instances to clean up."
+                "Found %s unexpected dead instances to clean up.",
+                len(dead_instances)
             )
 
         # Remove data on dead instances
@@ -760,12 +2687,18 @@ class UnisonHandler():
             process = self.get_process_info_by_pid(instance_id)
 
             self.logger.debug(
-                "Removing data on '" + str(process['syncname']) + "' " +
-                "because it is not running as expected."
+                "Removing data on '%s' because it is not running as expected.",
+                process['syncname'],
+                extra={'syncname': process['syncname'], 'pid': instance_id, 'phase': "cleanup"}
             )
 
+            self.restart_policy.record_exit(process)
             self.data_storage.remove_data(process['syncname'])
 
+            # A change queued for the dead instance applies to the next start
+            # anyway, and must not make a later change look overdue
+            self.restart_policy.clear_pending(process['syncname'])
+
     def get_process_info_by_pid(self, pid):
         """Return the syncname of a process given it's PID.
 
@@ -787,48 +2720,10 @@ class UnisonHandler():
         """
         # TODO: discuss if self.logger needs to happen here? I think not? -BY
 
-        for process in self.data_storage.running_data:
-            if self.data_storage.running_data[process]['pid'] == pid:
-                return self.data_storage.running_data[process]
-
-    def get_running_unison_processes(self):
-        """Return PIDs of currently running unison instances.
-
-        Parameters
-        ----------
-        none
-
-
-        Returns
-        -------
-        list[int]
-            PIDs of unison instances, empty list
-
-        Throws
-        -------
-        none
-
-        """
-        # Get PIDs
-        # Note: throws exception if no instances exist
-        try:
-            pids = str(subprocess.check_output(["pidof", '/usr/bin/unison']))
-
-            # Parse command output into list by removing junk chars and exploding
-            # string with space delimiter
-            pids = pids[2:-3].split(' ')
-
-        except subprocess.CalledProcessError:
-            # If error caught here, no unison instances are found running
-            pids = []
-
-        self.logger.debug(
-            "Found " + str(len(pids)) + " running instances on this system: PIDs " +
-            ", ".join(pids)
-        )
+        record = self.data_storage.registry.get_by_pid(pid)
 
-        # Return, after converting to ints
-        return list(map(int, pids))
+        if record is not None:
+            return record.info
 
     def import_config(self):
         """Import config from config, and apply details where needed.
@@ -880,6 +2775,67 @@ class UnisonHandler():
             'unison_user',
             'webhooks',
             'rotate_logs',
+            'state_data_dir',
+            'instance_restart_min_interval',
+            'restart_debounce',
+            'restart_debounce_max',
+            'global_restart_limit',
+            'global_restart_window',
+            'priority_classes',
+            'default_priority',
+            'max_instances',
+            'max_instance_starts_per_run',
+            'max_memory_percent',
+            'max_load_per_cpu',
+            'scheduled_workers',
+            'isolate_unison_archives',
+            'unison_archive_dir',
+            'unison_remote_archive_dir',
+            'unison_remotes',
+            'sync_roots',
+            'max_parallel_roots',
+            'shard_state_dir',
+            'shard_node_name',
+            'shard_lease_ttl',
+            'shard_rebalance_slack',
+            'watchdog_max_cycle_time',
+            'watchdog_min_cpu_seconds',
+            'crash_fast_failure_time',
+            'crash_backoff_base',
+            'crash_backoff_max',
+            'crash_backoff_jitter',
+            'crash_quarantine_after',
+            'crash_quarantine_time',
+            'instance_log_max_bytes',
+            'instance_log_max_age',
+            'instance_log_backups',
+            'instance_log_retention',
+            'instance_log_compress',
+            'log_format',
+            'restart_max_defer',
+            'urgent_restart_components',
+            'transfer_active_bytes_per_second',
+            'bandwidth_limit',
+            'bandwidth_rate_dir',
+            'bandwidth_ssh_command',
+            'bandwidth_idle_reserve',
+            'activity_half_life',
+            'activity_sample_interval',
+            'activity_sample_depth',
+            'activity_sample_entries',
+            'activity_max_samples_per_run',
+            'remote_listing',
+            'remote_listing_command',
+            'remote_listing_timeout',
+            'latency_probe_interval',
+            'latency_probe_command',
+            'latency_probe_timeout',
+            'latency_probe_max_wait',
+            'consolidation_max_rss',
+            'consolidation_memory_percent',
+            'consolidation_hysteresis',
+            'consolidation_min_time',
+            'consolidation_group_size',
         }
 
         # If a setting contains a directory path, add it's key here and it will
@@ -890,6 +2846,10 @@ class UnisonHandler():
             'running_data_dir',
             'unison_log_dir',
             'unisonctrl_log_dir',
+            'state_data_dir',
+            'unison_archive_dir',
+            'shard_state_dir',
+            'bandwidth_rate_dir',
         }
 
         # Values here are used as config values unless overridden in the
@@ -900,12 +2860,82 @@ class UnisonHandler():
             'make_root_directories_if_not_found': True,
             'unison_path': '/usr/bin/unison',  # Default ubuntu path for unison
             'unison_remote_ssh_keyfile': "",
+            'unison_remote_root': "",
+            'unison_remote_ssh_conn': "",
+            'unison_remotes': [],
+            'unison_local_root': "",
+            'sync_hierarchy_rules': [],
+            'sync_roots': [],
+            'max_parallel_roots': 0,
+            'shard_state_dir': "",
+            'shard_node_name': platform.node(),
+            'shard_lease_ttl': 300,
+            'shard_rebalance_slack': 0.25,
+            'watchdog_max_cycle_time': 1800,
+            'watchdog_min_cpu_seconds': 1.0,
             'unison_local_hostname': platform.node(),
             'running_data_dir': self.config['data_dir'] + os.sep + "running-sync-instance-information",
             'unison_log_dir': self.config['data_dir'] + os.sep + "unison-logs",
             'unisonctrl_log_dir': self.config['data_dir'] + os.sep + "unisonctrl-logs",
             'unison_user': getpass.getuser(),
             'rotate_logs': "time",
+            'log_format': "text",
+            'instance_log_max_bytes': 50 * 1024 * 1024,
+            'instance_log_max_age': 7 * 86400,
+            'instance_log_backups': 5,
+            'instance_log_retention': 30 * 86400,
+            'instance_log_compress': True,
+            'state_data_dir': self.config['data_dir'] + os.sep + "controller-state",
+            'instance_restart_min_interval': 600,
+            'restart_debounce': 120,
+            'restart_debounce_max': 900,
+            'global_restart_limit': 4,
+            'global_restart_window': 300,
+            'restart_max_defer': 3600,
+            'urgent_restart_components': ['remote'],
+            'transfer_active_bytes_per_second': 65536,
+            'bandwidth_limit': 0,
+            'bandwidth_rate_dir': self.config['data_dir'] + os.sep + "bandwidth",
+            'bandwidth_ssh_command': "ssh",
+            'bandwidth_idle_reserve': 0.1,
+            'activity_half_life': 86400,
+            'activity_sample_interval': 300,
+            'activity_sample_depth': 1,
+            'activity_sample_entries': 32,
+            'activity_max_samples_per_run': 100,
+            'remote_listing': False,
+            'remote_listing_command': "",
+            'remote_listing_timeout': 30,
+            'latency_probe_interval': 0,
+            'latency_probe_command': "",
+            'latency_probe_timeout': 30,
+            'latency_probe_max_wait': 3600,
+            'consolidation_max_rss': 0,
+            'consolidation_memory_percent': 0,
+            'consolidation_hysteresis': 0.1,
+            'consolidation_min_time': 3600,
+            'consolidation_group_size': 4,
+            'crash_fast_failure_time': 300,
+            'crash_backoff_base': 60,
+            'crash_backoff_max': 3600,
+            'crash_backoff_jitter': 0.2,
+            'crash_quarantine_after': 5,
+            'crash_quarantine_time': 86400,
+            'priority_classes': {
+                'high': {'nice': 0, 'ionice_class': 'best-effort', 'ionice_level': 0},
+                'normal': {'nice': 5, 'ionice_class': 'best-effort', 'ionice_level': 4},
+                'low': {'nice': 10, 'ionice_class': 'best-effort', 'ionice_level': 7},
+                'idle': {'nice': 19, 'ionice_class': 'idle'},
+            },
+            'default_priority': 'normal',
+            'max_instances': 0,
+            'max_instance_starts_per_run': 0,
+            'max_memory_percent': 0,
+            'max_load_per_cpu': 0,
+            'scheduled_workers': 0,
+            'isolate_unison_archives': True,
+            'unison_archive_dir': self.config['unison_home_dir'] + os.sep + ".unison-instances",
+            'unison_remote_archive_dir': ".unison-instances",
         }
 
         # TODO: Implement allowedSettings, which force settings to be
@@ -930,10 +2960,227 @@ class UnisonHandler():
         for key in settingPathsToSanitize:
             self.config[key] = self.sanatize_path(self.config[key])
 
+        # Ensure sync roots can be told apart
+        root_names = set()
+
+        for root in self.config['sync_roots']:
+            if root.get('name', "") == "" or root['name'] in root_names:
+                raise LookupError("Every sync root requires a unique 'name'")
+
+            # The name is used in directory and profile names
+            if os.sep in root['name'] or "." in root['name']:
+                raise LookupError(
+                    "Sync root name '" + root['name'] + "' can not contain '" + os.sep + "' or '.'"
+                )
+
+            root_names.add(root['name'])
+
         # If you reach here, configuration was read and imported without error
 
         return True
 
+    def validate_sync_config(self):
+        """Validate the remotes and sync rules of a sync root.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        True
+            if success
+
+        Throws
+        -------
+            'LookupError' if config is invalid.
+
+        """
+        if self.config['unison_local_root'] == "":
+            raise LookupError("Required config entry 'unison_local_root' not specified")
+
+        self.import_remotes_config()
+
+        if not 0 <= self.config['bandwidth_idle_reserve'] <= 1:
+            raise LookupError("Config entry 'bandwidth_idle_reserve' must be between 0 and 1")
+
+        self.config['sync_hierarchy_rules'] = self.expand_rule_templates(
+            self.config['sync_hierarchy_rules']
+        )
+
+        # Ensure every priority class used is defined
+        priorities_used = [self.config['default_priority']] + [
+            rule['priority'] for rule in self.config['sync_hierarchy_rules']
+            if 'priority' in rule
+        ]
+
+        for priority_class in priorities_used:
+            if priority_class not in self.config['priority_classes']:
+                raise LookupError("Unknown priority class: '" + priority_class + "'")
+
+        # Ensure scheduled rules know when to run
+        for rule in self.config['sync_hierarchy_rules']:
+            if rule.get('mode', 'continuous') not in ('continuous', 'scheduled'):
+                raise LookupError(
+                    "Unknown mode '" + str(rule['mode']) + "' on rule '" +
+                    rule['syncname'] + "'"
+                )
+
+            if rule.get('mode') == 'scheduled' and not isinstance(rule.get('interval'), int):
+                raise LookupError(
+                    "Scheduled rule '" + rule['syncname'] + "' requires an " +
+                    "integer 'interval' in seconds"
+                )
+
+            weight = rule.get('bandwidth_weight', 1)
+
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+                raise LookupError(
+                    "Rule '" + rule['syncname'] + "' requires a positive 'bandwidth_weight'"
+                )
+
+            for option in rule.get('unison_options', []):
+                if not isinstance(option, str) or not option.startswith("-"):
+                    raise LookupError(
+                        "Invalid unison option " + repr(option) + " on rule '" +
+                        rule['syncname'] + "', use the command line form like '-repeat=5'"
+                    )
+
+        return True
+
+    def expand_rule_templates(self, rules):
+        """Expand template rules into chains of batch rules.
+
+        A rule with "tiers" stands for one rule per tier, named
+        '<syncname>-batch-<n>', each taking the next "sort_count" directories
+        of the same sorted list. A tier is either a sort_count, or a dict with
+        a "sort_count" and settings overriding those of the template for
+        this tier only. The batch rules carry the template syncname in
+        'tier_of', so the directories are globbed and sorted once per chain.
+
+        Parameters
+        ----------
+        list[dict]
+            sync rules, possibly containing templates
+
+        Returns
+        -------
+        list[dict]
+            sync rules, with every template replaced by its batch rules
+
+        Throws
+        -------
+            'LookupError' if a template is invalid.
+
+        Doctests
+        -------
+        >>> UH = UnisonHandler.__new__(UnisonHandler)
+
+        >>> rules = UH.expand_rule_templates([{
+        ...     "syncname": "orders", "dir_selector": "O*",
+        ...     "tiers": [{"sort_count": 2, "priority": "high"}, 3],
+        ... }])
+
+        >>> [(x['syncname'], x['sort_count'], x.get('priority')) for x in rules]
+        [('orders-batch-1', 2, 'high'), ('orders-batch-2', 3, None)]
+
+        """
+        expanded = []
+
+        for rule in rules:
+            if 'tiers' not in rule:
+                expanded.append(rule)
+                continue
+
+            if not isinstance(rule['tiers'], list) or len(rule['tiers']) == 0:
+                raise LookupError("Template rule '" + rule['syncname'] + "' requires a list of 'tiers'")
+
+            # Tiers slice one list, so they can neither overlap nor set a
+            # sort_count of their own for the whole chain
+            if rule.get('overlap', False) or 'sort_count' in rule:
+                raise LookupError(
+                    "Template rule '" + rule['syncname'] + "' can not set " +
+                    "'overlap' or 'sort_count', set them per tier instead"
+                )
+
+            for number, tier in enumerate(rule['tiers'], 1):
+                if not isinstance(tier, dict):
+                    tier = {'sort_count': tier}
+
+                if (
+                    isinstance(tier.get('sort_count'), bool) or
+                    not isinstance(tier.get('sort_count'), int) or
+                    tier['sort_count'] < 1
+                ):
+                    raise LookupError(
+                        "Tier " + str(number) + " of template rule '" + rule['syncname'] +
+                        "' requires a positive integer 'sort_count'"
+                    )
+
+                for key in ('syncname', 'dir_selector', 'sort_method', 'overlap', 'tiers'):
+                    if key in tier:
+                        raise LookupError(
+                            "Tier " + str(number) + " of template rule '" + rule['syncname'] +
+                            "' can not set '" + key + "'"
+                        )
+
+                batch = {key: copy.deepcopy(value) for key, value in rule.items() if key != 'tiers'}
+                batch.update(copy.deepcopy(tier))
+                batch['syncname'] = rule['syncname'] + "-batch-" + str(number)
+                batch['tier_of'] = rule['syncname']
+
+                expanded.append(batch)
+
+        return expanded
+
+    def import_remotes_config(self):
+        """Build and validate the list of remotes in 'unison_remotes'.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        list[dict]
+            remotes to sync to (also stored in self.config['unison_remotes'])
+
+        Throws
+        -------
+            'LookupError' if the remotes are invalid.
+
+        """
+        # Without a list of remotes, the single remote settings are used
+        if len(self.config['unison_remotes']) == 0:
+            if self.config['unison_remote_root'] == "" or self.config['unison_remote_ssh_conn'] == "":
+                raise LookupError(
+                    "Required config entry 'unison_remote_root' and " +
+                    "'unison_remote_ssh_conn', or 'unison_remotes', not specified"
+                )
+
+            self.config['unison_remotes'] = [{
+                'name': "",
+                'ssh_conn': self.config['unison_remote_ssh_conn'],
+                'root': self.config['unison_remote_root'],
+                'ssh_keyfile': self.config['unison_remote_ssh_keyfile'],
+            }]
+
+        remote_names = set()
+
+        for remote in self.config['unison_remotes']:
+            for key in ('name', 'ssh_conn', 'root'):
+                if key not in remote:
+                    raise LookupError("Required entry '" + key + "' not specified on remote")
+
+            if remote['name'] in remote_names:
+                raise LookupError("Duplicate remote name: '" + remote['name'] + "'")
+
+            remote_names.add(remote['name'])
+            remote.setdefault('ssh_keyfile', "")
+            remote.setdefault('max_instances', 0)
+
+        return self.config['unison_remotes']
+
     def sanatize_path(self, path):
         """Sanitize directory paths by removing whitespace and trailing slashes.
 
@@ -1003,18 +3250,22 @@ class UnisonHandler():
 
         """
         self.logger.debug(
-            "Starting script shutdown in the class " +
+            "Starting script shutdown in the class %s",
             self.__class__.__name__
         )
 
         # Clean up dead processes before exiting
-        self.cleanup_dead_processes()
+        for handler in self.root_handlers:
+            handler.cleanup_dead_processes()
         """
         print("FAKELOG: [" + time.strftime("%c") + "] [UnisonCTRL] Exiting\n")
         """
         self.logger.debug(
-            "Script shutdown complete in class " +
+            "Script shutdown complete in class %s",
             self.__class__.__name__
         )
 
         self.logger.info("Exiting UnisonCTRL")
+
+        # Write out the log records still queued
+        self.log_listener.stop()
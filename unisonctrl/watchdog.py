@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# This script notices unison instances which are still running, but no longer
+# make any progress, for example when hung on a stale network share
+
+import os
+import time
+import psutil
+
+
+class InstanceWatchdog():
+    """InstanceWatchdog - find wedged unison instances by their lack of progress.
+
+    An instance makes progress when its log file grows, or when it (or its ssh
+    transport) uses CPU time. An instance which has made no progress for the
+    maximum cycle time of its rule is reported as stuck, so it can be
+    restarted. Unison rescans every few seconds, so a healthy instance uses
+    some CPU time even when there is nothing to sync.
+    """
+
+    # Key used to persist progress samples in the data storage backend
+    STATE_KEY = "watchdog"
+
+    # Number of stuck instance reports kept in the data storage
+    REPORT_LIMIT = 100
+
+    # configuration values
+    config = {}
+
+    def __init__(self, config, data_storage, logger):
+        """Prepare the watchdog.
+
+        Parameters
+        ----------
+        1) dict
+            unisonctrl configuration
+        2) DataStorage
+            storage backend, used to persist progress samples across runs
+        3) logging.Logger
+            logger to report stuck instances to
+
+        Returns
+        -------
+        null
+
+        Throws
+        -------
+        none
+
+        """
+        self.config = config
+        self.data_storage = data_storage
+        self.logger = logger
+
+    def get_max_cycle_time(self, rule):
+        """Return how long an instance of a rule may go without progress.
+
+        Parameters
+        ----------
+        dict
+            sync rule (may be None)
+
+        Returns
+        -------
+        int
+            seconds without progress before an instance is stuck, 0 if the
+            watchdog is disabled for the rule
+
+        Throws
+        -------
+        none
+
+        """
+        if rule is not None and 'max_cycle_time' in rule:
+            return rule['max_cycle_time']
+
+        return self.config['watchdog_max_cycle_time']
+
+    def get_cpu_seconds(self, pid):
+        """Return the CPU time used by a process and its children.
+
+        Parameters
+        ----------
+        int
+            PID of the process
+
+        Returns
+        -------
+        float
+            user and system CPU seconds, or None if the process is gone
+
+        Throws
+        -------
+        none
+
+        """
+        try:
+            proc = psutil.Process(pid)
+            cpu_seconds = sum(proc.cpu_times()[:2])
+
+            for child in proc.children(recursive=True):
+                cpu_seconds += sum(child.cpu_times()[:2])
+
+        except psutil.Error:
+            return None
+
+        return cpu_seconds
+
+    def get_log_size(self, instance_info):
+        """Return the size of the log file of an instance.
+
+        Parameters
+        ----------
+        dict
+            stored data of the instance
+
+        Returns
+        -------
+        int
+            size in bytes, or 0 if the log file is missing
+
+        Throws
+        -------
+        none
+
+        """
+        logfile = instance_info.get(
+            'logfile',
+            self.config['unison_log_dir'] + os.sep + instance_info['syncname'] + ".log"
+        )
+
+        try:
+            return os.stat(logfile).st_size
+        except OSError:
+            return 0
+
+    def check_instances(self, running_data, get_rule):
+        """Sample the progress of all running instances, and find stuck ones.
+
+        Parameters
+        ----------
+        1) dict
+            stored data of the running instances, keyed by instance name
+        2) callable
+            returns the sync rule of a syncname (or None)
+
+        Returns
+        -------
+        list[tuple]
+            (instance name, reason) of every stuck instance
+
+        Throws
+        -------
+        none
+
+        """
+        now = time.time()
+        state = self.data_storage.get_state(self.STATE_KEY, {'samples': {}, 'reports': []})
+        stuck = []
+
+        # Forget samples of instances which are no longer running
+        samples = {k: v for k, v in state['samples'].items() if k in running_data}
+
+        for instance_name, instance_info in running_data.items():
+            cpu_seconds = self.get_cpu_seconds(instance_info['pid'])
+
+            # Exited instances are handled by the dead process cleanup
+            if cpu_seconds is None:
+                continue
+
+            log_size = self.get_log_size(instance_info)
+            sample = samples.get(instance_name)
+
+            # Start over when the instance was restarted
+            if sample is None or sample['pid'] != instance_info['pid']:
+                samples[instance_name] = {
+                    'pid': instance_info['pid'],
+                    'log_size': log_size,
+                    'cpu_seconds': cpu_seconds,
+                    'last_progress': instance_info.get('start_time', now),
+                }
+                continue
+
+            if (
+                log_size != sample['log_size'] or
+                cpu_seconds - sample['cpu_seconds'] >= self.config['watchdog_min_cpu_seconds']
+            ):
+                sample['log_size'] = log_size
+                sample['cpu_seconds'] = cpu_seconds
+                sample['last_progress'] = now
+                continue
+
+            max_cycle_time = self.get_max_cycle_time(
+                get_rule(instance_info.get('rule', instance_info['syncname']))
+            )
+            idle_time = now - sample['last_progress']
+
+            if max_cycle_time > 0 and idle_time > max_cycle_time:
+                reason = (
+                    "no log output and less than " +
+                    str(self.config['watchdog_min_cpu_seconds']) + "s CPU time " +
+                    "in the last " + str(int(idle_time)) + "s"
+                )
+
+                self.logger.warning(
+                    "Instance '" + instance_name + "' " +
+                    "Appears to be stuck (PID " + str(instance_info['pid']) +
+                    "): " + reason + ".",
+                    extra={'syncname': instance_name, 'pid': instance_info['pid'], 'phase': "watchdog"}
+                )
+
+                stuck.append((instance_name, reason))
+                state['reports'].append({'instance': instance_name, 'time': now, 'reason': reason})
+
+        state['samples'] = samples
+        state['reports'] = state['reports'][-self.REPORT_LIMIT:]
+        self.data_storage.set_state(self.STATE_KEY, state)
+
+        return stuck